@@ -1,5 +1,6 @@
 from django.contrib import admin
-from api.models import Image, ThumbnailSize, ExpirableLink, AccountPlan, AccountPlanAssignement, Thumbnail
+from api.models import Image, ThumbnailSize, ExpirableLink, AccountPlan, AccountPlanAssignement, Thumbnail, \
+    ThumbnailJob, ThumbnailBackfill, StoredFile
 
 
 admin.site.register(Image)
@@ -8,4 +9,7 @@ admin.site.register(ExpirableLink)
 admin.site.register(AccountPlan)
 admin.site.register(AccountPlanAssignement)
 admin.site.register(Thumbnail)
+admin.site.register(ThumbnailJob)
+admin.site.register(ThumbnailBackfill)
+admin.site.register(StoredFile)
 
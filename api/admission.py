@@ -0,0 +1,65 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from rest_framework.exceptions import Throttled
+
+from api.metrics import render_admission_wait, render_admissions, renders_in_flight
+
+
+class RenderCapacityExceeded(Throttled):
+    default_detail = 'Thumbnail rendering is at capacity.'
+
+
+class RenderAdmission:
+    def __init__(self):
+        self._slots = None
+        self._limit = None
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    @property
+    def limit(self):
+        return settings.ADMISSION['MAX_CONCURRENT_RENDERS'] or os.cpu_count() or 1
+
+    @property
+    def slots(self):
+        limit = self.limit
+        with self._lock:
+            if self._slots is None or self._limit != limit:
+                self._slots = threading.BoundedSemaphore(limit)
+                self._limit = limit
+            return self._slots
+
+    @contextmanager
+    def admit(self):
+        # a render nested in an admitted one (a sprite of lazy thumbnails) runs in the slot it already holds
+        if getattr(self._local, 'depth', 0):
+            self._local.depth += 1
+            try:
+                yield
+            finally:
+                self._local.depth -= 1
+            return
+
+        slots = self.slots
+        started = time.monotonic()
+        admitted = slots.acquire(timeout=settings.ADMISSION['MAX_WAIT'])
+        render_admission_wait.observe(time.monotonic() - started)
+        render_admissions.inc(outcome='admitted' if admitted else 'rejected')
+        if not admitted:
+            raise RenderCapacityExceeded(wait=settings.ADMISSION['RETRY_AFTER'])
+
+        renders_in_flight.inc()
+        self._local.depth = 1
+        try:
+            yield
+        finally:
+            self._local.depth = 0
+            renders_in_flight.dec()
+            slots.release()
+
+
+render_admission = RenderAdmission()
@@ -0,0 +1,35 @@
+import django
+from asgiref.sync import sync_to_async
+from django.core.handlers import asgi
+
+
+class ASGIHandler(asgi.ASGIHandler):
+    # Django 3.2 only iterates streaming responses synchronously, responses that can be iterated
+    # asynchronously (api.serving.AsyncFileResponse) are sent without blocking the event loop
+    async def send_response(self, response, send):
+        if not hasattr(response, '__aiter__'):
+            return await super(ASGIHandler, self).send_response(response, send)
+
+        response_headers = []
+        for header, value in response.items():
+            if isinstance(header, str):
+                header = header.encode('ascii')
+            if isinstance(value, str):
+                value = value.encode('latin1')
+            response_headers.append((bytes(header), bytes(value)))
+        for cookie in response.cookies.values():
+            response_headers.append((b'Set-Cookie', cookie.output(header='').encode('ascii').strip()))
+        await send({'type': 'http.response.start', 'status': response.status_code, 'headers': response_headers})
+        try:
+            async for part in response:
+                for chunk, _ in self.chunk_bytes(part):
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            await send({'type': 'http.response.body'})
+        finally:
+            # closing sends request_finished, which closes the database connections of the sync thread
+            await sync_to_async(response.close, thread_sensitive=True)()
+
+
+def get_asgi_application():
+    django.setup(set_prefix=False)
+    return ASGIHandler()
@@ -0,0 +1,131 @@
+import logging
+import time
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Exists, F, OuterRef, Q
+
+from api.caching import invalidate_list_cache
+from api.metadata import METADATA_FIELDS
+from api.models import Image, Thumbnail, ThumbnailBackfill, ThumbnailSize
+
+
+logger = logging.getLogger(__name__)
+
+
+def missing_thumbnails(after=0, account_plan_id=None):
+    # one row per (image, size) of the uploader's plan that has no thumbnail yet,
+    # a join through the plan sizes with an anti-join on thumbnails instead of a subquery per image
+    pairs = Image.objects.filter(pk__gt=after).annotate(
+        size_id=F('uploader__account_plan_assignement__account_plan__thumbnail_sizes')
+    ).filter(size_id__isnull=False).exclude(
+        Exists(Thumbnail.objects.filter(original_image=OuterRef('pk'), thumbnail_size=OuterRef('size_id')))
+    )
+    if account_plan_id is not None:
+        pairs = pairs.filter(uploader__account_plan_assignement__account_plan=account_plan_id)
+    return pairs.order_by('pk', 'size_id').values_list('pk', 'size_id')
+
+
+def next_batch(after, batch_size, account_plan_id=None):
+    pairs = missing_thumbnails(after, account_plan_id)
+    image_ids = list(pairs.order_by('pk').values_list('pk', flat=True).distinct()[:batch_size])
+    if not image_ids:
+        return []
+    sizes = defaultdict(list)
+    for image_id, size_id in pairs.filter(pk__lte=image_ids[-1]):
+        sizes[image_id].append(size_id)
+    size_objects = ThumbnailSize.objects.in_bulk({size_id for size_ids in sizes.values() for size_id in size_ids})
+    images = Image.objects.in_bulk(image_ids)
+    return [(images[image_id], [size_objects[size_id] for size_id in sizes[image_id]]) for image_id in image_ids]
+
+
+def render_batch(batch, engine):
+    # submit every image before waiting so the engine renders the batch in parallel
+    submitted = []
+    failed = 0
+    for image, sizes in batch:
+        try:
+            submitted.append((image, image.submit_thumbnails(engine, sizes)))
+        except Exception:
+            logger.exception('Backfilling thumbnails of image %s failed', image.pk)
+            failed += len(sizes)
+    rendered = 0
+    missing = {image.pk: len(sizes) for image, sizes in batch}
+    for image, save_thumbnails in submitted:
+        try:
+            with transaction.atomic():
+                save_thumbnails()
+            rendered += missing[image.pk]
+        except Exception:
+            logger.exception('Backfilling thumbnails of image %s failed', image.pk)
+            failed += missing[image.pk]
+    return rendered, failed
+
+
+def create_cached_batch(batch):
+    # lazy thumbnails are rendered on their first request, only their rows are missing
+    for image, sizes in batch:
+        Thumbnail.create_cached([image], sizes)
+    return sum(len(sizes) for _, sizes in batch), 0
+
+
+def run_backfill(engine, name, batch_size, account_plan_id=None, restart=False, limit=None, report=None):
+    backfill, created = ThumbnailBackfill.objects.get_or_create(name=name)
+    if restart and not created:
+        backfill.delete()
+        backfill = ThumbnailBackfill.objects.create(name=name)
+    total = missing_thumbnails(backfill.last_image_id, account_plan_id).count()
+    started = time.monotonic()
+    done = batches = 0
+    while limit is None or batches < limit:
+        batch = next_batch(backfill.last_image_id, batch_size, account_plan_id)
+        if not batch:
+            # a finished run leaves no checkpoint, the next plan or size change starts over from the first image
+            backfill.delete()
+            break
+        if settings.THUMBNAIL_MATERIALIZATION == Thumbnail.MATERIALIZATION_LAZY:
+            rendered, failed = create_cached_batch(batch)
+        else:
+            rendered, failed = render_batch(batch, engine)
+        backfill.checkpoint(batch[-1][0].pk, rendered, failed)
+        done += rendered + failed
+        batches += 1
+        if report:
+            elapsed = time.monotonic() - started
+            report(backfill, done, total, done / elapsed if elapsed else 0)
+    return backfill
+
+
+def backfill_metadata(queryset, fields, batch_size, limit=None, report=None):
+    # rows are walked in primary key order, so a file that can't be read is skipped instead of retried forever
+    after = done = failed = batches = 0
+    while limit is None or batches < limit:
+        batch = list(queryset.filter(pk__gt=after).order_by('pk')[:batch_size])
+        if not batch:
+            break
+        for obj in batch:
+            try:
+                obj.read_metadata()
+            except Exception:
+                logger.exception('Reading the metadata of %s %s failed', queryset.model.__name__, obj.pk)
+                failed += 1
+        queryset.model.objects.bulk_update(batch, fields)
+        # rows of any number of users changed, every list goes stale
+        invalidate_list_cache()
+        after = batch[-1].pk
+        done += len(batch)
+        batches += 1
+        if report:
+            report(queryset.model, done, failed)
+    return done, failed
+
+
+def backfill_image_metadata(batch_size, limit=None, report=None):
+    images = backfill_metadata(
+        Image.objects.filter(Q(width=0) | Q(dhash__isnull=True)), METADATA_FIELDS + ['dhash'], batch_size, limit, report
+    )
+    thumbnails = backfill_metadata(
+        Thumbnail.objects.filter(width=0, cached=False), ['width', 'height'], batch_size, limit, report
+    )
+    return images, thumbnails
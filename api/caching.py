@@ -0,0 +1,144 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+
+
+class VersionedCache:
+    def __init__(self, name):
+        self.name = name
+        self._entries = OrderedDict()
+        self._version = None
+        self._local_version = 0
+        self._lock = threading.Lock()
+
+    @property
+    def version_key(self):
+        return f'api:{self.name}:version'
+
+    @property
+    def shared_cache(self):
+        alias = settings.PLAN_CACHE['SHARED_CACHE']
+        return caches[alias] if alias else None
+
+    def get_key_version_key(self, key):
+        return f'{self.version_key}:' + ':'.join(str(part) for part in key)
+
+    def get_versions(self, key):
+        # the version of the whole cache and the one of the key, in a single round trip to the shared cache
+        shared_cache = self.shared_cache
+        if shared_cache is None:
+            return self._local_version, 0
+        key_version_key = self.get_key_version_key(key)
+        versions = shared_cache.get_many([self.version_key, key_version_key])
+        version = versions.get(self.version_key)
+        if version is None:
+            shared_cache.add(self.version_key, 0, None)
+            version = shared_cache.get(self.version_key, 0)
+        return version, versions.get(key_version_key, 0)
+
+    def get_expires_at(self):
+        # without a shared cache nothing tells this process about changes saved by the others,
+        # so its entries only live for LOCAL_TIMEOUT seconds
+        if self.shared_cache is not None:
+            return None
+        return time.monotonic() + settings.PLAN_CACHE['LOCAL_TIMEOUT']
+
+    def get(self, key):
+        version, key_version = self.get_versions(key)
+        with self._lock:
+            if version != self._version:
+                self._entries.clear()
+                self._version = version
+                return None
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != key_version:
+                return None
+            if entry[1] is not None and entry[1] <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[2]
+
+    def set(self, key, value):
+        version, key_version = self.get_versions(key)
+        expires_at = self.get_expires_at()
+        with self._lock:
+            if version != self._version:
+                self._entries.clear()
+                self._version = version
+            self._entries[key] = (key_version, expires_at, value)
+            while len(self._entries) > settings.PLAN_CACHE['MAX_ENTRIES']:
+                self._entries.popitem(last=False)
+
+    def invalidate(self):
+        with self._lock:
+            self._entries.clear()
+            self._local_version += 1
+        self.bump(self.version_key)
+
+    def invalidate_key(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+        self.bump(self.get_key_version_key(key))
+
+    def bump(self, version_key):
+        shared_cache = self.shared_cache
+        if shared_cache is not None:
+            try:
+                shared_cache.incr(version_key)
+            except ValueError:
+                shared_cache.add(version_key, 1, None)
+
+
+plan_cache = VersionedCache('account-plans')
+
+
+LIST_VERSION_KEY = 'api:list-version'
+
+
+def get_list_cache():
+    alias = settings.LIST_CACHE['CACHE']
+    return caches[alias] if alias else None
+
+
+def get_list_version_key(user_id=None):
+    return LIST_VERSION_KEY if user_id is None else f'{LIST_VERSION_KEY}:{user_id}'
+
+
+def get_list_versions(cache, user_id):
+    keys = [get_list_version_key(), get_list_version_key(user_id)]
+    versions = cache.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            # counting from the clock rather than from 0, so a version evicted from the cache is never reused
+            cache.add(key, time.time_ns(), None)
+            versions[key] = cache.get(key)
+    return [versions[key] for key in keys]
+
+
+def get_list_cache_key(cache, user_id, variant):
+    global_version, user_version = get_list_versions(cache, user_id)
+    digest = hashlib.md5(variant.encode()).hexdigest()
+    return f'api:list:{user_id}:{global_version}:{user_version}:{digest}'
+
+
+def bump_list_version(user_id=None):
+    cache = get_list_cache()
+    if cache is None:
+        return
+    key = get_list_version_key(user_id)
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.add(key, time.time_ns(), None)
+
+
+def invalidate_list_cache(user_id=None):
+    # without a user every user's lists are invalidated, once now and once more on commit like the plan cache
+    bump_list_version(user_id)
+    transaction.on_commit(lambda: bump_list_version(user_id))
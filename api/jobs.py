@@ -0,0 +1,71 @@
+import logging
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils.timezone import now
+
+from api.caching import invalidate_list_cache
+from api.models import Image, ThumbnailJob
+from api.rendering import get_render_engine
+
+
+logger = logging.getLogger(__name__)
+
+
+def claim_jobs(limit):
+    with transaction.atomic():
+        jobs = list(
+            ThumbnailJob.objects.select_for_update(skip_locked=True).filter(
+                status=ThumbnailJob.STATUS_QUEUED
+            ).order_by('time_created', 'pk')[:limit]
+        )
+        ThumbnailJob.objects.filter(pk__in=[job.pk for job in jobs]).update(
+            status=ThumbnailJob.STATUS_RUNNING, attempts=F('attempts') + 1, time_started=now()
+        )
+    for job in jobs:
+        job.refresh_from_db(fields=['status', 'attempts', 'time_started'])
+    return jobs
+
+
+def requeue_stale_jobs():
+    stale_before = now() - timedelta(seconds=settings.THUMBNAIL_JOBS['STALE_AFTER'])
+    stale_jobs = ThumbnailJob.objects.filter(status=ThumbnailJob.STATUS_RUNNING, time_started__lt=stale_before)
+    failed = stale_jobs.filter(attempts__gte=settings.THUMBNAIL_JOBS['MAX_ATTEMPTS'])
+    if Image.objects.filter(thumbnail_jobs__in=failed).update(processing_status=Image.PROCESSING_FAILED):
+        invalidate_list_cache()
+    failed.update(status=ThumbnailJob.STATUS_FAILED, last_error='stale', time_finished=now())
+    return stale_jobs.update(status=ThumbnailJob.STATUS_QUEUED)
+
+
+def process_jobs(batch_size):
+    # submit the whole batch first so the render engine can spread it over its workers,
+    # rows and files are still written from this thread only
+    engine = get_render_engine()
+    jobs = claim_jobs(batch_size)
+    submitted = []
+    for job in jobs:
+        try:
+            submitted.append((job, job.submit(engine)))
+        except Exception:
+            logger.exception('Thumbnail job %s failed', job.pk)
+    for job, save_thumbnails in submitted:
+        try:
+            job.complete(save_thumbnails)
+        except Exception:
+            logger.exception('Thumbnail job %s failed', job.pk)
+    return len(jobs)
+
+
+def run_worker(batch_size, poll_interval, once=False):
+    processed = 0
+    while True:
+        requeue_stale_jobs()
+        count = process_jobs(batch_size)
+        processed += count
+        if once and not count:
+            return processed
+        if not count:
+            time.sleep(poll_interval)
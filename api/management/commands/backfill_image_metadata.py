@@ -0,0 +1,24 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from api.backfill import backfill_image_metadata
+
+
+class Command(BaseCommand):
+    help = 'Read the dimensions, format, size, capture time and perceptual hash of images stored before they were kept'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=settings.THUMBNAIL_JOBS['BATCH_SIZE'])
+        parser.add_argument('--max-batches', type=int, help='Stop after this many batches of each model')
+
+    def report(self, model, done, failed):
+        self.stdout.write(f'{done} {model._meta.verbose_name_plural} read, {failed} failed')
+
+    def handle(self, *args, **options):
+        (images, images_failed), (thumbnails, thumbnails_failed) = backfill_image_metadata(
+            options['batch_size'], limit=options['max_batches'], report=self.report
+        )
+        self.stdout.write(
+            f'{images - images_failed} images and {thumbnails - thumbnails_failed} thumbnails backfilled, '
+            f'{images_failed + thumbnails_failed} failed'
+        )
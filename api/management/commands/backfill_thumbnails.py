@@ -0,0 +1,38 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from api.backfill import run_backfill
+from api.rendering import RenderEngine, get_render_engine
+
+
+class Command(BaseCommand):
+    help = 'Render the thumbnails missing for existing images after plan or size changes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=settings.THUMBNAIL_JOBS['BATCH_SIZE'])
+        parser.add_argument('--workers', type=int, help='Render with a dedicated engine of this many workers')
+        parser.add_argument('--plan', type=int, help='Only backfill images of users on this account plan')
+        parser.add_argument('--name', default='default', help='Checkpoint to resume from and to update')
+        parser.add_argument('--restart', action='store_true', help='Start over instead of resuming the checkpoint')
+        parser.add_argument('--max-batches', type=int, help='Stop after this many batches')
+
+    def report(self, backfill, done, total, rate):
+        self.stdout.write(
+            f'{done}/{total} thumbnails, up to image {backfill.last_image_id}, '
+            f'{backfill.failed} failed, {rate:.1f} thumbnails/s'
+        )
+
+    def handle(self, *args, **options):
+        if options['workers']:
+            engine = RenderEngine(settings.THUMBNAIL_RENDERING['BACKEND'], options['workers'])
+        else:
+            engine = get_render_engine()
+        try:
+            backfill = run_backfill(
+                engine, options['name'], options['batch_size'], account_plan_id=options['plan'],
+                restart=options['restart'], limit=options['max_batches'], report=self.report
+            )
+        finally:
+            if options['workers']:
+                engine.shutdown()
+        self.stdout.write(f'Backfill {backfill.name}: {backfill.rendered} rendered, {backfill.failed} failed')
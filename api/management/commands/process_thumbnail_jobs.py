@@ -0,0 +1,19 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from api.jobs import run_worker
+
+
+class Command(BaseCommand):
+    help = 'Render thumbnails for queued images'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=settings.THUMBNAIL_JOBS['BATCH_SIZE'])
+        parser.add_argument('--poll-interval', type=float, default=settings.THUMBNAIL_JOBS['POLL_INTERVAL'])
+        parser.add_argument(
+            '--once', action='store_true', help='Exit as soon as the queue is drained instead of polling'
+        )
+
+    def handle(self, *args, **options):
+        processed = run_worker(options['batch_size'], options['poll_interval'], once=options['once'])
+        self.stdout.write(f'Processed {processed} thumbnail jobs')
@@ -0,0 +1,22 @@
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+
+from api.relocation import run_relocation
+
+
+class Command(BaseCommand):
+    help = 'Move stored originals and thumbnails into the sharded directory layout and update their references'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=settings.THUMBNAIL_JOBS['BATCH_SIZE'])
+        parser.add_argument('--max-batches', type=int, help='Stop after this many batches')
+
+    def report(self, done, total, relocated, rate):
+        self.stdout.write(f'{done}/{total} files checked, {relocated} relocated, {rate:.1f} files/s')
+
+    def handle(self, *args, **options):
+        relocated = run_relocation(
+            default_storage, options['batch_size'], limit=options['max_batches'], report=self.report
+        )
+        self.stdout.write(f'{relocated} files relocated')
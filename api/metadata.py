@@ -0,0 +1,54 @@
+from datetime import datetime
+
+from django.conf import settings
+from django.utils.timezone import make_aware
+from PIL import Image as ImageObject
+
+
+EXIF_IFD = 0x8769
+EXIF_DATE_TIME = 306
+EXIF_DATE_TIME_ORIGINAL = 36867
+EXIF_DATE_FORMAT = '%Y:%m:%d %H:%M:%S'
+METADATA_FIELDS = ['width', 'height', 'image_format', 'file_size', 'taken_at']
+# originals are stored under the extension of the format read from their header, never the uploaded one,
+# so nothing that serves by extension can be made to send an image as html
+IMAGE_EXTENSIONS = {'JPEG': '.jpg', 'PNG': '.png', 'GIF': '.gif', 'WEBP': '.webp', 'BMP': '.bmp', 'TIFF': '.tif'}
+
+
+def get_taken_at(img):
+    # EXIF keeps the camera's local time without an offset, it is read in the default time zone
+    try:
+        exif = img.getexif()
+        value = exif.get_ifd(EXIF_IFD).get(EXIF_DATE_TIME_ORIGINAL) or exif.get(EXIF_DATE_TIME)
+        taken_at = datetime.strptime(value.strip('\x00 '), EXIF_DATE_FORMAT)
+    except Exception:
+        return None
+    return make_aware(taken_at) if settings.USE_TZ else taken_at
+
+
+def read_image_metadata(content, size=None):
+    # everything comes from the header, no pixel data is decoded
+    try:
+        with ImageObject.open(content) as img:
+            return {
+                'width': img.width,
+                'height': img.height,
+                'image_format': img.format,
+                'file_size': content.size if size is None else size,
+                'taken_at': get_taken_at(img),
+            }
+    finally:
+        content.seek(0)
+
+
+def get_image_metadata(content):
+    return getattr(content, 'image_metadata', None) or read_image_metadata(content)
+
+
+def get_image_extension(image_format):
+    return IMAGE_EXTENSIONS.get(image_format, '')
+
+
+def get_image_size(content):
+    with ImageObject.open(content) as img:
+        return img.size
@@ -0,0 +1,184 @@
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from contextvars import ContextVar
+
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+BYTES_BUCKETS = (2 ** 10, 2 ** 14, 2 ** 16, 2 ** 18, 2 ** 20, 2 ** 22, 2 ** 24, 2 ** 26)
+
+_registry = []
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._series = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def get_key(self, labels):
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def format_labels(self, key, **extra):
+        labels = dict(zip(self.labelnames, key), **extra)
+        if not labels:
+            return ''
+        escaped = (
+            '{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+            for name, value in labels.items()
+        )
+        return '{' + ','.join(escaped) + '}'
+
+    def collect_header(self):
+        return [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.get_key(labels)
+        with self._lock:
+            self._series[key] = self._series.get(key, 0) + amount
+
+    def collect(self):
+        lines = self.collect_header()
+        with self._lock:
+            series = sorted(self._series.items())
+        for key, value in series:
+            lines.append(f'{self.name}{self.format_labels(key)} {value}')
+        return lines
+
+
+class Gauge(Counter):
+    type = 'gauge'
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames, buckets=DURATION_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self.get_key(labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * len(self.buckets), 0, 0.0]
+            index = bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                series[0][index] += 1
+            series[1] += 1
+            series[2] += value
+
+    def collect(self):
+        lines = self.collect_header()
+        with self._lock:
+            series = sorted((key, list(counts), count, total) for key, (counts, count, total) in self._series.items())
+        for key, counts, count, total in series:
+            cumulative = 0
+            for bucket, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f'{self.name}_bucket{self.format_labels(key, le=repr(float(bucket)))} {cumulative}')
+            lines.append(f'{self.name}_bucket{self.format_labels(key, le="+Inf")} {count}')
+            lines.append(f'{self.name}_sum{self.format_labels(key)} {total}')
+            lines.append(f'{self.name}_count{self.format_labels(key)} {count}')
+        return lines
+
+
+def render_metrics():
+    return '\n'.join(line for metric in _registry for line in metric.collect()) + '\n'
+
+
+request_duration = Histogram(
+    'http_request_duration_seconds', 'Time spent handling requests.', ['view', 'method', 'status']
+)
+request_db_duration = Histogram('http_request_db_seconds', 'Time spent in database queries per request.', ['view'])
+request_db_queries = Histogram(
+    'http_request_db_queries', 'Database queries per request.', ['view'], buckets=COUNT_BUCKETS
+)
+render_stage_duration = Histogram(
+    'thumbnail_render_stage_seconds', 'Time spent decoding, resizing and encoding thumbnails.', ['stage']
+)
+storage_duration = Histogram('storage_io_seconds', 'Latency of storage operations.', ['operation'])
+storage_bytes = Histogram('storage_io_bytes', 'Bytes moved by storage operations.', ['operation'], BYTES_BUCKETS)
+# the per request totals of the two above, by the view that caused them
+request_render_duration = Histogram(
+    'http_request_render_seconds', 'Thumbnail render time per request, by stage.', ['view', 'stage']
+)
+request_storage_duration = Histogram(
+    'http_request_storage_seconds', 'Storage latency per request, by operation.', ['view', 'operation']
+)
+request_storage_bytes = Histogram(
+    'http_request_storage_bytes', 'Storage bytes per request, by operation.', ['view', 'operation'], BYTES_BUCKETS
+)
+render_admissions = Counter('render_admissions_total', 'Renders requested by requests, by outcome.', ['outcome'])
+render_admission_wait = Histogram('render_admission_wait_seconds', 'Time requests waited for a render slot.', [])
+renders_in_flight = Gauge('render_admission_in_flight', 'Renders of requests holding a slot.', [])
+throttled_requests = Counter('throttled_requests_total', 'Write requests refused by the plan rate.', ['plan'])
+
+
+class RequestMetrics:
+    def __init__(self):
+        self.db_time = 0.0
+        self.queries = 0
+        self.stages = defaultdict(float)
+        self.storage = defaultdict(lambda: [0, 0.0, 0])
+
+    def get_breakdown(self):
+        return {
+            'db_seconds': round(self.db_time, 6),
+            'queries': self.queries,
+            'render_seconds': {stage: round(seconds, 6) for stage, seconds in self.stages.items()},
+            'storage': {
+                operation: {'calls': calls, 'seconds': round(seconds, 6), 'bytes': size}
+                for operation, (calls, seconds, size) in self.storage.items()
+            },
+        }
+
+
+current_request_metrics = ContextVar('current_request_metrics', default=None)
+
+
+def record_query(execute, sql, params, many, context):
+    # installed on every connection, the context variable follows the request into sync_to_async threads
+    request_metrics = current_request_metrics.get()
+    if request_metrics is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        request_metrics.db_time += time.perf_counter() - started
+        request_metrics.queries += 1
+
+
+def record_render_stages(timings, request_metrics=None):
+    for stage, seconds in timings.items():
+        render_stage_duration.observe(seconds, stage=stage)
+        if request_metrics is not None:
+            request_metrics.stages[stage] += seconds
+
+
+def record_storage(operation, seconds, size=None):
+    storage_duration.observe(seconds, operation=operation)
+    if size is not None:
+        storage_bytes.observe(size, operation=operation)
+    request_metrics = current_request_metrics.get()
+    if request_metrics is not None:
+        totals = request_metrics.storage[operation]
+        totals[0] += 1
+        totals[1] += seconds
+        totals[2] += size or 0
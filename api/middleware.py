@@ -0,0 +1,64 @@
+import asyncio
+import logging
+import time
+
+from django.conf import settings
+
+from api.metrics import RequestMetrics, current_request_metrics, request_db_duration, request_db_queries, \
+    request_duration, request_render_duration, request_storage_bytes, request_storage_duration
+
+
+logger = logging.getLogger(__name__)
+
+
+class RequestMetricsMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(get_response):
+            # lets Django call it without a thread in front of async views
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        request_metrics = RequestMetrics()
+        token = current_request_metrics.set(request_metrics)
+        started = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            current_request_metrics.reset(token)
+        self.record(request, response, request_metrics, time.perf_counter() - started)
+        return response
+
+    async def __acall__(self, request):
+        request_metrics = RequestMetrics()
+        token = current_request_metrics.set(request_metrics)
+        started = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            current_request_metrics.reset(token)
+        self.record(request, response, request_metrics, time.perf_counter() - started)
+        return response
+
+    def record(self, request, response, request_metrics, duration):
+        view = request.resolver_match.view_name if request.resolver_match else 'unresolved'
+        request_duration.observe(duration, view=view, method=request.method, status=response.status_code)
+        request_db_duration.observe(request_metrics.db_time, view=view)
+        request_db_queries.observe(request_metrics.queries, view=view)
+        for stage, seconds in request_metrics.stages.items():
+            request_render_duration.observe(seconds, view=view, stage=stage)
+        for operation, (_, seconds, size) in request_metrics.storage.items():
+            request_storage_duration.observe(seconds, view=view, operation=operation)
+            request_storage_bytes.observe(size, view=view, operation=operation)
+
+        threshold = settings.REQUEST_METRICS['SLOW_REQUEST_THRESHOLD']
+        if threshold is not None and duration >= threshold:
+            logger.warning(
+                'Slow request %s %s (%s) took %.3fs: %s', request.method, request.path, view, duration,
+                request_metrics.get_breakdown()
+            )
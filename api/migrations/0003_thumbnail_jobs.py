@@ -0,0 +1,46 @@
+# Generated by Django 3.2 on 2026-10-18 15:37
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+def mark_existing_images_processed(apps, schema_editor):
+    Image = apps.get_model('api', 'Image')
+    Image.objects.update(processing_status='done')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0002_auto_20210419_1206'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='image',
+            name='processing_status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('processing', 'Processing'), ('done', 'Done'), ('failed', 'Failed')], default='pending', max_length=16),
+        ),
+        migrations.RunPython(
+            code=mark_existing_images_processed,
+            reverse_code=migrations.RunPython.noop,
+        ),
+        migrations.CreateModel(
+            name='ThumbnailJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(choices=[('queued', 'Queued'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], default='queued', max_length=16)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('last_error', models.TextField(blank=True)),
+                ('time_created', models.DateTimeField(default=django.utils.timezone.now)),
+                ('time_started', models.DateTimeField(blank=True, null=True)),
+                ('time_finished', models.DateTimeField(blank=True, null=True)),
+                ('image', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='thumbnail_jobs', to='api.image')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='thumbnailjob',
+            index=models.Index(fields=['status', 'time_created'], name='api_thumbna_status_ca2950_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2 on 2026-10-18 15:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0003_thumbnail_jobs'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='thumbnail',
+            name='cached',
+            field=models.BooleanField(default=False),
+        ),
+    ]
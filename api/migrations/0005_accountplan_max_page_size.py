@@ -0,0 +1,28 @@
+# Generated by Django 3.2 on 2026-10-18 15:44
+
+from django.db import migrations, models
+
+
+def set_default_max_page_sizes(apps, schema_editor):
+    AccountPlan = apps.get_model('api', 'AccountPlan')
+    AccountPlan.objects.filter(pk=1).update(max_page_size=50)
+    AccountPlan.objects.filter(pk=3).update(max_page_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0004_thumbnail_cached'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='accountplan',
+            name='max_page_size',
+            field=models.PositiveIntegerField(default=100),
+        ),
+        migrations.RunPython(
+            code=set_default_max_page_sizes,
+            reverse_code=migrations.RunPython.noop,
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 3.2 on 2026-10-18 15:46
+
+from django.db import migrations, models
+from django.db.models import DateTimeField, ExpressionWrapper, F
+
+
+def fill_expires_at(apps, schema_editor):
+    ExpirableLink = apps.get_model('api', 'ExpirableLink')
+    ExpirableLink.objects.filter(expires_at__isnull=True).update(expires_at=ExpressionWrapper(
+        F('time_created') + F('experation_period'), output_field=DateTimeField()
+    ))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0005_accountplan_max_page_size'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='expirablelink',
+            name='expires_at',
+            field=models.DateTimeField(editable=False, null=True),
+        ),
+        migrations.RunPython(
+            code=fill_expires_at,
+            reverse_code=migrations.RunPython.noop,
+        ),
+        migrations.AlterField(
+            model_name='expirablelink',
+            name='expires_at',
+            field=models.DateTimeField(db_index=True, editable=False),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 3.2 on 2026-10-18 15:49
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0006_expirablelink_expires_at'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StoredFile',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255, unique=True)),
+                ('sha256', models.CharField(blank=True, db_index=True, max_length=64)),
+                ('reference_count', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='sha256',
+            field=models.CharField(blank=True, db_index=True, editable=False, max_length=64),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 3.2 on 2026-10-18 15:53
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0007_content_addressed_storage'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ThumbnailBackfill',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=64, unique=True)),
+                ('last_image_id', models.PositiveIntegerField(default=0)),
+                ('rendered', models.PositiveIntegerField(default=0)),
+                ('failed', models.PositiveIntegerField(default=0)),
+                ('time_started', models.DateTimeField(default=django.utils.timezone.now)),
+                ('time_updated', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 3.2 on 2026-10-18 15:56
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0008_thumbnail_backfill'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='thumbnail',
+            name='encodings',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+        migrations.AddField(
+            model_name='thumbnailsize',
+            name='avif_quality',
+            field=models.PositiveSmallIntegerField(blank=True, null=True, validators=[django.core.validators.MinValueValidator(1), django.core.validators.MaxValueValidator(100)]),
+        ),
+        migrations.AddField(
+            model_name='thumbnailsize',
+            name='jpeg_quality',
+            field=models.PositiveSmallIntegerField(default=75, validators=[django.core.validators.MinValueValidator(1), django.core.validators.MaxValueValidator(95)]),
+        ),
+        migrations.AddField(
+            model_name='thumbnailsize',
+            name='optimize',
+            field=models.BooleanField(default=False, help_text='Progressive, optimized JPEG and slower WebP encoding'),
+        ),
+        migrations.AddField(
+            model_name='thumbnailsize',
+            name='webp_quality',
+            field=models.PositiveSmallIntegerField(blank=True, null=True, validators=[django.core.validators.MinValueValidator(1), django.core.validators.MaxValueValidator(100)]),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 3.2 on 2026-10-18 15:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0009_thumbnail_encodings'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='accountplan',
+            name='max_image_pixels',
+            field=models.PositiveIntegerField(default=40000000),
+        ),
+        migrations.AddField(
+            model_name='accountplan',
+            name='max_image_side',
+            field=models.PositiveIntegerField(default=10000),
+        ),
+        migrations.AddField(
+            model_name='accountplan',
+            name='max_upload_size',
+            field=models.PositiveIntegerField(default=20971520),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 3.2 on 2026-10-18 16:08
+
+from django.db import migrations
+import thumbnails.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0010_account_plan_upload_limits'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='image',
+            name='image_file',
+            field=thumbnails.fields.ImageField(db_index=True, upload_to=''),
+        ),
+        migrations.AlterField(
+            model_name='thumbnail',
+            name='thumbnail_image',
+            field=thumbnails.fields.ImageField(db_index=True, upload_to=''),
+        ),
+    ]
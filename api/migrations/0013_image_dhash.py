@@ -0,0 +1,18 @@
+# Generated by Django 3.2 on 2026-10-18 16:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0012_image_metadata'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='image',
+            name='dhash',
+            field=models.BigIntegerField(blank=True, editable=False, null=True),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 3.2 on 2026-10-18 16:25
+
+import django.core.validators
+from django.db import migrations, models
+
+
+def set_default_upload_rates(apps, schema_editor):
+    AccountPlan = apps.get_model('api', 'AccountPlan')
+    AccountPlan.objects.filter(pk=1).update(upload_rate='20/min')
+    AccountPlan.objects.filter(pk=3).update(upload_rate='300/min')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0013_image_dhash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='accountplan',
+            name='upload_rate',
+            field=models.CharField(blank=True, default='60/min', max_length=32, validators=[django.core.validators.RegexValidator('^\\d+/[smhd]')]),
+        ),
+        migrations.RunPython(
+            code=set_default_upload_rates,
+            reverse_code=migrations.RunPython.noop,
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2 on 2026-10-18 16:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0014_account_plan_upload_rate'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='thumbnailbackfill',
+            name='last_image_id',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+    ]
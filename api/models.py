@@ -1,14 +1,27 @@
+from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.db import models
+from django.db import IntegrityError, models, transaction
+from django.db.models import F
+from django.db.models.functions import Now
+from django.core.files.base import ContentFile
 from django.core.files.storage import get_storage_class
 from django.urls import reverse
 from django.utils.timezone import now
 from django.contrib.auth.models import Group
-from django.core.validators import MaxValueValidator, MinValueValidator
+from django.core.validators import MaxValueValidator, MinValueValidator, RegexValidator
 
 from thumbnails.fields import ImageField
-from PIL import Image as ImageObject
 
+from api.admission import render_admission
+from api.caching import invalidate_list_cache, plan_cache
+from api.metadata import METADATA_FIELDS, get_image_extension, get_image_metadata, get_image_size, read_image_metadata
+from api.rendering import EXTENSIONS, FORMAT_AVIF, FORMAT_JPEG, FORMAT_WEBP, FORMATS, Encoding, compute_dhash, \
+    get_render_engine, is_format_supported, to_signed
+from api.signing import sign_temporary_link
+from api.uploadhandlers import get_sha256
+from api.thumbnail_cache import get_thumbnail_cache
+
+from collections import Counter, defaultdict
 from io import BytesIO
 from datetime import timedelta
 
@@ -19,60 +32,466 @@ User = get_user_model()
 Storage = get_storage_class()
 
 
+def get_account_plan(user):
+    account_plan_id = plan_cache.get(('assignement', user.pk))
+    if account_plan_id is None:
+        if not hasattr(user, 'account_plan_assignement'):
+            AccountPlanAssignement.objects.create(user=user, account_plan_id=AccountPlan.BASIC_ID)
+        account_plan_id = user.account_plan_assignement.account_plan_id
+        if account_plan_id is None:
+            return None
+        plan_cache.set(('assignement', user.pk), account_plan_id)
+
+    account_plan = plan_cache.get(('account_plan', account_plan_id))
+    if account_plan is None:
+        account_plan = AccountPlan.objects.prefetch_related('thumbnail_sizes').get(pk=account_plan_id)
+        plan_cache.set(('account_plan', account_plan_id), account_plan)
+    return account_plan
+
+
 class Image(models.Model):
+    PROCESSING_PENDING = 'pending'
+    PROCESSING_IN_PROGRESS = 'processing'
+    PROCESSING_DONE = 'done'
+    PROCESSING_FAILED = 'failed'
+    PROCESSING_STATUSES = [
+        (PROCESSING_PENDING, 'Pending'),
+        (PROCESSING_IN_PROGRESS, 'Processing'),
+        (PROCESSING_DONE, 'Done'),
+        (PROCESSING_FAILED, 'Failed'),
+    ]
+
     uploader = models.ForeignKey(User, on_delete=models.CASCADE)
-    image_file = ImageField()
+    image_file = ImageField(db_index=True)
+    processing_status = models.CharField(max_length=16, choices=PROCESSING_STATUSES, default=PROCESSING_PENDING)
+    sha256 = models.CharField(max_length=64, blank=True, db_index=True, editable=False)
+    # read from the header when the file is stored, 0 until then
+    width = models.PositiveIntegerField(default=0, editable=False)
+    height = models.PositiveIntegerField(default=0, editable=False)
+    image_format = models.CharField(max_length=16, blank=True, editable=False)
+    file_size = models.PositiveBigIntegerField(default=0, editable=False)
+    taken_at = models.DateTimeField(null=True, blank=True, editable=False)
+    # 64 bit difference hash, computed with the thumbnails from the same decode
+    dhash = models.BigIntegerField(null=True, blank=True, editable=False)
+
+    class Meta:
+        indexes = [models.Index(fields=['uploader', field]) for field in METADATA_FIELDS]
 
     def save(self, *args, **kwargs):
+        if self.image_file and not self.image_file._committed:
+            self.store_image_file()
+        adding = self._state.adding
         status = super(Image, self).save(*args, **kwargs)
-        if not hasattr(self.uploader, 'account_plan_assignement'):
-            assignement = AccountPlanAssignement.objects.create(user=self.uploader, account_plan_id=1)
-            sizes = assignement.account_plan.thumbnail_sizes.filter(~models.Q(thumbnail__in=self.thumbnails.all()))
-        else:
-            sizes = self.uploader.account_plan_assignement.account_plan.thumbnail_sizes.filter(
-               ~models.Q(thumbnail__in=self.thumbnails.all())
+        if adding and settings.THUMBNAIL_MATERIALIZATION == Thumbnail.MATERIALIZATION_LAZY:
+            # the rows are cheap, their content is rendered on the first request
+            Thumbnail.create_cached([self], list(self.get_account_plan().thumbnail_sizes.all()))
+        if settings.THUMBNAIL_MATERIALIZATION == Thumbnail.MATERIALIZATION_EAGER and \
+                self.get_missing_thumbnail_sizes():
+            ThumbnailJob.enqueue(self)
+        elif self.processing_status != self.PROCESSING_DONE:
+            self.set_processing_status(self.PROCESSING_DONE)
+        return status
+
+    def store_image_file(self):
+        content = self.image_file.file
+        self.sha256 = get_sha256(content)
+        self.set_metadata(get_image_metadata(content))
+        name = StoredFile.store(self.image_file.storage, self.sha256, get_image_extension(self.image_format), content)
+        self.image_file = name
+
+    def set_metadata(self, metadata):
+        for field, value in metadata.items():
+            setattr(self, field, value)
+
+    def read_metadata(self):
+        with self.image_file.storage.open(self.image_file.name, 'rb') as content:
+            self.set_metadata(read_image_metadata(content))
+            self.dhash = to_signed(compute_dhash(content))
+
+    def set_dhash(self, dhash):
+        if dhash is not None:
+            Image.objects.filter(pk=self.pk).update(dhash=dhash)
+            self.dhash = dhash
+            invalidate_list_cache(self.uploader_id)
+
+    def set_processing_status(self, processing_status):
+        Image.objects.filter(pk=self.pk).update(processing_status=processing_status)
+        self.processing_status = processing_status
+        invalidate_list_cache(self.uploader_id)
+
+    def get_account_plan(self):
+        return get_account_plan(self.uploader)
+
+    def get_missing_thumbnail_sizes(self):
+        rendered = set(self.thumbnails.values_list('thumbnail_size_id', flat=True))
+        return [size for size in self.get_account_plan().thumbnail_sizes.all() if size.pk not in rendered]
+
+    def get_shared_thumbnails(self, sizes):
+        if not self.sha256:
+            return {}
+        return {
+            size_id: tuple(thumbnail) for size_id, *thumbnail in Thumbnail.objects.filter(
+                original_image__sha256=self.sha256, thumbnail_size__in=sizes, cached=False
+            ).exclude(original_image=self).values_list(
+                'thumbnail_size_id', 'thumbnail_image', 'encodings', 'width', 'height'
             )
+        }
+
+    def submit_thumbnails(self, engine, sizes=None):
+        if sizes is None:
+            sizes = self.get_missing_thumbnail_sizes()
+        shared = self.get_shared_thumbnails(sizes)
+        encodings = {(size.width, size.height): size.get_encodings() for size in sizes if size.pk not in shared}
+        if self.dhash is None and not encodings and self.sha256:
+            # nothing to render for a duplicate upload, the hash is the one of the same bytes
+            self.set_dhash(Image.objects.filter(
+                sha256=self.sha256, dhash__isnull=False
+            ).values_list('dhash', flat=True).first())
+        if encodings or self.dhash is None:
+            self.image_file.open('rb')
+            future = engine.submit_ingest(self.image_file.read(), encodings)
+            return lambda: self.save_ingested(sizes, future.result(), shared)
+        return lambda: self.save_thumbnails(sizes, {}, shared)
+
+    def save_ingested(self, sizes, ingested, shared=None):
+        rendered, dhash = ingested
+        self.set_dhash(to_signed(dhash))
+        self.save_thumbnails(sizes, rendered, shared)
+
+    def build_thumbnails(self, sizes, rendered, shared=None):
         storage = Storage()
+        thumbnails = []
         for size in sizes:
-            img = ImageObject.open(self.image_file.file.file)
-            img.thumbnail((size.width, size.height))
-            new_img_io = BytesIO()
-            img.save(new_img_io, format='JPEG')
-            splitted_ext = os.path.splitext(self.image_file.path)
-            if len(splitted_ext) > 1:
-                filename, ext = splitted_ext
+            if shared and size.pk in shared:
+                name, encodings, width, height = shared[size.pk]
             else:
-                filename, ext = splitted_ext[0], '.jpg'
-            filename = storage.generate_filename(filename + str(size) + ext)
-            storage.save(filename, new_img_io)
+                variants = rendered[(size.width, size.height)]
+                name, encodings = Thumbnail.store_variants(storage, variants)
+                width, height = get_image_size(BytesIO(variants[FORMAT_JPEG]))
+            # a stored name counts as committed, so the field doesn't copy the file again on save
+            thumbnails.append(Thumbnail(
+                thumbnail_size=size, original_image=self, thumbnail_image=name, encodings=encodings,
+                width=width, height=height
+            ))
+        return thumbnails
 
-            Thumbnail.objects.create(
-                thumbnail_size=size, original_image=self,
-                thumbnail_image=storage.open(filename)
-            )
+    def save_thumbnails(self, sizes, rendered, shared=None):
+        thumbnails = Thumbnail.objects.bulk_create(self.build_thumbnails(sizes, rendered, shared))
+        # rendered files were claimed when they were stored, reused ones gain a reference here
+        StoredFile.track([
+            name for thumbnail in thumbnails if thumbnail.thumbnail_size_id in (shared or {})
+            for name in thumbnail.get_stored_names()
+        ])
+        invalidate_list_cache(self.uploader_id)
+
+    def generate_thumbnails(self):
+        complete = self.submit_thumbnails(get_render_engine())
+        complete()
+
+    def get_thumbnail(self, size):
+        thumbnail = self.thumbnails.filter(thumbnail_size=size).first()
+        if not thumbnail:
+            Thumbnail.create_cached([self], [size])
+            thumbnail = self.thumbnails.get(thumbnail_size=size)
+        return thumbnail
+
+
+class ThumbnailJob(models.Model):
+    STATUS_QUEUED = 'queued'
+    STATUS_RUNNING = 'running'
+    STATUS_DONE = 'done'
+    STATUS_FAILED = 'failed'
+    STATUSES = [
+        (STATUS_QUEUED, 'Queued'),
+        (STATUS_RUNNING, 'Running'),
+        (STATUS_DONE, 'Done'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+    ACTIVE_STATUSES = [STATUS_QUEUED, STATUS_RUNNING]
+
+    image = models.ForeignKey(Image, on_delete=models.CASCADE, related_name='thumbnail_jobs')
+    status = models.CharField(max_length=16, choices=STATUSES, default=STATUS_QUEUED)
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    time_created = models.DateTimeField(default=now)
+    time_started = models.DateTimeField(null=True, blank=True)
+    time_finished = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['status', 'time_created'])]
+
+    @classmethod
+    def enqueue(cls, image):
+        image.set_processing_status(Image.PROCESSING_PENDING)
+        job = cls.objects.filter(image=image, status__in=cls.ACTIVE_STATUSES).first()
+        if not job:
+            job = cls.objects.create(image=image)
+        if settings.THUMBNAIL_JOBS['EAGER'] and job.status == cls.STATUS_QUEUED:
+            job.start()
+            job.run()
+        return job
+
+    def start(self):
+        self.status = self.STATUS_RUNNING
+        self.attempts += 1
+        self.time_started = now()
+        self.save(update_fields=['status', 'attempts', 'time_started'])
+
+    def run(self):
+        self.complete(self.submit(get_render_engine()))
+
+    def submit(self, engine):
+        self.image.set_processing_status(Image.PROCESSING_IN_PROGRESS)
+        try:
+            return self.image.submit_thumbnails(engine)
+        except Exception as e:
+            self.fail(e)
+            raise
+
+    def complete(self, save_thumbnails):
+        try:
+            save_thumbnails()
+        except Exception as e:
+            self.fail(e)
+            raise
+        self.finish(self.STATUS_DONE, Image.PROCESSING_DONE)
+
+    def fail(self, error):
+        if self.attempts < settings.THUMBNAIL_JOBS['MAX_ATTEMPTS']:
+            self.finish(self.STATUS_QUEUED, Image.PROCESSING_PENDING, repr(error))
+        else:
+            self.finish(self.STATUS_FAILED, Image.PROCESSING_FAILED, repr(error))
+
+    def finish(self, status, processing_status, error=''):
+        self.status = status
+        self.last_error = error
+        self.time_finished = now() if status in (self.STATUS_DONE, self.STATUS_FAILED) else None
+        self.save(update_fields=['status', 'last_error', 'time_finished'])
+        self.image.set_processing_status(processing_status)
+
+    def __str__(self):
+        return f'Thumbnail job for {self.image} ({self.status})'
+
+
+class ThumbnailBackfill(models.Model):
+    name = models.CharField(max_length=64, unique=True)
+    last_image_id = models.PositiveBigIntegerField(default=0)
+    rendered = models.PositiveIntegerField(default=0)
+    failed = models.PositiveIntegerField(default=0)
+    time_started = models.DateTimeField(default=now)
+    time_updated = models.DateTimeField(auto_now=True)
+
+    def checkpoint(self, last_image_id, rendered, failed):
+        self.last_image_id = last_image_id
+        self.rendered += rendered
+        self.failed += failed
+        self.save(update_fields=['last_image_id', 'rendered', 'failed', 'time_updated'])
+
+    def __str__(self):
+        return f'Thumbnail backfill {self.name} at image {self.last_image_id}'
 
-        return status
+
+class StoredFile(models.Model):
+    name = models.CharField(max_length=255, unique=True)
+    sha256 = models.CharField(max_length=64, blank=True, db_index=True)
+    reference_count = models.PositiveIntegerField(default=0)
+
+    @classmethod
+    def store(cls, storage, sha256, ext, content):
+        # the reference is taken before the file is looked at, so a concurrent release of the last one can't
+        # delete the file this upload decided to reuse
+        name = storage.generate_filename(sha256 + ext.lower())
+        cls.claim(name, sha256)
+        if storage.exists(name):
+            return name
+        return storage.save(name, content)
+
+    @classmethod
+    def claim(cls, name, sha256=''):
+        while not cls.objects.filter(name=name).update(reference_count=F('reference_count') + 1):
+            try:
+                with transaction.atomic():
+                    cls.objects.create(name=name, sha256=sha256, reference_count=1)
+                return
+            except IntegrityError:
+                # created by a concurrent upload of the same content, the update takes the reference
+                continue
+
+    @classmethod
+    def track(cls, names, sha256s=None):
+        sha256s = sha256s or {}
+        references = Counter(name for name in names if name)
+        cls.objects.bulk_create([
+            cls(name=name, sha256=sha256s.get(name, '')) for name in references
+        ], ignore_conflicts=True)
+        by_count = defaultdict(list)
+        for name, count in references.items():
+            by_count[count].append(name)
+        for count, names in by_count.items():
+            cls.objects.filter(name__in=names).update(reference_count=F('reference_count') + count)
+
+    @classmethod
+    def release(cls, storage, name):
+        with transaction.atomic():
+            stored_file = cls.objects.select_for_update().filter(name=name).first()
+            if not stored_file:
+                return
+            if stored_file.reference_count > 1:
+                cls.objects.filter(pk=stored_file.pk).update(reference_count=F('reference_count') - 1)
+                return
+            cls.objects.filter(pk=stored_file.pk).update(reference_count=0)
+            transaction.on_commit(lambda: cls.delete_unreferenced(storage, name))
+
+    @classmethod
+    def delete_unreferenced(cls, storage, name):
+        # an upload may have claimed the file again since the release committed
+        with transaction.atomic():
+            stored_file = cls.objects.select_for_update().filter(name=name, reference_count=0).first()
+            if stored_file:
+                storage.delete(name)
+                stored_file.delete()
+
+    def __str__(self):
+        return f'{self.name} ({self.reference_count} references)'
 
 
 class ThumbnailSize(models.Model):
     width = models.PositiveIntegerField()
     height = models.PositiveIntegerField()
+    jpeg_quality = models.PositiveSmallIntegerField(
+        default=75, validators=[MinValueValidator(1), MaxValueValidator(95)]
+    )
+    optimize = models.BooleanField(default=False, help_text='Progressive, optimized JPEG and slower WebP encoding')
+    webp_quality = models.PositiveSmallIntegerField(
+        null=True, blank=True, validators=[MinValueValidator(1), MaxValueValidator(100)]
+    )
+    avif_quality = models.PositiveSmallIntegerField(
+        null=True, blank=True, validators=[MinValueValidator(1), MaxValueValidator(100)]
+    )
 
     class Meta:
         unique_together = ('width', 'height')
 
+    def get_encodings(self):
+        encodings = [Encoding(FORMAT_JPEG, self.jpeg_quality, self.optimize)]
+        for image_format, quality in ((FORMAT_WEBP, self.webp_quality), (FORMAT_AVIF, self.avif_quality)):
+            if quality is not None and is_format_supported(image_format):
+                encodings.append(Encoding(image_format, quality, self.optimize))
+        return encodings
+
     def __str__(self):
         return f'size {self.width}x{self.height}'
 
 
 class Thumbnail(models.Model):
+    MATERIALIZATION_EAGER = 'eager'
+    MATERIALIZATION_LAZY = 'lazy'
+
     thumbnail_size = models.ForeignKey(ThumbnailSize, on_delete=models.CASCADE)
     original_image = models.ForeignKey(Image, on_delete=models.CASCADE, related_name='thumbnails')
-    thumbnail_image = ImageField()
+    thumbnail_image = ImageField(db_index=True)
+    cached = models.BooleanField(default=False)
+    # of the rendered JPEG, 0 for cached thumbnails
+    width = models.PositiveIntegerField(default=0, editable=False)
+    height = models.PositiveIntegerField(default=0, editable=False)
+    # format -> {'size': bytes, 'name': stored file}, the JPEG entry has no name as it is `thumbnail_image`
+    encodings = models.JSONField(default=dict, blank=True)
 
     class Meta:
         unique_together = ('thumbnail_size', 'original_image')
 
+    @staticmethod
+    def store_variants(storage, variants):
+        # every encoding is written once under its content hash, the JPEG one becomes `thumbnail_image`
+        name, encodings = None, {}
+        for image_format, content in variants.items():
+            content = ContentFile(content)
+            stored_name = StoredFile.store(storage, get_sha256(content), EXTENSIONS[image_format], content)
+            encodings[image_format] = {'size': content.size}
+            if image_format == FORMAT_JPEG:
+                name = stored_name
+            else:
+                encodings[image_format]['name'] = stored_name
+        return name, encodings
+
+    def read_metadata(self):
+        with self.thumbnail_image.storage.open(self.thumbnail_image.name, 'rb') as content:
+            self.width, self.height = get_image_size(content)
+
+    def get_stored_names(self):
+        if self.cached:
+            return []
+        return [self.thumbnail_image.name] + [
+            encoding['name'] for encoding in self.encodings.values() if 'name' in encoding
+        ]
+
+    def get_formats(self):
+        if self.cached:
+            return [encoding.format for encoding in self.thumbnail_size.get_encodings()]
+        return [image_format for image_format in FORMATS if image_format in self.encodings] or [FORMAT_JPEG]
+
+    def get_encoded_size(self, image_format):
+        return self.encodings.get(image_format, {}).get('size')
+
+    @classmethod
+    def create_cached(cls, images, sizes):
+        existing = set(
+            cls.objects.filter(original_image__in=images).values_list('original_image_id', 'thumbnail_size_id')
+        )
+        created = cls.objects.bulk_create([
+            cls(
+                original_image=image, thumbnail_size=size, cached=True,
+                thumbnail_image=cls.get_cached_name(image, size)
+            )
+            for image in images for size in sizes if (image.pk, size.pk) not in existing
+        ], ignore_conflicts=True)
+        for uploader_id in {thumbnail.original_image.uploader_id for thumbnail in created}:
+            invalidate_list_cache(uploader_id)
+
+    @staticmethod
+    def get_cached_name(image, size):
+        filename, ext = os.path.splitext(os.path.basename(image.image_file.name))
+        return f'{filename}_{size.width}x{size.height}{ext or ".jpg"}'
+
+    def open_content(self, image_format=FORMAT_JPEG):
+        if not self.cached and image_format == FORMAT_JPEG:
+            return self.thumbnail_image.open('rb')
+        if not self.cached:
+            return self.thumbnail_image.storage.open(self.encodings[image_format]['name'], 'rb')
+
+        name = self.thumbnail_image.name
+        if image_format != FORMAT_JPEG:
+            name += EXTENSIONS[image_format]
+        cache = get_thumbnail_cache()
+        path = cache.get(name)
+        if path:
+            try:
+                return open(path, 'rb')
+            except FileNotFoundError:
+                pass
+
+        box = (self.thumbnail_size.width, self.thumbnail_size.height)
+        encoding = next(encoding for encoding in self.thumbnail_size.get_encodings() if encoding.format == image_format)
+        with render_admission.admit():
+            self.original_image.image_file.open('rb')
+            rendered, dhash = get_render_engine().submit_ingest(
+                self.original_image.image_file.read(), {box: [encoding]}
+            ).result()
+        rendered = rendered[box][image_format]
+        if self.original_image.dhash is None:
+            self.original_image.set_dhash(to_signed(dhash))
+        cache.set(name, rendered)
+        return BytesIO(rendered)
+
+    def get_content_url(self, request=None):
+        obj = reverse('thumbnail-content', kwargs={
+            'image': self.original_image_id, 'thumbnail_size': self.thumbnail_size_id
+        })
+        if request:
+            return request.build_absolute_uri(obj)
+        else:
+            return obj
+
 
 class AccountPlan(models.Model):
     BASIC_ID = 1
@@ -81,6 +500,14 @@ class AccountPlan(models.Model):
     thumbnail_sizes = models.ManyToManyField(ThumbnailSize, related_name='account_plans')
     have_access_to_original_link = models.BooleanField(default=False)
     can_create_expirable_links = models.BooleanField(default=False)
+    max_page_size = models.PositiveIntegerField(default=100)
+    max_upload_size = models.PositiveIntegerField(default=20 * 2 ** 20)
+    max_image_side = models.PositiveIntegerField(default=10000)
+    max_image_pixels = models.PositiveIntegerField(default=40 * 10 ** 6)
+    # write requests per period (s, m, h or d) on the images endpoints, empty for no limit
+    upload_rate = models.CharField(
+        max_length=32, blank=True, default='60/min', validators=[RegexValidator(r'^\d+/[smhd]')]
+    )
     name = models.CharField(max_length=256)
 
     def __str__(self):
@@ -98,19 +525,39 @@ class AccountPlanAssignement(models.Model):
 
 
 class ExpirableLink(models.Model):
+    FORMAT_ID = 'id'
+    FORMAT_SIGNED = 'signed'
+
     image = models.ForeignKey(Image, on_delete=models.CASCADE)
     time_created = models.DateTimeField(default=now)
     experation_period = models.DurationField(validators=[
         MinValueValidator(timedelta(seconds=300)),
         MaxValueValidator(timedelta(seconds=30000))
     ])
+    expires_at = models.DateTimeField(db_index=True, editable=False)
+
+    def save(self, *args, **kwargs):
+        self.expires_at = self.time_created + self.experation_period
+        return super(ExpirableLink, self).save(*args, **kwargs)
+
+    @classmethod
+    def filter_not_expired(cls):
+        return cls.objects.filter(expires_at__gt=Now())
 
     @classmethod
     def filter_by_temporary_link(cls, temporary_link):
         return cls.objects.filter(pk=int(temporary_link))
 
-    def generate_temporary_link(self, request=None):
-        obj = reverse('temporary-link', kwargs={'expirable_link': self.id})
+    @classmethod
+    def get_active(cls, temporary_link):
+        return cls.filter_by_temporary_link(temporary_link).filter(expires_at__gt=Now()).select_related('image').first()
+
+    def generate_temporary_link(self, request=None, link_format=None):
+        link_format = link_format or settings.TEMPORARY_LINKS['FORMAT']
+        if link_format == self.FORMAT_SIGNED:
+            obj = reverse('signed-temporary-link', kwargs={'token': sign_temporary_link(self)})
+        else:
+            obj = reverse('temporary-link', kwargs={'expirable_link': self.id})
         if request:
             return request.build_absolute_uri(obj)
         else:
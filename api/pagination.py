@@ -0,0 +1,115 @@
+import json
+from datetime import datetime
+
+from django.db.models import F, Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import Cursor, CursorPagination
+
+from api.models import get_account_plan
+
+
+class PrimaryKeyCursorPagination(CursorPagination):
+    # rows get their primary key on insert, so primary key order is upload order
+    ORDERINGS = {
+        'uploaded': 'pk',
+        '-uploaded': '-pk',
+    }
+
+    ordering = '-pk'
+    ordering_query_param = 'ordering'
+    page_size_query_param = 'page_size'
+
+    def get_ordering(self, request, queryset, view):
+        orderings = getattr(view, 'cursor_orderings', {})
+        ordering = request.query_params.get(self.ordering_query_param)
+        if ordering in orderings:
+            return orderings[ordering]
+        return (self.ORDERINGS.get(ordering, self.ordering),)
+
+    def get_page_size(self, request):
+        page_size = super(PrimaryKeyCursorPagination, self).get_page_size(request)
+        if request.user.is_authenticated:
+            page_size = min(page_size, get_account_plan(request.user).max_page_size)
+        return page_size
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if len(self.get_ordering(request, queryset, view)) == 1:
+            return super(PrimaryKeyCursorPagination, self).paginate_queryset(queryset, request, view)
+        return self.paginate_keyset(queryset, request, view)
+
+    def paginate_keyset(self, queryset, request, view=None):
+        # the cursor of DRF only keeps the first column and skips ties by offset, which stops at offset_cutoff,
+        # here the position is the (value, pk) pair, so any number of equal values pages through
+        self.page_size = self.get_page_size(request)
+        if not self.page_size:
+            return None
+        self.base_url = request.build_absolute_uri()
+        self.ordering = self.get_ordering(request, queryset, view)
+        self.cursor = self.decode_cursor(request)
+        reverse = bool(self.cursor and self.cursor.reverse)
+        field = self.ordering[0].lstrip('-')
+        descending = self.ordering[0].startswith('-') != reverse
+
+        # rows without a value come last either way, so they come first when walking back
+        column = F(field).desc(nulls_last=not reverse) if descending else F(field).asc(nulls_last=not reverse)
+        queryset = queryset.order_by(column, '-pk' if descending else 'pk')
+        if self.cursor and self.cursor.position:
+            value, pk = self.decode_position(self.cursor.position)
+            queryset = queryset.filter(self.get_keyset_filter(field, value, pk, descending, not reverse))
+
+        results = list(queryset[:self.page_size + 1])
+        self.page = results[:self.page_size]
+        has_following = len(results) > len(self.page)
+        if reverse:
+            self.page.reverse()
+            self.has_next, self.has_previous = self.cursor is not None, has_following
+        else:
+            self.has_next, self.has_previous = has_following, self.cursor is not None
+        if self.page:
+            self.next_position = self.encode_position(self.page[-1], field)
+            self.previous_position = self.encode_position(self.page[0], field)
+        else:
+            self.has_next = self.has_previous = False
+        if (self.has_previous or self.has_next) and self.template is not None:
+            self.display_page_controls = True
+        return self.page
+
+    @staticmethod
+    def get_keyset_filter(field, value, pk, descending, nulls_after):
+        lookup = 'lt' if descending else 'gt'
+        following_pk = Q(**{f'pk__{lookup}': pk})
+        if value is None:
+            condition = Q(**{f'{field}__isnull': True}) & following_pk
+            if not nulls_after:
+                condition |= Q(**{f'{field}__isnull': False})
+        else:
+            condition = Q(**{f'{field}__{lookup}': value}) | (Q(**{field: value}) & following_pk)
+            if nulls_after:
+                condition |= Q(**{f'{field}__isnull': True})
+        return condition
+
+    @staticmethod
+    def encode_position(instance, field):
+        value = getattr(instance, field)
+        return json.dumps([value.isoformat() if isinstance(value, datetime) else value, instance.pk])
+
+    def decode_position(self, position):
+        try:
+            value, pk = json.loads(position)
+            return value, int(pk)
+        except (TypeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+
+    def get_next_link(self):
+        if len(self.ordering) == 1:
+            return super(PrimaryKeyCursorPagination, self).get_next_link()
+        if not self.has_next:
+            return None
+        return self.encode_cursor(Cursor(offset=0, reverse=False, position=self.next_position))
+
+    def get_previous_link(self):
+        if len(self.ordering) == 1:
+            return super(PrimaryKeyCursorPagination, self).get_previous_link()
+        if not self.has_previous:
+            return None
+        return self.encode_cursor(Cursor(offset=0, reverse=True, position=self.previous_position))
@@ -1,5 +1,7 @@
 from rest_framework.permissions import IsAuthenticated, SAFE_METHODS
 
+from api.models import get_account_plan
+
 
 class IsCreationOfExpirableLinkAllowedOrReadOnly(IsAuthenticated):
     def has_permission(self, request, view):
@@ -8,4 +10,4 @@ class IsCreationOfExpirableLinkAllowedOrReadOnly(IsAuthenticated):
         result = super(IsCreationOfExpirableLinkAllowedOrReadOnly, self).has_permission(request, view)
         if not result:
             return result
-        return request.user.account_plan_assignement.account_plan.can_create_expirable_links
+        return get_account_plan(request.user).can_create_expirable_links
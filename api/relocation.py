@@ -0,0 +1,105 @@
+import logging
+import time
+
+from django.db import transaction
+from django.db.models import Count, Exists, OuterRef
+
+from api.caching import invalidate_list_cache
+from api.models import Image, StoredFile, Thumbnail
+from api.rendering import FORMAT_JPEG, FORMATS
+
+
+logger = logging.getLogger(__name__)
+
+
+def track_legacy_files(batch_size):
+    # files stored before content addressing have no StoredFile row, they are tracked with one reference per row
+    untracked = []
+    for queryset, field in (
+        (Image.objects.all(), 'image_file'),
+        (Thumbnail.objects.filter(cached=False), 'thumbnail_image'),
+    ):
+        untracked += queryset.exclude(**{field: ''}).filter(
+            ~Exists(StoredFile.objects.filter(name=OuterRef(field)))
+        ).values(field).annotate(references=Count('pk')).values_list(field, 'references')
+    for start in range(0, len(untracked), batch_size):
+        StoredFile.track([name for name, count in untracked[start:start + batch_size] for _ in range(count)])
+    return len(untracked)
+
+
+def get_moves(storage, stored_files):
+    moves = {}
+    for stored_file in stored_files:
+        target = storage.generate_filename(stored_file.name)
+        if target != stored_file.name:
+            moves[stored_file.name] = target
+    return moves
+
+
+def copy_files(storage, moves):
+    copied = {}
+    for name, target in moves.items():
+        try:
+            # a target left behind by an interrupted run holds the same content, it is reused
+            if not storage.exists(target):
+                with storage.open(name, 'rb') as content:
+                    saved = storage.save(target, content)
+                if saved != target:
+                    storage.delete(saved)
+                    raise ValueError(f'{target} was stored as {saved}')
+            copied[name] = target
+        except Exception:
+            logger.exception('Relocating %s to %s failed', name, target)
+    return copied
+
+
+def update_references(moves):
+    for name, target in moves.items():
+        StoredFile.objects.filter(name=name).update(name=target)
+        Image.objects.filter(image_file=name).update(image_file=target)
+        Thumbnail.objects.filter(thumbnail_image=name, cached=False).update(thumbnail_image=target)
+
+    variant_formats = [image_format for image_format in FORMATS if image_format != FORMAT_JPEG]
+    thumbnails = []
+    for image_format in variant_formats:
+        for thumbnail in Thumbnail.objects.filter(**{f'encodings__{image_format}__name__in': list(moves)}):
+            for encoding in thumbnail.encodings.values():
+                if encoding.get('name') in moves:
+                    encoding['name'] = moves[encoding['name']]
+            thumbnails.append(thumbnail)
+    Thumbnail.objects.bulk_update(thumbnails, ['encodings'])
+
+
+def relocate_batch(storage, stored_files):
+    moves = copy_files(storage, get_moves(storage, stored_files))
+    with transaction.atomic():
+        update_references(moves)
+        # the old names are only removed once no committed row can point at them anymore
+        for name in moves:
+            transaction.on_commit(lambda name=name: storage.delete(name))
+        if moves:
+            # the urls of any number of users changed
+            invalidate_list_cache()
+    return len(moves)
+
+
+def run_relocation(storage, batch_size, limit=None, report=None):
+    track_legacy_files(batch_size)
+    total = StoredFile.objects.count()
+    started = time.monotonic()
+    after = done = relocated = batches = 0
+    while limit is None or batches < limit:
+        # files released to zero references are about to be deleted, they are left where they are
+        stored_files = list(
+            StoredFile.objects.filter(pk__gt=after, reference_count__gt=0).order_by('pk')[:batch_size]
+        )
+        if not stored_files:
+            break
+        relocated += relocate_batch(storage, stored_files)
+        after = stored_files[-1].pk
+        done += len(stored_files)
+        batches += 1
+        if report:
+            elapsed = time.monotonic() - started
+            report(done, total, relocated, done / elapsed if elapsed else 0)
+    return relocated
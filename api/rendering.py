@@ -0,0 +1,267 @@
+import os
+import threading
+import time
+from collections import defaultdict, namedtuple
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from io import BytesIO
+
+from django.conf import settings
+from PIL import Image as ImageObject
+
+from api.metrics import current_request_metrics, record_render_stages
+
+
+REDUCING_GAP = 2
+DHASH_SIZE = 8
+# the hash is taken from at least this resolution, so it does not depend on the thumbnail sizes of the plan
+DHASH_DECODE_BOX = (128, 128)
+
+FORMAT_JPEG = 'JPEG'
+FORMAT_WEBP = 'WEBP'
+FORMAT_AVIF = 'AVIF'
+CONTENT_TYPES = {FORMAT_JPEG: 'image/jpeg', FORMAT_WEBP: 'image/webp', FORMAT_AVIF: 'image/avif'}
+EXTENSIONS = {FORMAT_JPEG: '.jpg', FORMAT_WEBP: '.webp', FORMAT_AVIF: '.avif'}
+FORMATS = [FORMAT_JPEG, FORMAT_WEBP, FORMAT_AVIF]
+
+
+class Encoding(namedtuple('Encoding', ['format', 'quality', 'optimize'], defaults=[None, False])):
+    __slots__ = ()
+
+    def get_save_options(self):
+        options = {}
+        if self.quality is not None:
+            options['quality'] = self.quality
+        if self.optimize and self.format == FORMAT_JPEG:
+            options.update(optimize=True, progressive=True)
+        elif self.optimize and self.format == FORMAT_WEBP:
+            options['method'] = 6
+        return options
+
+
+def is_format_supported(image_format):
+    # WebP and AVIF encoders are only registered when Pillow was built with (or extended by) them
+    ImageObject.init()
+    return image_format in ImageObject.SAVE
+
+
+def get_scale(image_size, box):
+    return min(box[0] / image_size[0], box[1] / image_size[1], 1)
+
+
+def render_thumbnails(source, boxes, image_format='JPEG', timings=None):
+    variants = render_variants(source, {box: [Encoding(image_format)] for box in boxes}, timings)
+    return {box: encoded[image_format] for box, encoded in variants.items()}
+
+
+def decode(source, boxes, timings):
+    # decode once, at the smallest draft scale the largest box allows
+    started = time.perf_counter()
+    img = ImageObject.open(source)
+    scale = max(get_scale(img.size, box) for box in boxes)
+    img.draft(None, (int(img.width * scale * REDUCING_GAP), int(img.height * scale * REDUCING_GAP)))
+    img.load()
+    if img.mode not in ('RGB', 'L'):
+        img = img.convert('RGB')
+    timings['decode'] += time.perf_counter() - started
+    return img
+
+
+def resize_variants(img, encodings, timings):
+    # every smaller box cascades down from the previous result instead of from the decoded image
+    boxes = sorted(encodings, key=lambda box: get_scale(img.size, box), reverse=True)
+    variants = {}
+    for box in boxes:
+        started = time.perf_counter()
+        img = img.copy()
+        img.thumbnail(box)
+        timings['resize'] += time.perf_counter() - started
+        variants[box] = {}
+        for encoding in encodings[box]:
+            started = time.perf_counter()
+            thumbnail_io = BytesIO()
+            img.save(thumbnail_io, format=encoding.format, **encoding.get_save_options())
+            thumbnail_io.seek(0)
+            variants[box][encoding.format] = thumbnail_io
+            timings['encode'] += time.perf_counter() - started
+    return variants
+
+
+def render_variants(source, encodings, timings=None):
+    if not encodings:
+        return {}
+    timings = timings if timings is not None else defaultdict(float)
+    return resize_variants(decode(source, list(encodings), timings), encodings, timings)
+
+
+def get_dhash(img):
+    # difference hash, one bit per horizontally adjacent pair of a 9x8 grayscale downscale
+    small = img.convert('L').resize((DHASH_SIZE + 1, DHASH_SIZE), ImageObject.BOX)
+    pixels = list(small.getdata())
+    dhash = 0
+    for row in range(DHASH_SIZE):
+        for column in range(DHASH_SIZE):
+            offset = row * (DHASH_SIZE + 1) + column
+            dhash = dhash << 1 | (pixels[offset] > pixels[offset + 1])
+    return dhash
+
+
+def to_signed(dhash):
+    # the 64 bits are stored in a signed bigint
+    return dhash - 2 ** 64 if dhash >= 2 ** 63 else dhash
+
+
+def to_unsigned(dhash):
+    return dhash & (2 ** 64 - 1)
+
+
+def compute_dhash(source):
+    return get_dhash(decode(source, [DHASH_DECODE_BOX], defaultdict(float)))
+
+
+def render_ingest_from_bytes(source, encodings, timings=None):
+    # the thumbnails of a new image and its perceptual hash share a single decode
+    timings = timings if timings is not None else defaultdict(float)
+    img = decode(BytesIO(source), list(encodings) + [DHASH_DECODE_BOX], timings)
+    started = time.perf_counter()
+    dhash = get_dhash(img)
+    timings['hash'] += time.perf_counter() - started
+    rendered = resize_variants(img, encodings, timings)
+    variants = {
+        box: {image_format: thumbnail_io.getvalue() for image_format, thumbnail_io in encoded.items()}
+        for box, encoded in rendered.items()
+    }
+    return variants, dhash
+
+
+def render_thumbnails_from_bytes(source, boxes, image_format='JPEG', timings=None):
+    rendered = render_thumbnails(BytesIO(source), boxes, image_format, timings)
+    return {box: thumbnail_io.getvalue() for box, thumbnail_io in rendered.items()}
+
+
+def pack_sprite(dimensions, max_width):
+    # shelf packing, left to right in rows no wider than `max_width`, each row as tall as its tallest thumbnail
+    positions = []
+    x = y = row_height = width = 0
+    for w, h in dimensions:
+        if x and x + w > max_width:
+            y += row_height
+            x = row_height = 0
+        positions.append((x, y))
+        x += w
+        width = max(width, x)
+        row_height = max(row_height, h)
+    return positions, (width, y + row_height)
+
+
+def render_sprite(sources, max_width, encoding, timings=None):
+    timings = timings if timings is not None else defaultdict(float)
+    started = time.perf_counter()
+    images = [ImageObject.open(BytesIO(source)) for source in sources]
+    positions, size = pack_sprite([img.size for img in images], max_width)
+    sprite = ImageObject.new('RGB', size, 'white')
+    for img, position in zip(images, positions):
+        img.load()
+        sprite.paste(img if img.mode in ('RGB', 'L') else img.convert('RGB'), position)
+    timings['decode'] += time.perf_counter() - started
+
+    started = time.perf_counter()
+    sprite_io = BytesIO()
+    sprite.save(sprite_io, format=encoding.format, **encoding.get_save_options())
+    timings['encode'] += time.perf_counter() - started
+    boxes = [(x, y, img.width, img.height) for img, (x, y) in zip(images, positions)]
+    return sprite_io.getvalue(), size, boxes
+
+
+def render_timed(render, *args):
+    # stage timings travel back with the result, so they are recorded by the submitting process
+    timings = defaultdict(float)
+    return render(*args, timings=timings), dict(timings)
+
+
+class RenderEngine:
+    BACKEND_INLINE = 'inline'
+    BACKEND_THREAD = 'thread'
+    BACKEND_PROCESS = 'process'
+
+    def __init__(self, backend=BACKEND_INLINE, workers=None, max_pending=None):
+        self.backend = backend
+        self.workers = workers or os.cpu_count() or 1
+        self.max_pending = max_pending or self.workers * 2
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        self._executor = None
+        self._lock = threading.Lock()
+
+    @property
+    def executor(self):
+        with self._lock:
+            if self._executor is None:
+                if self.backend == self.BACKEND_PROCESS:
+                    self._executor = ProcessPoolExecutor(max_workers=self.workers)
+                elif self.backend == self.BACKEND_THREAD:
+                    self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='thumbnails')
+                else:
+                    raise ValueError(f'Unknown thumbnail rendering backend {self.backend!r}')
+            return self._executor
+
+    def submit(self, source, boxes, image_format='JPEG'):
+        return self._submit(render_thumbnails_from_bytes, source, boxes, image_format)
+
+    def submit_ingest(self, source, encodings):
+        return self._submit(render_ingest_from_bytes, source, encodings)
+
+    def submit_sprite(self, sources, max_width, encoding):
+        return self._submit(render_sprite, sources, max_width, encoding)
+
+    def _submit(self, render, *args):
+        request_metrics = current_request_metrics.get()
+        future = Future()
+        if self.backend == self.BACKEND_INLINE:
+            try:
+                result, timings = render_timed(render, *args)
+            except Exception as e:
+                future.set_exception(e)
+            else:
+                record_render_stages(timings, request_metrics)
+                future.set_result(result)
+            return future
+
+        # blocks the producer once `max_pending` renders are in flight
+        self._slots.acquire()
+        try:
+            rendering = self.executor.submit(render_timed, render, *args)
+        except Exception:
+            self._slots.release()
+            raise
+        rendering.add_done_callback(lambda _: self._complete(rendering, future, request_metrics))
+        return future
+
+    def _complete(self, rendering, future, request_metrics):
+        self._slots.release()
+        try:
+            result, timings = rendering.result()
+        except Exception as e:
+            future.set_exception(e)
+        else:
+            record_render_stages(timings, request_metrics)
+            future.set_result(result)
+
+    def map(self, tasks):
+        futures = [self.submit(*task) for task in tasks]
+        return [future.result() for future in futures]
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+
+
+_engines = {}
+
+
+def get_render_engine():
+    options = settings.THUMBNAIL_RENDERING
+    key = (options['BACKEND'], options['WORKERS'], options['MAX_PENDING'])
+    if key not in _engines:
+        _engines[key] = RenderEngine(*key)
+    return _engines[key]
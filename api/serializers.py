@@ -1,6 +1,8 @@
 from rest_framework import serializers
 
-from api.models import Image, ExpirableLink, Thumbnail, ThumbnailSize
+from api.models import Image, ExpirableLink, Thumbnail, ThumbnailSize, get_account_plan
+from api.rendering import CONTENT_TYPES, FORMAT_JPEG, to_unsigned
+from api.uploads import validate_image
 
 
 class ExpirableLinkSerializer(serializers.ModelSerializer):
@@ -30,19 +32,65 @@ class ThumbnailSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Thumbnail
-        exclude = ['original_image']
+        exclude = ['original_image', 'encodings']
+
+    def get_encoding_url(self, instance, image_format, thumbnail_image):
+        if image_format == FORMAT_JPEG:
+            return thumbnail_image
+        request = self.context.get('request')
+        if instance.cached:
+            return f'{instance.get_content_url(request)}?encoding={image_format.lower()}'
+        url = instance.thumbnail_image.storage.url(instance.encodings[image_format]['name'])
+        return request.build_absolute_uri(url) if request else url
+
+    def to_representation(self, instance):
+        representation = super(ThumbnailSerializer, self).to_representation(instance)
+        if instance.cached:
+            representation['thumbnail_image'] = instance.get_content_url(self.context.get('request'))
+        representation['encodings'] = [
+            {
+                'content_type': CONTENT_TYPES[image_format],
+                'size': instance.get_encoded_size(image_format),
+                'url': self.get_encoding_url(instance, image_format, representation['thumbnail_image']),
+            }
+            for image_format in instance.get_formats()
+        ]
+        return representation
 
 
 class ImageSerializer(serializers.ModelSerializer):
     uploader = serializers.HiddenField(default=serializers.CurrentUserDefault())
+    # a plain file field, the image field of DRF would load and verify the whole upload in memory
+    image_file = serializers.FileField()
     thumbnails = ThumbnailSerializer(many=True, read_only=True)
+    pending_thumbnails = serializers.SerializerMethodField()
+    dhash = serializers.SerializerMethodField()
 
     class Meta:
         model = Image
         fields = '__all__'
+        read_only_fields = ['processing_status']
+
+    def get_account_plan(self, instance):
+        return self.context.get('account_plan') or instance.get_account_plan()
+
+    def validate_image_file(self, image_file):
+        account_plan = self.context.get('account_plan') or get_account_plan(self.context['request'].user)
+        image_file.image_metadata = validate_image(image_file, image_file.size, account_plan)
+        return image_file
+
+    def get_pending_thumbnails(self, instance):
+        sizes = self.context.get('thumbnail_sizes')
+        if sizes is None:
+            sizes = self.get_account_plan(instance).thumbnail_sizes.all()
+        rendered = {thumbnail.thumbnail_size_id for thumbnail in instance.thumbnails.all()}
+        return ThumnailSizeSerializer([size for size in sizes if size.pk not in rendered], many=True).data
+
+    def get_dhash(self, instance):
+        return None if instance.dhash is None else f'{to_unsigned(instance.dhash):016x}'
 
     def to_representation(self, instance):
         representation = super(ImageSerializer, self).to_representation(instance)
-        if not instance.uploader.account_plan_assignement.account_plan.have_access_to_original_link:
+        if not self.get_account_plan(instance).have_access_to_original_link:
             representation.pop('image_file')
         return representation
@@ -0,0 +1,161 @@
+import asyncio
+import re
+
+from asgiref.sync import sync_to_async
+
+from django.conf import settings
+from django.http import FileResponse, Http404, HttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, parse_etags
+from PIL import Image as ImageObject
+
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+OFFLOAD_X_ACCEL_REDIRECT = 'x-accel-redirect'
+OFFLOAD_X_SENDFILE = 'x-sendfile'
+
+
+class RangeFile:
+    def __init__(self, file, start, length):
+        self.file = file
+        self.file.seek(start)
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.file.close()
+
+
+def get_format_content_type(image_format):
+    return ImageObject.MIME.get(image_format, 'application/octet-stream')
+
+
+def get_content_type(storage, name):
+    # the type always comes from the header, the name's extension may have been picked by the uploader
+    try:
+        with storage.open(name, 'rb') as f:
+            return get_format_content_type(ImageObject.open(f).format)
+    except Exception:
+        return 'application/octet-stream'
+
+
+def parse_accept(header):
+    accepted = {}
+    for item in header.split(','):
+        media_type, _, params = item.partition(';')
+        quality = 1.0
+        for param in params.split(';'):
+            key, _, value = param.strip().partition('=')
+            if key == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0
+        if media_type.strip():
+            accepted[media_type.strip().lower()] = quality
+    return accepted
+
+
+def negotiate_content_type(request, offers):
+    # offers are (content_type, size or None) with the fallback every client can decode first, the others
+    # have to be named in Accept as clients without WebP/AVIF support still send */*
+    accepted = parse_accept(request.META.get('HTTP_ACCEPT', ''))
+    candidates = [
+        (size is None, size or 0, -index, content_type) for index, (content_type, size) in enumerate(offers)
+        if index == 0 or accepted.get(content_type, 0) > 0
+    ]
+    return min(candidates)[3]
+
+
+def parse_range(request, etag, size):
+    header = request.META.get('HTTP_RANGE', '')
+    match = RANGE_RE.match(header.strip())
+    if not match or not size:
+        return None
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if if_range and etag not in parse_etags(if_range):
+        return None
+
+    start, end = match.groups()
+    if not start:
+        if not end:
+            return None
+        start, end = max(size - int(end), 0), size - 1
+    else:
+        start, end = int(start), min(int(end), size - 1) if end else size - 1
+    return start, end
+
+
+class AsyncFileResponse(FileResponse):
+    # iterated with `async for` by api.asgi.ASGIHandler, every chunk is read off the event loop and a slow
+    # client holds a coroutine instead of a thread, other servers iterate it like any FileResponse
+    async def __aiter__(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            chunk = await loop.run_in_executor(None, self.file_to_stream.read, self.block_size)
+            if not chunk:
+                break
+            yield chunk
+
+
+def serve_file(request, storage, name, image_format=None, response_class=FileResponse):
+    try:
+        size = storage.size(name)
+        last_modified = int(storage.get_modified_time(name).timestamp())
+    except OSError:
+        raise Http404
+    # stored names are never reused for other content, so name, size and mtime make a strong validator
+    etag = f'"{last_modified:x}-{size:x}"'
+
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        content_type = get_format_content_type(image_format) if image_format else get_content_type(storage, name)
+        response = build_file_response(request, storage, name, content_type, etag, size, response_class)
+    response['ETag'] = etag
+    response['X-Content-Type-Options'] = 'nosniff'
+    response['Last-Modified'] = http_date(last_modified)
+    return response
+
+
+async def serve_file_async(request, storage, name, image_format=None):
+    # stat, open and the Pillow content type fallback run on a worker thread, only the body is streamed async
+    return await sync_to_async(serve_file, thread_sensitive=False)(
+        request, storage, name, image_format, AsyncFileResponse
+    )
+
+
+def build_file_response(request, storage, name, content_type, etag, size, response_class=FileResponse):
+    offload = settings.FILE_OFFLOAD['MODE']
+    if offload == OFFLOAD_X_ACCEL_REDIRECT:
+        response = HttpResponse(content_type=content_type)
+        response['X-Accel-Redirect'] = settings.FILE_OFFLOAD['PREFIX'] + name
+        return response
+    if offload == OFFLOAD_X_SENDFILE:
+        response = HttpResponse(content_type=content_type)
+        response['X-Sendfile'] = storage.path(name)
+        return response
+
+    byte_range = parse_range(request, etag, size)
+    if byte_range and byte_range[0] > byte_range[1]:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f'bytes */{size}'
+        return response
+
+    if byte_range:
+        start, end = byte_range
+        response = response_class(RangeFile(storage.open(name, 'rb'), start, end - start + 1), status=206)
+        response['Content-Type'] = content_type
+        response['Content-Range'] = f'bytes {start}-{end}/{size}'
+        response['Content-Length'] = end - start + 1
+    else:
+        response = response_class(storage.open(name, 'rb'), content_type=content_type)
+        response['Content-Length'] = size
+    response['Accept-Ranges'] = 'bytes'
+    return response
@@ -0,0 +1,77 @@
+from django.db import transaction
+from django.db.backends.signals import connection_created
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+
+from api.caching import invalidate_list_cache, plan_cache
+from api.metrics import record_query
+from api.models import AccountPlan, AccountPlanAssignement, ExpirableLink, Image, StoredFile, Thumbnail, ThumbnailSize
+from api.signing import revoke_temporary_link
+
+
+@receiver(post_delete, sender=ExpirableLink)
+def revoke_signed_temporary_link(sender, instance, **kwargs):
+    revoke_temporary_link(instance)
+
+
+@receiver(post_delete, sender=Image)
+def release_image_file(sender, instance, **kwargs):
+    StoredFile.release(instance.image_file.storage, instance.image_file.name)
+
+
+@receiver(post_delete, sender=Thumbnail)
+def release_thumbnail_file(sender, instance, **kwargs):
+    for name in instance.get_stored_names():
+        StoredFile.release(instance.thumbnail_image.storage, name)
+
+
+@receiver(post_save, sender=AccountPlan)
+@receiver(post_delete, sender=AccountPlan)
+@receiver(post_save, sender=ThumbnailSize)
+@receiver(post_delete, sender=ThumbnailSize)
+@receiver(m2m_changed, sender=AccountPlan.thumbnail_sizes.through)
+def invalidate_plan_cache(sender, **kwargs):
+    # once now for this process and once more on commit, so nothing read before the commit stays cached
+    plan_cache.invalidate()
+    transaction.on_commit(plan_cache.invalidate)
+    # sizes and plan flags show up in every list
+    invalidate_list_cache()
+
+
+@receiver(post_save, sender=AccountPlanAssignement)
+@receiver(post_delete, sender=AccountPlanAssignement)
+def invalidate_plan_assignement(sender, instance, **kwargs):
+    # only the user's entry, every signup creates an assignment and must not flush the plans of everyone
+    key = ('assignement', instance.user_id)
+    plan_cache.invalidate_key(key)
+    transaction.on_commit(lambda: plan_cache.invalidate_key(key))
+    invalidate_list_cache(instance.user_id)
+
+
+def get_uploader_id(instance):
+    image_field = instance._meta.get_field('original_image' if isinstance(instance, Thumbnail) else 'image')
+    if image_field.is_cached(instance):
+        return image_field.get_cached_value(instance).uploader_id
+    return Image.objects.filter(pk=getattr(instance, image_field.attname)).values_list('uploader_id', flat=True).first()
+
+
+@receiver(post_save, sender=Image)
+@receiver(post_delete, sender=Image)
+def invalidate_image_lists(sender, instance, **kwargs):
+    invalidate_list_cache(instance.uploader_id)
+
+
+@receiver(post_save, sender=Thumbnail)
+@receiver(post_delete, sender=Thumbnail)
+@receiver(post_save, sender=ExpirableLink)
+@receiver(post_delete, sender=ExpirableLink)
+def invalidate_image_child_lists(sender, instance, **kwargs):
+    uploader_id = get_uploader_id(instance)
+    if uploader_id is not None:
+        invalidate_list_cache(uploader_id)
+
+
+@receiver(connection_created)
+def instrument_connection(sender, connection, **kwargs):
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
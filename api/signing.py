@@ -0,0 +1,41 @@
+import time
+
+from django.conf import settings
+from django.core import signing
+from django.core.cache import caches
+
+
+SALT = 'api.temporary_link'
+
+
+def get_revocation_key(link_id, expires):
+    return f'api:revoked-temporary-link:{link_id}:{expires}'
+
+
+def sign_temporary_link(link):
+    return signing.dumps({
+        'link': link.pk,
+        'file': link.image.image_file.name,
+        'format': link.image.image_format,
+        'expires': int(link.expires_at.timestamp()),
+    }, salt=SALT)
+
+
+def unsign_temporary_link(token):
+    try:
+        payload = signing.loads(token, salt=SALT)
+    except signing.BadSignature:
+        return None
+    if payload['expires'] <= time.time():
+        return None
+    revocation_cache = caches[settings.TEMPORARY_LINKS['REVOCATION_CACHE']]
+    if revocation_cache.get(get_revocation_key(payload['link'], payload['expires'])):
+        return None
+    return payload
+
+
+def revoke_temporary_link(link):
+    expires = int(link.expires_at.timestamp())
+    timeout = int(expires - time.time()) + 1
+    if timeout > 0:
+        caches[settings.TEMPORARY_LINKS['REVOCATION_CACHE']].set(get_revocation_key(link.pk, expires), True, timeout)
@@ -0,0 +1,127 @@
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db import connection
+
+from api.models import Image
+from api.rendering import to_unsigned
+
+
+def hamming_distance(a, b):
+    return bin(a ^ b).count('1')
+
+
+class BKTree:
+    # nodes are [dhash, image ids, {distance: child}], images with the same hash share a node
+    def __init__(self):
+        self.root = None
+
+    def add(self, dhash, item):
+        if self.root is None:
+            self.root = [dhash, [item], {}]
+            return
+        node = self.root
+        while True:
+            distance = hamming_distance(dhash, node[0])
+            if distance == 0:
+                node[1].append(item)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [dhash, [item], {}]
+                return
+            node = child
+
+    def search(self, dhash, max_distance):
+        # the triangle inequality rules out every subtree outside [distance - max, distance + max]
+        results = []
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            node_hash, items, children = stack.pop()
+            distance = hamming_distance(dhash, node_hash)
+            if distance <= max_distance:
+                results.extend((distance, item) for item in items)
+            for child_distance, child in children.items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    stack.append(child)
+        return results
+
+
+class DHashIndex:
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.tree = BKTree()
+        self.last_pk = 0
+        self.time_built = time.monotonic()
+        self.rebuilding = False
+        self.lock = threading.Lock()
+        self.update_lock = threading.Lock()
+
+    def update(self):
+        # only rows added since the last query, an image hashed after it was first seen joins on the next rebuild,
+        # the query runs outside the lock searches take, so they only wait for the rows to be added
+        with self.update_lock:
+            rows = list(
+                Image.objects.filter(uploader_id=self.user_id, pk__gt=self.last_pk).values_list('pk', 'dhash')
+            )
+            if not rows:
+                return
+            with self.lock:
+                for pk, dhash in rows:
+                    if dhash is not None:
+                        self.tree.add(to_unsigned(dhash), pk)
+                self.last_pk = max(pk for pk, _ in rows)
+
+    def search(self, dhash, max_distance):
+        with self.lock:
+            return self.tree.search(to_unsigned(dhash), max_distance)
+
+
+_indexes = OrderedDict()
+_indexes_lock = threading.Lock()
+
+
+def get_dhash_index(user):
+    options = settings.NEAR_DUPLICATES
+    with _indexes_lock:
+        index = _indexes.get(user.pk)
+        if index is None:
+            # the first search of a user builds the index, concurrent ones wait for it in update()
+            index = _indexes[user.pk] = DHashIndex(user.pk)
+        elif not index.rebuilding and time.monotonic() - index.time_built > options['REBUILD_INTERVAL']:
+            # rebuilt now and then to drop deleted images and pick up hashes backfilled for older ones,
+            # in the background while searches keep using this one
+            index.rebuilding = True
+            threading.Thread(target=run_rebuild, args=(index,), daemon=True).start()
+        _indexes.move_to_end(user.pk)
+        while len(_indexes) > options['MAX_INDEXES']:
+            _indexes.popitem(last=False)
+    index.update()
+    return index
+
+
+def rebuild_dhash_index(user_id):
+    index = DHashIndex(user_id)
+    index.update()
+    with _indexes_lock:
+        # dropped from the LRU while it was being built, the next search starts over
+        if user_id in _indexes:
+            _indexes[user_id] = index
+    return index
+
+
+def run_rebuild(index):
+    try:
+        rebuild_dhash_index(index.user_id)
+    finally:
+        index.rebuilding = False
+        connection.close()
+
+
+def find_near_duplicates(image, max_distance):
+    if image.dhash is None:
+        return []
+    matches = get_dhash_index(image.uploader).search(image.dhash, max_distance)
+    return sorted((distance, pk) for distance, pk in matches if pk != image.pk)
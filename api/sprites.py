@@ -0,0 +1,77 @@
+import hashlib
+import json
+import math
+
+from django.conf import settings
+
+from api.admission import render_admission
+from api.models import Thumbnail
+from api.rendering import EXTENSIONS, FORMAT_JPEG, get_render_engine
+from api.thumbnail_cache import get_thumbnail_cache
+
+
+def get_sprite_key(thumbnails, size):
+    # a thumbnail is a function of the original's content and the size's settings, so that is all the key needs
+    digest = hashlib.sha256(f'{size.width}x{size.height}:{size.jpeg_quality}:{size.optimize}'.encode())
+    for thumbnail in thumbnails:
+        image = thumbnail.original_image
+        digest.update(f'|{image.pk}:{image.sha256 or image.image_file.name}'.encode())
+    # the uploader leads the key so the content view can tell whose sprite it is
+    return f'{thumbnails[0].original_image.uploader_id}-{digest.hexdigest()}'
+
+
+def get_sprite_owner_id(key):
+    owner_id, _, digest = key.partition('-')
+    return int(owner_id) if owner_id.isdigit() and digest else None
+
+
+def get_sprite_name(key, extension=EXTENSIONS[FORMAT_JPEG]):
+    return f'sprites/{key}{extension}'
+
+
+def get_thumbnails(images, size):
+    if settings.THUMBNAIL_MATERIALIZATION == Thumbnail.MATERIALIZATION_LAZY:
+        Thumbnail.create_cached(images, [size])
+    thumbnails = Thumbnail.objects.filter(original_image__in=images, thumbnail_size=size).select_related(
+        'original_image', 'thumbnail_size'
+    )
+    # images still waiting for their thumbnail job are left out until it is done
+    thumbnails = {thumbnail.original_image_id: thumbnail for thumbnail in thumbnails}
+    return [thumbnails[image.pk] for image in images if image.pk in thumbnails]
+
+
+def get_sprite(images, size):
+    thumbnails = get_thumbnails(images, size)
+    if not thumbnails:
+        return None
+    cache = get_thumbnail_cache()
+    key = get_sprite_key(thumbnails, size)
+    path = cache.get(get_sprite_name(key, '.json'))
+    if path and cache.get(get_sprite_name(key)):
+        try:
+            with open(path, 'rb') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            pass
+
+    sprite = build_sprite(thumbnails, size, key)
+    cache.set(get_sprite_name(key, '.json'), json.dumps(sprite).encode())
+    return sprite
+
+
+def build_sprite(thumbnails, size, key):
+    with render_admission.admit():
+        sources = []
+        for thumbnail in thumbnails:
+            with thumbnail.open_content() as f:
+                sources.append(f.read())
+        max_width = math.ceil(math.sqrt(len(sources))) * size.width
+        encoding = next(encoding for encoding in size.get_encodings() if encoding.format == FORMAT_JPEG)
+        content, (width, height), boxes = get_render_engine().submit_sprite(sources, max_width, encoding).result()
+    get_thumbnail_cache().set(get_sprite_name(key), content)
+    return {
+        'key': key,
+        'width': width,
+        'height': height,
+        'offsets': {str(thumbnail.original_image_id): list(box) for thumbnail, box in zip(thumbnails, boxes)},
+    }
@@ -0,0 +1,50 @@
+import hashlib
+import posixpath
+import time
+
+from django.conf import settings
+from django.core.files.storage import FileSystemStorage
+
+from api.metrics import record_storage
+
+
+class InstrumentedFileSystemStorage(FileSystemStorage):
+    def _open(self, name, mode='rb'):
+        started = time.perf_counter()
+        file = super(InstrumentedFileSystemStorage, self)._open(name, mode)
+        record_storage('open', time.perf_counter() - started, file.size)
+        return file
+
+    def _save(self, name, content):
+        started = time.perf_counter()
+        name = super(InstrumentedFileSystemStorage, self)._save(name, content)
+        record_storage('save', time.perf_counter() - started, content.size)
+        return name
+
+    def delete(self, name):
+        started = time.perf_counter()
+        super(InstrumentedFileSystemStorage, self).delete(name)
+        record_storage('delete', time.perf_counter() - started)
+
+
+def get_shard(filename, depth, width):
+    digest = hashlib.md5(filename.encode()).hexdigest()
+    return posixpath.join(*(digest[i * width:(i + 1) * width] for i in range(depth)))
+
+
+def shard_name(name, depth=None, width=None):
+    depth = settings.MEDIA_SHARDING['DEPTH'] if depth is None else depth
+    width = settings.MEDIA_SHARDING['WIDTH'] if width is None else width
+    if not depth:
+        return name
+    dirname, filename = posixpath.split(name)
+    shard = get_shard(filename, depth, width)
+    if dirname == shard or dirname.endswith('/' + shard):
+        return name
+    return posixpath.join(dirname, shard, filename)
+
+
+class ShardedFileSystemStorage(InstrumentedFileSystemStorage):
+    # names are only chosen through generate_filename, anything already stored keeps resolving under its own name
+    def generate_filename(self, filename):
+        return shard_name(super(ShardedFileSystemStorage, self).generate_filename(filename))
@@ -1,17 +1,57 @@
+from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.exceptions import RequestDataTooBig
 from django.core.files import File
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.files.uploadhandler import StopUpload
 from django.core.files.storage import get_storage_class
-from django.test import TestCase
+from django.core.management import call_command
+from django.db import connection
+from django.http import Http404
+from django.test import AsyncRequestFactory, RequestFactory, SimpleTestCase, TestCase, override_settings
 from django.urls import reverse
 
 from datetime import datetime, timedelta
+from unittest import mock, skipUnless
+from io import BytesIO, StringIO
+from random import Random
+import hashlib
+import os
+import shutil
+import struct
+import tempfile
+import threading
+import time
+import zipfile
+import zlib
 import pytz
+from PIL import Image as ImageObject, PngImagePlugin
 
-from api.models import Image, ExpirableLink, AccountPlanAssignement, AccountPlan
+from benchmarks.hot_paths import bench_lists, bench_temporary_links
+from benchmarks.thumbnail_rendering import DecodeCounter
+
+from api.admission import render_admission
+from api.asgi import ASGIHandler
+from api.backfill import missing_thumbnails
+from api.caching import VersionedCache, plan_cache
+from api.metadata import EXIF_DATE_TIME_ORIGINAL, EXIF_IFD, METADATA_FIELDS
+from api.metrics import Histogram, RequestMetrics, _registry, current_request_metrics
+from api.models import Image, ExpirableLink, AccountPlanAssignement, AccountPlan, StoredFile, Thumbnail, \
+    ThumbnailBackfill, ThumbnailJob, ThumbnailSize, get_account_plan
+from api.rendering import RenderEngine, compute_dhash, is_format_supported, render_thumbnails, \
+    to_unsigned
+from api.serving import negotiate_content_type
+from api.similarity import BKTree, _indexes, get_dhash_index, hamming_distance, rebuild_dhash_index
+from api.storage import shard_name
+from api.thumbnail_cache import ThumbnailDiskCache
+from api.uploadhandlers import HashingTemporaryFileUploadHandler
+from api.views import async_expirable_link_content_view, async_signed_link_content_view
 
 
 User = get_user_model()
 Storage = get_storage_class()
+EAGER_THUMBNAIL_JOBS = dict(settings.THUMBNAIL_JOBS, EAGER=True)
 
 
 class TestExperibableLink(TestCase):
@@ -29,7 +69,7 @@ class TestExperibableLink(TestCase):
 
         self.client.force_login(user)
         response = self.client.get(reverse('expirable-link'))
-        self.assertEqual(len(response.data), 0)
+        self.assertEqual(len(response.data['results']), 0)
 
         response = self.client.get(expirable_link.generate_temporary_link())
         self.assertEqual(response.status_code, 404)
@@ -50,13 +90,33 @@ class TestExperibableLink(TestCase):
 
         self.client.force_login(user)
         response = self.client.get(reverse('expirable-link'))
-        self.assertEqual(len(response.data), 1)
+        self.assertEqual(len(response.data['results']), 1)
 
-        response = self.client.get(response.data[0]['temporary_link'])
+        response = self.client.get(response.data['results'][0]['temporary_link'])
         self.assertEqual(response.status_code, 200)
 
         user.delete()
 
+    def test_expires_at(self):
+        user = User.objects.create_user('test_user_name')
+        AccountPlanAssignement.objects.create(user=user, account_plan_id=AccountPlan.ENTERPRISE_ID)
+        image = Image.objects.create(
+            uploader=user, image_file=File(open('static/test_image.jpg', 'rb'))
+        )
+        expirable_link = ExpirableLink.objects.create(
+            image=image,
+            time_created=datetime(2000, 1, 1, 1, tzinfo=pytz.UTC),
+            experation_period=timedelta(seconds=300)
+        )
+        self.assertEqual(expirable_link.expires_at, datetime(2000, 1, 1, 1, 5, tzinfo=pytz.UTC))
+
+        expirable_link.experation_period = timedelta(seconds=600)
+        expirable_link.save()
+        expirable_link.refresh_from_db()
+        self.assertEqual(expirable_link.expires_at, datetime(2000, 1, 1, 1, 10, tzinfo=pytz.UTC))
+
+        user.delete()
+
     def test_create(self):
         user = User.objects.create_user('test_user_name')
         AccountPlanAssignement.objects.create(user=user, account_plan_id=AccountPlan.ENTERPRISE_ID)
@@ -75,7 +135,7 @@ class TestExperibableLink(TestCase):
         self.assertIn('image', response.data)
 
         response = self.client.get(reverse('expirable-link'))
-        self.assertEqual(len(response.data), 1)
+        self.assertEqual(len(response.data['results']), 1)
 
         user.delete()
 
@@ -101,6 +161,166 @@ class TestExperibableLink(TestCase):
         user2.delete()
 
 
+@override_settings(TEMPORARY_LINKS=dict(settings.TEMPORARY_LINKS, FORMAT=ExpirableLink.FORMAT_SIGNED))
+class TestSignedLink(TestCase):
+    def setUp(self):
+        # sequences restart with every test, revocations of earlier tests would match the new links
+        cache.clear()
+
+    def create_link(self, user, **kwargs):
+        AccountPlanAssignement.objects.create(user=user, account_plan_id=AccountPlan.ENTERPRISE_ID)
+        image = Image.objects.create(
+            uploader=user, image_file=File(open('static/test_image.jpg', 'rb'))
+        )
+        return ExpirableLink.objects.create(image=image, experation_period=timedelta(seconds=4000), **kwargs)
+
+    def test_resolved_without_database(self):
+        user = User.objects.create_user('test_user_name')
+        self.create_link(user)
+
+        self.client.force_login(user)
+        response = self.client.get(reverse('expirable-link'))
+        temporary_link = response.data['results'][0]['temporary_link']
+        self.assertIn('/signed/', temporary_link)
+
+        self.client.logout()
+        with self.assertNumQueries(0):
+            response = self.client.get(temporary_link)
+            self.assertEqual(response.status_code, 200)
+            response.close()
+
+        response = self.client.get(temporary_link[:-1] + ('A' if temporary_link[-1] != 'A' else 'B'))
+        self.assertEqual(response.status_code, 404)
+
+        user.delete()
+
+    def test_expired(self):
+        user = User.objects.create_user('test_user_name')
+        expirable_link = self.create_link(user, time_created=datetime(2000, 1, 1, 1, tzinfo=pytz.UTC))
+
+        response = self.client.get(expirable_link.generate_temporary_link())
+        self.assertEqual(response.status_code, 404)
+
+        user.delete()
+
+    def test_revoked(self):
+        user = User.objects.create_user('test_user_name')
+        expirable_link = self.create_link(user)
+        temporary_link = expirable_link.generate_temporary_link()
+        id_link = expirable_link.generate_temporary_link(link_format=ExpirableLink.FORMAT_ID)
+        self.assertNotIn('/signed/', id_link)
+
+        expirable_link.delete()
+        response = self.client.get(temporary_link)
+        self.assertEqual(response.status_code, 404)
+
+        user.delete()
+
+
+class TestLinkContent(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('test_user_name')
+        AccountPlanAssignement.objects.create(user=self.user, account_plan_id=AccountPlan.ENTERPRISE_ID)
+        image = Image.objects.create(
+            uploader=self.user, image_file=File(open('static/test_image.jpg', 'rb'))
+        )
+        self.expirable_link = ExpirableLink.objects.create(image=image, experation_period=timedelta(seconds=4000))
+        self.temporary_link = self.expirable_link.generate_temporary_link()
+        with open('static/test_image.jpg', 'rb') as f:
+            self.content = f.read()
+
+    def tearDown(self):
+        self.user.delete()
+
+    def test_conditional(self):
+        response = self.client.get(self.temporary_link)
+        self.assertEqual(response['Content-Type'], 'image/jpeg')
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        self.assertEqual(b''.join(response.streaming_content), self.content)
+
+        not_modified = self.client.get(self.temporary_link, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(not_modified.status_code, 304)
+        self.assertEqual(not_modified['ETag'], response['ETag'])
+
+        not_modified = self.client.get(self.temporary_link, HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(not_modified.status_code, 304)
+
+    def test_range(self):
+        response = self.client.get(self.temporary_link, HTTP_RANGE='bytes=10-19')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], f'bytes 10-19/{len(self.content)}')
+        self.assertEqual(b''.join(response.streaming_content), self.content[10:20])
+
+        response = self.client.get(self.temporary_link, HTTP_RANGE='bytes=-5')
+        self.assertEqual(b''.join(response.streaming_content), self.content[-5:])
+
+        response = self.client.get(self.temporary_link, HTTP_RANGE='bytes=10-', HTTP_IF_RANGE='"stale"')
+        self.assertEqual(response.status_code, 200)
+        response.close()
+
+        response = self.client.get(self.temporary_link, HTTP_RANGE=f'bytes={len(self.content)}-')
+        self.assertEqual(response.status_code, 416)
+
+    @override_settings(FILE_OFFLOAD={'MODE': 'x-accel-redirect', 'PREFIX': '/protected/'})
+    def test_offload(self):
+        response = self.client.get(self.temporary_link)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['X-Accel-Redirect'].startswith('/protected/'))
+        self.assertEqual(response.content, b'')
+
+    async def send_response(self, response):
+        messages = []
+
+        async def send(message):
+            messages.append(message)
+
+        await ASGIHandler().send_response(response, send)
+        return messages[0], b''.join(message.get('body', b'') for message in messages[1:])
+
+    async def test_async_view(self):
+        request = AsyncRequestFactory().get('/', range='bytes=10-19')
+        response = await async_expirable_link_content_view(request, str(self.expirable_link.pk))
+        start, body = await self.send_response(response)
+        self.assertEqual(start['status'], 206)
+        self.assertIn((b'Content-Range', f'bytes 10-19/{len(self.content)}'.encode()), start['headers'])
+        self.assertEqual(body, self.content[10:20])
+
+        request = AsyncRequestFactory().get('/')
+        token = self.expirable_link.generate_temporary_link(link_format=ExpirableLink.FORMAT_SIGNED).split('/')[-1]
+        start, body = await self.send_response(await async_signed_link_content_view(request, token))
+        self.assertEqual(start['status'], 200)
+        self.assertEqual(body, self.content)
+
+        with self.assertRaises(Http404):
+            await async_expirable_link_content_view(request, '0')
+        response = await async_expirable_link_content_view(AsyncRequestFactory().post('/'), '0')
+        self.assertEqual(response.status_code, 405)
+
+    @override_settings(THUMBNAIL_JOBS=EAGER_THUMBNAIL_JOBS)
+    def test_uploaded_extension(self):
+        info = PngImagePlugin.PngInfo()
+        info.add_text('Comment', '<script>alert(1)</script>')
+        content = BytesIO()
+        ImageObject.new('RGB', (8, 8)).save(content, 'PNG', pnginfo=info)
+        self.client.force_login(self.user)
+
+        response = self.client.post(reverse('image'), data={
+            'image_file': SimpleUploadedFile('evil.html', content.getvalue())
+        })
+        bulk_response = self.client.post(reverse('image-bulk'), data={
+            'image_files': [SimpleUploadedFile('evil.html', content.getvalue())]
+        })
+        for image_id in (response.data['id'], bulk_response.data[0]['id']):
+            image = Image.objects.get(pk=image_id)
+            self.assertTrue(image.image_file.name.endswith('.png'))
+            expirable_link = ExpirableLink.objects.create(image=image, experation_period=timedelta(seconds=4000))
+            for link_format in (ExpirableLink.FORMAT_ID, ExpirableLink.FORMAT_SIGNED):
+                link_response = self.client.get(expirable_link.generate_temporary_link(link_format=link_format))
+                self.assertEqual(link_response['Content-Type'], 'image/png')
+                self.assertEqual(link_response['X-Content-Type-Options'], 'nosniff')
+                link_response.close()
+
+
 class TestImage(TestCase):
     def test_presence_of_links(self):
         user = User.objects.create_user('test_user_name')
@@ -111,8 +331,8 @@ class TestImage(TestCase):
 
         self.client.force_login(user)
         response = self.client.get(reverse('image'))
-        self.assertEqual(len(response.data), 1)
-        self.assertIn('image_file', response.data[0])
+        self.assertEqual(len(response.data['results']), 1)
+        self.assertIn('image_file', response.data['results'][0])
 
         user.delete()
 
@@ -125,7 +345,7 @@ class TestImage(TestCase):
 
         self.client.force_login(user)
         response = self.client.get(reverse('image'))
-        self.assertNotIn('image_file', response.data[0])
+        self.assertNotIn('image_file', response.data['results'][0])
 
         user.delete()
 
@@ -144,6 +364,168 @@ class TestImage(TestCase):
         user.delete()
 
 
+def make_png_header(width, height):
+    # a PNG without any pixel data, enough for its header to be parsed
+    chunks = [b'IHDR' + struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0), b'IDAT']
+    return b'\x89PNG\r\n\x1a\n' + b''.join(
+        struct.pack('>I', len(chunk) - 4) + chunk + struct.pack('>I', zlib.crc32(chunk)) for chunk in chunks
+    )
+
+
+def make_jpeg(width, height, taken=None):
+    exif = ImageObject.Exif()
+    if taken:
+        exif[EXIF_IFD] = {EXIF_DATE_TIME_ORIGINAL: taken}
+    content = BytesIO()
+    ImageObject.new('RGB', (width, height), (width % 256, height % 256, 0)).save(content, 'JPEG', exif=exif.tobytes())
+    return content.getvalue()
+
+
+class TestUploadLimits(TestCase):
+    def setUp(self):
+        self.addCleanup(plan_cache.invalidate)
+        self.user = User.objects.create_user('test_user_name')
+        AccountPlanAssignement.objects.create(user=self.user, account_plan_id=AccountPlan.BASIC_ID)
+        self.client.force_login(self.user)
+
+    def tearDown(self):
+        self.user.delete()
+
+    def set_limits(self, **limits):
+        account_plan = AccountPlan.objects.get(pk=AccountPlan.BASIC_ID)
+        for name, value in limits.items():
+            setattr(account_plan, name, value)
+        account_plan.save()
+
+    def upload(self, name='test_image.jpg', content=None):
+        if content is None:
+            with open('static/test_image.jpg', 'rb') as f:
+                content = f.read()
+        return self.client.post(reverse('image'), data={'image_file': SimpleUploadedFile(name, content)})
+
+    def test_plan_limits(self):
+        self.set_limits(max_image_pixels=1000)
+        response = self.upload()
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('pixels', response.data['image_file'][0])
+
+        self.set_limits(max_image_pixels=10 ** 6, max_image_side=100)
+        response = self.upload()
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('on a side', response.data['image_file'][0])
+
+        self.set_limits(max_image_side=10000, max_upload_size=1000)
+        response = self.client.post(reverse('image-bulk'), data={
+            'image_files': [SimpleUploadedFile('test_image.jpg', open('static/test_image.jpg', 'rb').read())]
+        })
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data[0]['error'], 'image is larger than 1000 bytes')
+        self.assertFalse(Image.objects.filter(uploader=self.user).exists())
+
+    @override_settings(IMAGE_UPLOADS=dict(settings.IMAGE_UPLOADS, FORMATS=['PNG']))
+    def test_format(self):
+        response = self.upload()
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data['image_file'][0], 'JPEG images are not accepted')
+
+    def test_decompression_bomb(self):
+        with DecodeCounter() as counter:
+            response = self.upload('bomb.png', make_png_header(30000, 30000))
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('pixels', response.data['image_file'][0])
+        self.assertEqual(counter.count, 0)
+
+    @override_settings(IMAGE_UPLOADS=dict(settings.IMAGE_UPLOADS, MAX_SIZE=1000), FILE_UPLOAD_MAX_MEMORY_SIZE=0)
+    def test_streamed_to_disk(self):
+        handler = HashingTemporaryFileUploadHandler()
+        handler.new_file('image_file', 'test_image.jpg', 'image/jpeg', 3000)
+        handler.receive_data_chunk(b'0' * 500, 0)
+        handler.receive_data_chunk(b'0' * 500, 500)
+        # the chunk crossing the limit stops the upload, nothing after it is read
+        with self.assertRaises(StopUpload) as stop:
+            handler.receive_data_chunk(b'0' * 500, 1000)
+        self.assertTrue(stop.exception.connection_reset)
+        self.assertEqual(handler.file.tell(), 1000)
+        handler.file.close()
+        with self.assertRaises(RequestDataTooBig):
+            handler.upload_complete()
+
+        response = self.upload()
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Image.objects.filter(uploader=self.user).exists())
+
+
+@override_settings(THUMBNAIL_JOBS=EAGER_THUMBNAIL_JOBS)
+class TestImageMetadata(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('test_user_name')
+        AccountPlanAssignement.objects.create(user=self.user, account_plan_id=AccountPlan.BASIC_ID)
+        self.client.force_login(self.user)
+
+    def tearDown(self):
+        self.user.delete()
+
+    def upload(self, content, name='image.jpg'):
+        response = self.client.post(reverse('image'), data={'image_file': SimpleUploadedFile(name, content)})
+        return Image.objects.get(pk=response.data['id'])
+
+    def test_extracted_on_upload(self):
+        content = make_jpeg(300, 200, '2021:05:06 07:08:09')
+        image = self.upload(content)
+        self.assertEqual((image.width, image.height, image.image_format), (300, 200, 'JPEG'))
+        self.assertEqual(image.file_size, len(content))
+        self.assertEqual(image.taken_at, datetime(2021, 5, 6, 7, 8, 9, tzinfo=pytz.utc))
+        thumbnail = image.thumbnails.get()
+        self.assertEqual((thumbnail.width, thumbnail.height), ImageObject.open(thumbnail.open_content()).size)
+
+        content = BytesIO()
+        ImageObject.new('RGBA', (40, 30)).save(content, 'PNG')
+        image = self.upload(content.getvalue(), 'image.png')
+        self.assertEqual((image.width, image.height, image.image_format, image.taken_at), (40, 30, 'PNG', None))
+
+        response = self.client.post(reverse('image-bulk'), data={
+            'image_files': [SimpleUploadedFile('bulk.jpg', make_jpeg(120, 80, '2020:01:02 03:04:05'))]
+        })
+        image = Image.objects.get(pk=response.data[0]['id'])
+        self.assertEqual((image.width, image.height, image.taken_at.year), (120, 80, 2020))
+
+    def test_filter_and_order(self):
+        small = self.upload(make_jpeg(50, 40, '2019:01:01 00:00:00'))
+        large = self.upload(make_jpeg(400, 300))
+        medium = self.upload(make_jpeg(200, 100, '2021:01:01 00:00:00'))
+
+        def ids(params):
+            response = self.client.get(reverse('image'), params)
+            self.assertEqual(response.status_code, 200)
+            return [image['id'] for image in response.data['results']]
+
+        self.assertEqual(ids({'min_width': 100, 'ordering': 'width'}), [medium.pk, large.pk])
+        self.assertEqual(ids({'max_height': 100, 'ordering': '-width'}), [medium.pk, small.pk])
+        self.assertEqual(ids({'ordering': '-file_size', 'page_size': 1}), [large.pk])
+        self.assertEqual(ids({'ordering': 'taken'}), [small.pk, medium.pk, large.pk])
+        self.assertEqual(ids({'ordering': '-taken'}), [medium.pk, small.pk, large.pk])
+        self.assertEqual(ids({'taken_after': '2020-01-01T00:00:00Z'}), [medium.pk])
+        self.assertEqual(ids({'image_format': 'png'}), [])
+
+        response = self.client.get(reverse('image'), {'ordering': 'width', 'page_size': 2})
+        response = self.client.get(response.data['next'])
+        self.assertEqual([image['id'] for image in response.data['results']], [large.pk])
+
+        self.assertEqual(self.client.get(reverse('image'), {'min_width': 'wide'}).status_code, 400)
+
+    def test_backfill(self):
+        image = self.upload(make_jpeg(300, 200, '2021:05:06 07:08:09'))
+        Image.objects.update(width=0, height=0, image_format='', file_size=0, taken_at=None)
+        Thumbnail.objects.update(width=0, height=0)
+
+        call_command('backfill_image_metadata', stdout=StringIO())
+        backfilled = Image.objects.get(pk=image.pk)
+        for field in METADATA_FIELDS:
+            self.assertEqual(getattr(backfilled, field), getattr(image, field))
+        self.assertFalse(Thumbnail.objects.filter(width=0).exists())
+
+
+@override_settings(THUMBNAIL_JOBS=EAGER_THUMBNAIL_JOBS)
 class TestThumbnails(TestCase):
     def test_get_basic_thumbnails(self):
         user = User.objects.create_user('test_user_name')
@@ -154,7 +536,7 @@ class TestThumbnails(TestCase):
 
         self.client.force_login(user)
         response = self.client.get(reverse('thumbnails'))
-        self.assertEqual(len(response.data), 2)
+        self.assertEqual(len(response.data['results']), 2)
 
         user.delete()
 
@@ -170,9 +552,1137 @@ class TestThumbnails(TestCase):
 
         self.client.force_login(user)
         response = self.client.get(reverse('thumbnails'))
-        self.assertEqual(len(response.data), 4)
+        self.assertEqual(len(response.data['results']), 4)
 
         response = self.client.get(reverse('thumbnails'), {'image': specific_image.id})
-        self.assertEqual(len(response.data), 2)
+        self.assertEqual(len(response.data['results']), 2)
+
+        user.delete()
+
+    @override_settings(THUMBNAIL_JOBS=EAGER_THUMBNAIL_JOBS)
+    def test_storage_operations(self):
+        user = User.objects.create_user('test_user_name')
+        AccountPlanAssignement.objects.create(user=user, account_plan_id=AccountPlan.PREMIUM_ID)
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        request_metrics = RequestMetrics()
+        token = current_request_metrics.set(request_metrics)
+        try:
+            with self.settings(MEDIA_ROOT=media_root):
+                image = Image.objects.create(uploader=user, image_file=File(open('static/test_image.jpg', 'rb')))
+        finally:
+            current_request_metrics.reset(token)
+
+        # the original and one write per thumbnail, the original is read once to render from
+        self.assertEqual(request_metrics.storage['save'][0], 3)
+        self.assertEqual(request_metrics.storage['open'][0], 1)
+        storage = image.image_file.storage
+        names = list(image.thumbnails.values_list('thumbnail_image', flat=True))
+        self.assertEqual(set(StoredFile.objects.values_list('name', flat=True)), {image.image_file.name, *names})
+        with self.settings(MEDIA_ROOT=media_root):
+            self.assertEqual(
+                request_metrics.storage['save'][2], sum(storage.size(name) for name in [image.image_file.name] + names)
+            )
+            with self.captureOnCommitCallbacks(execute=True):
+                user.delete()
+
+
+@override_settings(THUMBNAIL_JOBS=EAGER_THUMBNAIL_JOBS)
+class TestEncodings(TestCase):
+    def setUp(self):
+        self.addCleanup(plan_cache.invalidate)
+
+    def test_jpeg_profile(self):
+        user = User.objects.create_user('test_user_name')
+        AccountPlanAssignement.objects.create(user=user, account_plan_id=AccountPlan.PREMIUM_ID)
+        size = AccountPlan.objects.get(pk=AccountPlan.PREMIUM_ID).thumbnail_sizes.first()
+        size.jpeg_quality = 60
+        size.optimize = True
+        size.save()
+        image = Image.objects.create(uploader=user, image_file=File(open('static/test_image.jpg', 'rb')))
+
+        thumbnail = image.thumbnails.get(thumbnail_size=size)
+        self.assertIn('progressive', ImageObject.open(thumbnail.thumbnail_image).info)
+        self.assertEqual(thumbnail.encodings['JPEG']['size'], thumbnail.thumbnail_image.size)
+
+        self.client.force_login(user)
+        response = self.client.get(reverse('thumbnails'), {'image': image.id})
+        for result in response.data['results']:
+            self.assertEqual(result['encodings'][0]['content_type'], 'image/jpeg')
+            self.assertEqual(result['encodings'][0]['url'], result['thumbnail_image'])
+
+        response = self.client.get(
+            reverse('thumbnail-content', kwargs={'image': image.id, 'thumbnail_size': size.id}),
+            HTTP_ACCEPT='image/avif,image/webp,*/*'
+        )
+        self.assertEqual(response['Content-Type'], 'image/jpeg')
+        self.assertIn('Accept', response['Vary'])
+
+        user.delete()
+
+    @skipUnless(is_format_supported('WEBP'), 'Pillow is built without WebP')
+    def test_webp(self):
+        user = User.objects.create_user('test_user_name')
+        AccountPlanAssignement.objects.create(user=user, account_plan_id=AccountPlan.PREMIUM_ID)
+        size = AccountPlan.objects.get(pk=AccountPlan.PREMIUM_ID).thumbnail_sizes.first()
+        size.webp_quality = 50
+        size.save()
+        image = Image.objects.create(uploader=user, image_file=File(open('static/test_image.jpg', 'rb')))
+
+        thumbnail = image.thumbnails.get(thumbnail_size=size)
+        self.assertEqual(thumbnail.get_formats(), ['JPEG', 'WEBP'])
+        with thumbnail.open_content('WEBP') as f:
+            self.assertEqual(ImageObject.open(f).format, 'WEBP')
+
+        self.client.force_login(user)
+        url = reverse('thumbnail-content', kwargs={'image': image.id, 'thumbnail_size': size.id})
+        response = self.client.get(url, HTTP_ACCEPT='image/webp,*/*')
+        self.assertEqual(response['Content-Type'], 'image/webp')
+        response = self.client.get(url, HTTP_ACCEPT='*/*')
+        self.assertEqual(response['Content-Type'], 'image/jpeg')
+
+        user.delete()
+
+    def test_negotiation(self):
+        offers = [('image/jpeg', 300), ('image/webp', 200), ('image/avif', 250)]
+        for accept, expected in [
+            ('', 'image/jpeg'),
+            ('*/*', 'image/jpeg'),
+            ('image/webp,*/*', 'image/webp'),
+            ('image/avif,image/webp;q=0,*/*', 'image/avif'),
+            ('image/avif,image/webp', 'image/webp'),
+        ]:
+            request = RequestFactory().get('/', HTTP_ACCEPT=accept)
+            self.assertEqual(negotiate_content_type(request, offers), expected)
+
+        request = RequestFactory().get('/', HTTP_ACCEPT='image/avif,image/webp,*/*')
+        self.assertEqual(negotiate_content_type(request, [('image/jpeg', None), ('image/webp', None)]), 'image/webp')
+
+
+class TestThumbnailJobs(TestCase):
+    def test_upload_is_queued(self):
+        user = User.objects.create_user('test_user_name')
+        AccountPlanAssignement.objects.create(user=user, account_plan_id=AccountPlan.PREMIUM_ID)
+        image = Image.objects.create(
+            uploader=user, image_file=File(open('static/test_image.jpg', 'rb'))
+        )
+
+        self.assertEqual(image.processing_status, Image.PROCESSING_PENDING)
+        self.assertEqual(image.thumbnails.count(), 0)
+        self.assertEqual(ThumbnailJob.objects.filter(image=image, status=ThumbnailJob.STATUS_QUEUED).count(), 1)
+
+        self.client.force_login(user)
+        response = self.client.get(reverse('image'))
+        self.assertEqual(response.data['results'][0]['processing_status'], Image.PROCESSING_PENDING)
+        self.assertEqual(len(response.data['results'][0]['pending_thumbnails']), 2)
+
+        user.delete()
+
+    def test_worker(self):
+        user = User.objects.create_user('test_user_name')
+        AccountPlanAssignement.objects.create(user=user, account_plan_id=AccountPlan.PREMIUM_ID)
+        image = Image.objects.create(
+            uploader=user, image_file=File(open('static/test_image.jpg', 'rb'))
+        )
+
+        call_command('process_thumbnail_jobs', '--once', stdout=StringIO())
+
+        image.refresh_from_db()
+        self.assertEqual(image.processing_status, Image.PROCESSING_DONE)
+        self.assertEqual(image.thumbnails.count(), 2)
+        self.assertEqual(ThumbnailJob.objects.get(image=image).status, ThumbnailJob.STATUS_DONE)
+
+        self.client.force_login(user)
+        response = self.client.get(reverse('image'))
+        self.assertEqual(len(response.data['results'][0]['thumbnails']), 2)
+        self.assertEqual(response.data['results'][0]['pending_thumbnails'], [])
+
+        user.delete()
+
+
+class TestBackfill(TestCase):
+    def test_resume(self):
+        user = User.objects.create_user('test_user_name')
+        AccountPlanAssignement.objects.create(user=user, account_plan_id=AccountPlan.PREMIUM_ID)
+        images = [
+            Image.objects.create(uploader=user, image_file=File(open('static/test_image.jpg', 'rb')))
+            for _ in range(3)
+        ]
+        self.assertEqual(missing_thumbnails().count(), 6)
+
+        out = StringIO()
+        call_command('backfill_thumbnails', '--batch-size', '2', '--max-batches', '1', stdout=out)
+        self.assertIn('4/6 thumbnails', out.getvalue())
+        self.assertEqual(ThumbnailBackfill.objects.get(name='default').last_image_id, images[1].pk)
+        self.assertEqual([image.thumbnails.count() for image in images], [2, 2, 0])
+
+        out = StringIO()
+        call_command('backfill_thumbnails', '--batch-size', '2', stdout=out)
+        self.assertIn('2/2 thumbnails', out.getvalue())
+        self.assertIn('6 rendered, 0 failed', out.getvalue())
+        self.assertEqual(missing_thumbnails().count(), 0)
+
+        user.delete()
+
+    def test_plan_change(self):
+        user = User.objects.create_user('test_user_name')
+        AccountPlanAssignement.objects.create(user=user, account_plan_id=AccountPlan.PREMIUM_ID)
+        image = Image.objects.create(uploader=user, image_file=File(open('static/test_image.jpg', 'rb')))
+        call_command('backfill_thumbnails', stdout=StringIO())
+
+        size = ThumbnailSize.objects.create(width=50, height=50)
+        AccountPlan.objects.get(pk=AccountPlan.PREMIUM_ID).thumbnail_sizes.add(size)
+        self.assertEqual(list(missing_thumbnails()), [(image.pk, size.pk)])
+
+        call_command('backfill_thumbnails', '--restart', '--workers', '2', stdout=StringIO())
+        self.assertEqual(image.thumbnails.get(thumbnail_size=size).thumbnail_image.height, 50)
+        self.assertEqual(missing_thumbnails().count(), 0)
+
+        user.delete()
+
+    def test_successive_plan_changes(self):
+        user = User.objects.create_user('test_user_name')
+        AccountPlanAssignement.objects.create(user=user, account_plan_id=AccountPlan.PREMIUM_ID)
+        images = [
+            Image.objects.create(uploader=user, image_file=File(open('static/test_image.jpg', 'rb')))
+            for _ in range(2)
+        ]
+        call_command('backfill_thumbnails', stdout=StringIO())
+        self.assertFalse(ThumbnailBackfill.objects.exists())
+
+        for side in (50, 60):
+            size = ThumbnailSize.objects.create(width=side, height=side)
+            AccountPlan.objects.get(pk=AccountPlan.PREMIUM_ID).thumbnail_sizes.add(size)
+            out = StringIO()
+            call_command('backfill_thumbnails', stdout=out)
+            self.assertIn('2 rendered, 0 failed', out.getvalue())
+            self.assertEqual(missing_thumbnails().count(), 0)
+            self.assertTrue(all(image.thumbnails.filter(thumbnail_size=size).exists() for image in images))
+
+        user.delete()
+
+
+class TestRendering(SimpleTestCase):
+    def test_single_decode(self):
+        boxes = [(200, 200), (400, 400), (100, 50)]
+        with DecodeCounter() as counter, open('static/test_image.jpg', 'rb') as f:
+            thumbnails = render_thumbnails(f, boxes)
+        self.assertEqual(counter.count, 1)
+
+        with open('static/test_image.jpg', 'rb') as f:
+            original = ImageObject.open(f)
+            for box in boxes:
+                expected = original.copy()
+                expected.thumbnail(box)
+                self.assertEqual(ImageObject.open(thumbnails[box]).size, expected.size)
+
+    def test_render_engine(self):
+        with open('static/test_image.jpg', 'rb') as f:
+            source = f.read()
+        tasks = [(source, [(200, 200), (100, 100)])] * 4
+
+        for backend in (RenderEngine.BACKEND_INLINE, RenderEngine.BACKEND_THREAD, RenderEngine.BACKEND_PROCESS):
+            engine = RenderEngine(backend, workers=2, max_pending=2)
+            results = engine.map(tasks)
+            engine.shutdown()
+
+            self.assertEqual(len(results), 4)
+            for rendered in results:
+                self.assertEqual(set(rendered), {(200, 200), (100, 100)})
+                self.assertLessEqual(max(ImageObject.open(BytesIO(rendered[(100, 100)])).size), 100)
+
+
+class TestLazyThumbnails(TestCase):
+    def setUp(self):
+        self.cache_location = tempfile.mkdtemp()
+        self.settings_override = override_settings(
+            THUMBNAIL_MATERIALIZATION='lazy',
+            THUMBNAIL_CACHE={'LOCATION': self.cache_location, 'MAX_SIZE': 1024 ** 2}
+        )
+        self.settings_override.enable()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.cache_location)
+
+    def test_rendered_on_request(self):
+        user = User.objects.create_user('test_user_name')
+        AccountPlanAssignement.objects.create(user=user, account_plan_id=AccountPlan.PREMIUM_ID)
+        image = Image.objects.create(
+            uploader=user, image_file=File(open('static/test_image.jpg', 'rb'))
+        )
+        self.assertEqual(image.processing_status, Image.PROCESSING_DONE)
+        self.assertFalse(ThumbnailJob.objects.exists())
+        # the rows are created with the image, only their content waits for a request
+        self.assertEqual(image.thumbnails.count(), 2)
+
+        self.client.force_login(user)
+        response = self.client.get(reverse('thumbnails'))
+        self.assertEqual(len(response.data['results']), 2)
+        self.assertEqual(os.listdir(self.cache_location), [])
+
+        response = self.client.get(response.data['results'][0]['thumbnail_image'])
+        self.assertEqual(response.status_code, 200)
+        ImageObject.open(BytesIO(b''.join(response.streaming_content)))
+        self.assertEqual(len(os.listdir(self.cache_location)), 1)
+
+        for name in os.listdir(self.cache_location):
+            os.remove(os.path.join(self.cache_location, name))
+        response = self.client.get(reverse('thumbnails'))
+        response = self.client.get(response.data['results'][0]['thumbnail_image'])
+        self.assertEqual(response.status_code, 200)
+
+        user.delete()
+
+    def test_list_bounded_by_page(self):
+        user = User.objects.create_user('test_user_name')
+        AccountPlanAssignement.objects.create(user=user, account_plan_id=AccountPlan.PREMIUM_ID)
+        Image.objects.bulk_create([Image(uploader=user, image_file='legacy.jpg') for _ in range(50)])
+        image = Image.objects.create(uploader=user, image_file=File(open('static/test_image.jpg', 'rb')))
+
+        self.client.force_login(user)
+        # session, user and one page of thumbnails, however many images the user has
+        with self.assertNumQueries(3):
+            response = self.client.get(reverse('thumbnails'), {'page_size': 1})
+        self.assertEqual(response.data['results'][0]['thumbnail_image'].split('/')[-2], str(image.pk))
+
+        # images from before the change get their rows from the backfill, which renders nothing in lazy mode
+        call_command('backfill_thumbnails', stdout=StringIO())
+        self.assertEqual(Thumbnail.objects.filter(original_image__uploader=user, cached=True).count(), 102)
+        self.assertEqual(os.listdir(self.cache_location), [])
+
+        user.delete()
+
+    def test_not_in_plan(self):
+        user = User.objects.create_user('test_user_name')
+        AccountPlanAssignement.objects.create(user=user, account_plan_id=AccountPlan.BASIC_ID)
+        image = Image.objects.create(
+            uploader=user, image_file=File(open('static/test_image.jpg', 'rb'))
+        )
+
+        self.client.force_login(user)
+        response = self.client.get(reverse('thumbnail-content', kwargs={'image': image.id, 'thumbnail_size': 1}))
+        self.assertEqual(response.status_code, 404)
+        response = self.client.get(reverse('thumbnail-content', kwargs={'image': image.id, 'thumbnail_size': 2}))
+        self.assertEqual(response.status_code, 200)
+
+        user.delete()
+
+    def test_eviction(self):
+        cache = ThumbnailDiskCache(self.cache_location, 250)
+        cache.set('first.jpg', b'1' * 100)
+        cache.set('second.jpg', b'2' * 100)
+        os.utime(cache.path('first.jpg'), (1, 1))
+        os.utime(cache.path('second.jpg'), (2, 2))
+        cache.get('first.jpg')
+
+        cache.set('third.jpg', b'3' * 100)
+        self.assertIsNone(cache.get('second.jpg'))
+        self.assertIsNotNone(cache.get('first.jpg'))
+        self.assertIsNotNone(cache.get('third.jpg'))
+
+    def test_shared_location(self):
+        # two processes writing to the same directory keep it under one MAX_SIZE, not one each
+        cache, other = ThumbnailDiskCache(self.cache_location, 250), ThumbnailDiskCache(self.cache_location, 250)
+        other.set('first.jpg', b'1' * 50)
+        cache.set('second.jpg', b'2' * 100)
+        cache.set('third.jpg', b'3' * 100)
+        os.utime(other.path('first.jpg'), (1, 1))
+        other.set('fourth.jpg', b'4' * 100)
+        self.assertLessEqual(sum(size for _, size, _ in cache.entries()), 250)
+        self.assertIsNone(cache.get('first.jpg'))
+
+
+@override_settings(THUMBNAIL_JOBS=EAGER_THUMBNAIL_JOBS)
+class TestNearDuplicates(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('test_user_name')
+        AccountPlanAssignement.objects.create(user=self.user, account_plan_id=AccountPlan.PREMIUM_ID)
+        self.client.force_login(self.user)
+        self.original = ImageObject.open('static/test_image.jpg')
+        # indexes outlive the test, the primary keys they hold do not
+        self.addCleanup(_indexes.clear)
+
+    def tearDown(self):
+        self.user.delete()
+
+    def upload(self, img, quality=90):
+        content = BytesIO()
+        img.convert('RGB').save(content, 'JPEG', quality=quality)
+        response = self.client.post(reverse('image'), data={
+            'image_file': SimpleUploadedFile('image.jpg', content.getvalue())
+        })
+        return Image.objects.get(pk=response.data['id'])
+
+    def test_bk_tree(self):
+        random = Random(7)
+        hashes = [random.getrandbits(64) for _ in range(500)]
+        tree = BKTree()
+        for pk, dhash in enumerate(hashes):
+            tree.add(dhash, pk)
+        for dhash in hashes[:20]:
+            for max_distance in (0, 5, 20):
+                self.assertEqual(sorted(tree.search(dhash, max_distance)), sorted(
+                    (hamming_distance(dhash, other), pk) for pk, other in enumerate(hashes)
+                    if hamming_distance(dhash, other) <= max_distance
+                ))
+
+    def test_similar(self):
+        original = self.upload(self.original)
+        copy = self.upload(self.original.resize((300, 300)), quality=40)
+        unrelated = self.upload(ImageObject.linear_gradient('L').rotate(90).resize((500, 400)))
+        self.assertIsNotNone(original.dhash)
+        with original.image_file.storage.open(original.image_file.name) as content:
+            self.assertEqual(to_unsigned(original.dhash), compute_dhash(content))
+
+        response = self.client.get(reverse('image-similar', kwargs={'pk': original.pk}))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([result['id'] for result in response.data], [copy.pk])
+        self.assertLessEqual(response.data[0]['distance'], 2)
+        self.assertEqual(len(response.data[0]['dhash']), 16)
+
+        duplicate = self.upload(self.original.resize((300, 300)), quality=40)
+        self.assertEqual(duplicate.dhash, copy.dhash)
+        response = self.client.get(reverse('image-similar', kwargs={'pk': original.pk}), {'distance': 0})
+        self.assertEqual(response.data, [])
+        response = self.client.get(reverse('image-similar', kwargs={'pk': copy.pk}))
+        self.assertEqual([result['id'] for result in response.data], [duplicate.pk, original.pk])
+
+        duplicate.delete()
+        response = self.client.get(reverse('image-similar', kwargs={'pk': unrelated.pk}), {'distance': 10})
+        self.assertEqual(response.data, [])
+        response = self.client.get(reverse('image-similar', kwargs={'pk': copy.pk}))
+        self.assertEqual([result['id'] for result in response.data], [original.pk])
+        self.assertEqual(self.client.get(
+            reverse('image-similar', kwargs={'pk': copy.pk}), {'distance': 65}
+        ).status_code, 400)
+
+    def test_background_rebuild(self):
+        original = self.upload(self.original)
+        copy = self.upload(self.original.resize((300, 300)), quality=40)
+        index = get_dhash_index(self.user)
+        index.time_built -= settings.NEAR_DUPLICATES['REBUILD_INTERVAL'] + 1
+        Image.objects.filter(pk=copy.pk).update(dhash=None)
+
+        # the stale index keeps answering while the new one is built off the request
+        with mock.patch('api.similarity.threading.Thread') as thread:
+            self.assertIs(get_dhash_index(self.user), index)
+            self.assertIs(get_dhash_index(self.user), index)
+        thread.assert_called_once()
+        self.assertEqual([pk for _, pk in index.search(original.dhash, 6)], [original.pk, copy.pk])
+
+        rebuilt = rebuild_dhash_index(self.user.pk)
+        self.assertIs(get_dhash_index(self.user), rebuilt)
+        self.assertEqual([pk for _, pk in rebuilt.search(original.dhash, 6)], [original.pk])
+
+
+@override_settings(THUMBNAIL_JOBS=EAGER_THUMBNAIL_JOBS)
+class TestSprites(TestCase):
+    def setUp(self):
+        self.cache_location = tempfile.mkdtemp()
+        self.settings_override = override_settings(
+            THUMBNAIL_CACHE={'LOCATION': self.cache_location, 'MAX_SIZE': 1024 ** 2}
+        )
+        self.settings_override.enable()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.cache_location)
+
+    def test_sprite(self):
+        user = User.objects.create_user('test_user_name')
+        AccountPlanAssignement.objects.create(user=user, account_plan_id=AccountPlan.PREMIUM_ID)
+        images = [
+            Image.objects.create(uploader=user, image_file=File(open('static/test_image.jpg', 'rb')))
+            for _ in range(3)
+        ]
+        size = AccountPlan.objects.get(pk=AccountPlan.PREMIUM_ID).thumbnail_sizes.order_by('height').first()
+        self.client.force_login(user)
+
+        response = self.client.get(reverse('thumbnail-sprite'), {'thumbnail_size': size.pk, 'page_size': 2})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(list(response.data['offsets']), [str(images[2].pk), str(images[1].pk)])
+        self.assertIsNotNone(response.data['next'])
+
+        response = self.client.get(reverse('thumbnail-sprite'), {
+            'thumbnail_size': size.pk, 'images': ','.join(str(image.pk) for image in images)
+        })
+        offsets = response.data['offsets']
+        self.assertEqual(len(offsets), 3)
+        thumbnail = ImageObject.open(images[0].thumbnails.get(thumbnail_size=size).open_content())
+        self.assertEqual(offsets[str(images[0].pk)][2:], list(thumbnail.size))
+        for x, y, width, height in offsets.values():
+            self.assertLessEqual(x + width, response.data['width'])
+            self.assertLessEqual(y + height, response.data['height'])
+
+        sprite_response = self.client.get(response.data['url'])
+        self.assertEqual(sprite_response['Content-Type'], 'image/jpeg')
+        self.assertIn('immutable', sprite_response['Cache-Control'])
+        sprite = ImageObject.open(BytesIO(b''.join(sprite_response.streaming_content)))
+        self.assertEqual(sprite.size, (response.data['width'], response.data['height']))
+
+        other = User.objects.create_user('test_user_name2')
+        self.client.force_login(other)
+        self.assertEqual(self.client.get(response.data['url']).status_code, 404)
+        forged_key = response.data['key'].replace(f'{user.pk}-', f'{other.pk}-', 1)
+        self.assertEqual(self.client.get(reverse('thumbnail-sprite-content', args=[forged_key])).status_code, 404)
+        other.delete()
+        self.client.force_login(user)
+
+        with DecodeCounter() as counter:
+            cached = self.client.get(reverse('thumbnail-sprite'), {
+                'thumbnail_size': size.pk, 'images': ','.join(str(image.pk) for image in images)
+            })
+        self.assertEqual(counter.count, 0)
+        self.assertEqual(cached.data['url'], response.data['url'])
+
+        with self.settings(THUMBNAIL_MATERIALIZATION='lazy'):
+            image = Image.objects.create(uploader=user, image_file=File(open('static/test_image.jpg', 'rb')))
+            response = self.client.get(reverse('thumbnail-sprite'), {'thumbnail_size': size.pk})
+        self.assertEqual(len(response.data['offsets']), 4)
+        self.assertIn(str(image.pk), response.data['offsets'])
+        self.assertNotEqual(response.data['url'], cached.data['url'])
+
+        user.delete()
+
+    def test_not_in_plan(self):
+        user = User.objects.create_user('test_user_name')
+        AccountPlanAssignement.objects.create(user=user, account_plan_id=AccountPlan.BASIC_ID)
+        size = AccountPlan.objects.get(pk=AccountPlan.ENTERPRISE_ID).thumbnail_sizes.order_by('-height').first()
+        self.client.force_login(user)
+
+        response = self.client.get(reverse('thumbnail-sprite'), {'thumbnail_size': size.pk})
+        self.assertEqual(response.status_code, 404)
+        response = self.client.get(reverse('thumbnail-sprite'), {
+            'thumbnail_size': AccountPlan.objects.get(pk=AccountPlan.BASIC_ID).thumbnail_sizes.first().pk,
+            'images': 'a,b'
+        })
+        self.assertEqual(response.status_code, 400)
+
+        user.delete()
+
+
+class TestBulkUpload(TestCase):
+    def setUp(self):
+        # every file counts against the upload rate of the plan, the counts are kept per user id
+        self.addCleanup(cache.clear)
+
+    def test_multipart(self):
+        user = User.objects.create_user('test_user_name')
+        AccountPlanAssignement.objects.create(user=user, account_plan_id=AccountPlan.PREMIUM_ID)
+
+        self.client.force_login(user)
+        with open('static/test_image.jpg', 'rb') as f:
+            content = f.read()
+        files = [SimpleUploadedFile(f'{i}.jpg', content) for i in range(20)]
+        # session, user, plan assignment, plan, sizes, a reference claim per file (and the savepoint and insert of
+        # the first), then per batch one savepoint, images, jobs and release, plus the pk lookup on databases
+        # without INSERT ... RETURNING
+        queries = 32 if connection.features.can_return_rows_from_bulk_insert else 33
+        with self.assertNumQueries(queries):
+            response = self.client.post(reverse('image-bulk'), data={
+                'image_files': files + [SimpleUploadedFile('broken.jpg', b'not an image')]
+            })
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(len(response.data), 21)
+        self.assertEqual([result['name'] for result in response.data if 'error' in result], ['broken.jpg'])
+        self.assertEqual(Image.objects.filter(uploader=user).count(), 20)
+        self.assertEqual(ThumbnailJob.objects.filter(image__uploader=user).count(), 20)
+
+        user.delete()
+
+    @override_settings(THUMBNAIL_JOBS=EAGER_THUMBNAIL_JOBS, BULK_UPLOAD={'BATCH_SIZE': 2})
+    def test_zip(self):
+        user = User.objects.create_user('test_user_name')
+        AccountPlanAssignement.objects.create(user=user, account_plan_id=AccountPlan.PREMIUM_ID)
+        archive = BytesIO()
+        with zipfile.ZipFile(archive, 'w') as zip_file:
+            for i in range(3):
+                zip_file.write('static/test_image.jpg', f'photos/{i}.jpg')
+
+        self.client.force_login(user)
+        response = self.client.post(reverse('image-bulk'), data={
+            'archive': SimpleUploadedFile('photos.zip', archive.getvalue())
+        })
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual([result['processing_status'] for result in response.data], [Image.PROCESSING_DONE] * 3)
+        self.assertEqual(Thumbnail.objects.filter(original_image__uploader=user).count(), 6)
+
+        user.delete()
+
+    @override_settings(THUMBNAIL_JOBS=EAGER_THUMBNAIL_JOBS, BULK_UPLOAD={'BATCH_SIZE': 2})
+    def test_undecodable(self):
+        user = User.objects.create_user('test_user_name')
+        AccountPlanAssignement.objects.create(user=user, account_plan_id=AccountPlan.PREMIUM_ID)
+        with open('static/test_image.jpg', 'rb') as f:
+            content = f.read()
+        truncated = content[:len(content) * 2 // 3]
+
+        self.client.force_login(user)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse('image-bulk'), data={'image_files': [
+                SimpleUploadedFile('0.jpg', content), SimpleUploadedFile('truncated.jpg', truncated),
+                SimpleUploadedFile('1.jpg', content),
+            ]})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data[1], {'name': 'truncated.jpg', 'error': 'image could not be decoded'})
+        self.assertEqual([result['processing_status'] for result in response.data if 'id' in result], [
+            Image.PROCESSING_DONE, Image.PROCESSING_DONE
+        ])
+        self.assertEqual(Image.objects.filter(uploader=user).count(), 2)
+        # the reference taken for the broken file was released and the file deleted
+        self.assertFalse(StoredFile.objects.filter(sha256=hashlib.sha256(truncated).hexdigest()).exists())
+
+        user.delete()
+
+
+@override_settings(THUMBNAIL_JOBS=EAGER_THUMBNAIL_JOBS)
+class TestListQueries(TestCase):
+    def create_images(self, user, count):
+        for _ in range(count):
+            Image.objects.create(
+                uploader=user, image_file=File(open('static/test_image.jpg', 'rb'))
+            )
+
+    def test_images(self):
+        user = User.objects.create_user('test_user_name')
+        AccountPlanAssignement.objects.create(user=user, account_plan_id=AccountPlan.ENTERPRISE_ID)
+        self.client.force_login(user)
+
+        for count in (1, 5):
+            self.create_images(user, count)
+            # session, user, images, prefetched thumbnails and their sizes, the plan comes from the plan cache
+            with self.assertNumQueries(5):
+                response = self.client.get(reverse('image'))
+            self.assertEqual(response.status_code, 200)
+
+        user.delete()
+
+    def test_thumbnails(self):
+        user = User.objects.create_user('test_user_name')
+        AccountPlanAssignement.objects.create(user=user, account_plan_id=AccountPlan.ENTERPRISE_ID)
+        self.client.force_login(user)
+
+        for count in (1, 5):
+            self.create_images(user, count)
+            # session, user and thumbnails joined with their sizes, the page size comes from the plan cache
+            with self.assertNumQueries(3):
+                response = self.client.get(reverse('thumbnails'))
+            self.assertEqual(response.status_code, 200)
+
+        user.delete()
+
+
+class TestPlanCache(TestCase):
+    def setUp(self):
+        plan_cache.invalidate()
+        self.addCleanup(plan_cache.invalidate)
+
+    def test_cached(self):
+        user = User.objects.create_user('test_user_name')
+        AccountPlanAssignement.objects.create(user=user, account_plan_id=AccountPlan.ENTERPRISE_ID)
+        get_account_plan(user)
+
+        user = User.objects.get(pk=user.pk)
+        with self.assertNumQueries(0):
+            account_plan = get_account_plan(user)
+            self.assertEqual(account_plan.pk, AccountPlan.ENTERPRISE_ID)
+            self.assertEqual(len(account_plan.thumbnail_sizes.all()), 2)
+
+        user.delete()
+
+    def test_invalidation(self):
+        user = User.objects.create_user('test_user_name')
+        AccountPlanAssignement.objects.create(user=user, account_plan_id=AccountPlan.BASIC_ID)
+        self.assertFalse(get_account_plan(user).can_create_expirable_links)
+
+        account_plan = AccountPlan.objects.get(pk=AccountPlan.BASIC_ID)
+        account_plan.can_create_expirable_links = True
+        account_plan.save()
+        self.assertTrue(get_account_plan(user).can_create_expirable_links)
+
+        size = ThumbnailSize.objects.create(width=50, height=50)
+        account_plan.thumbnail_sizes.add(size)
+        self.assertIn(size, get_account_plan(user).thumbnail_sizes.all())
+
+        AccountPlanAssignement.objects.filter(user=user).delete()
+        AccountPlanAssignement.objects.create(user=user, account_plan_id=AccountPlan.ENTERPRISE_ID)
+        self.assertEqual(get_account_plan(User.objects.get(pk=user.pk)).pk, AccountPlan.ENTERPRISE_ID)
+
+        user.delete()
+
+    def test_shared_version(self):
+        with self.settings(PLAN_CACHE=dict(settings.PLAN_CACHE, SHARED_CACHE='default')):
+            other = VersionedCache('account-plans')
+            other.set('key', 'value')
+            self.assertEqual(other.get('key'), 'value')
+            plan_cache.invalidate()
+            self.assertIsNone(other.get('key'))
+
+            other.set(('assignement', 1), 1)
+            other.set(('assignement', 2), 2)
+            plan_cache.invalidate_key(('assignement', 1))
+            self.assertIsNone(other.get(('assignement', 1)))
+            self.assertEqual(other.get(('assignement', 2)), 2)
+
+    def test_local_timeout(self):
+        other = VersionedCache('account-plans')
+        other.set(('account_plan', AccountPlan.BASIC_ID), 'value')
+        # saved through the cache of this process, the other one only finds out by its entry expiring
+        AccountPlan.objects.get(pk=AccountPlan.BASIC_ID).save()
+        self.assertEqual(other.get(('account_plan', AccountPlan.BASIC_ID)), 'value')
+
+        expired = time.monotonic() + settings.PLAN_CACHE['LOCAL_TIMEOUT'] + 1
+        with mock.patch('api.caching.time.monotonic', return_value=expired):
+            self.assertIsNone(other.get(('account_plan', AccountPlan.BASIC_ID)))
+
+    def test_signup_keeps_plans(self):
+        user = User.objects.create_user('test_user_name')
+        get_account_plan(user)
+        other = User.objects.create_user('test_user_name2')
+        get_account_plan(other)
+
+        # the assignment created for the second user left the first user's entries alone
+        with self.assertNumQueries(0):
+            self.assertEqual(get_account_plan(User(pk=user.pk)).pk, AccountPlan.BASIC_ID)
+
+        user.delete()
+        other.delete()
+
+
+@override_settings(LIST_CACHE=dict(settings.LIST_CACHE, CACHE='default'))
+class TestListCache(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('test_user_name')
+        AccountPlanAssignement.objects.create(user=self.user, account_plan_id=AccountPlan.ENTERPRISE_ID)
+        self.image = Image.objects.create(uploader=self.user, image_file=File(open('static/test_image.jpg', 'rb')))
+        self.client.force_login(self.user)
+
+    def tearDown(self):
+        self.user.delete()
+
+    def test_not_modified(self):
+        for name in ('image', 'thumbnails', 'expirable-link'):
+            response = self.client.get(reverse(name))
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(response['ETag'].startswith('W/"'))
+
+            # only the session and the user are read, the payload and its tag come from the cache
+            with self.assertNumQueries(2):
+                cached = self.client.get(reverse(name))
+            self.assertEqual(cached.json(), response.json())
+            self.assertEqual(cached['ETag'], response['ETag'])
+            with self.assertNumQueries(2):
+                response = self.client.get(reverse(name), HTTP_IF_NONE_MATCH=response['ETag'])
+            self.assertEqual(response.status_code, 304)
+
+    def test_invalidated(self):
+        etag = self.client.get(reverse('image'))['ETag']
+        self.image.set_processing_status(Image.PROCESSING_FAILED)
+        response = self.client.get(reverse('image'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['results'][0]['processing_status'], Image.PROCESSING_FAILED)
+
+        etag = self.client.get(reverse('expirable-link'))['ETag']
+        ExpirableLink.objects.create(image=self.image, experation_period=timedelta(seconds=300))
+        response = self.client.get(reverse('expirable-link'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(len(response.data['results']), 1)
+
+        etag = self.client.get(reverse('image'))['ETag']
+        self.image.delete()
+        response = self.client.get(reverse('image'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(len(response.data['results']), 0)
+
+    def test_other_users(self):
+        etag = self.client.get(reverse('expirable-link'))['ETag']
+        user = User.objects.create_user('test_user_name2')
+        image = Image.objects.create(uploader=user, image_file=File(open('static/test_image.jpg', 'rb')))
+        ExpirableLink.objects.create(image=image, experation_period=timedelta(seconds=300))
+
+        response = self.client.get(reverse('expirable-link'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        cache.clear()
+        response = self.client.get(reverse('expirable-link'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        user.delete()
+
+
+class TestPagination(TestCase):
+    def test_cursor(self):
+        user = User.objects.create_user('test_user_name')
+        AccountPlanAssignement.objects.create(user=user, account_plan_id=AccountPlan.ENTERPRISE_ID)
+        images = [
+            Image.objects.create(uploader=user, image_file=File(open('static/test_image.jpg', 'rb')))
+            for _ in range(5)
+        ]
+
+        self.client.force_login(user)
+        ids = []
+        response = self.client.get(reverse('image'), {'page_size': 2})
+        while True:
+            self.assertLessEqual(len(response.data['results']), 2)
+            ids += [image['id'] for image in response.data['results']]
+            if not response.data['next']:
+                break
+            response = self.client.get(response.data['next'])
+        self.assertEqual(ids, [image.id for image in reversed(images)])
+
+        response = self.client.get(reverse('image'), {'page_size': 2, 'ordering': 'uploaded'})
+        self.assertEqual([image['id'] for image in response.data['results']], [images[0].id, images[1].id])
+
+        user.delete()
+
+    def test_equal_values(self):
+        user = User.objects.create_user('test_user_name')
+        AccountPlanAssignement.objects.create(user=user, account_plan_id=AccountPlan.ENTERPRISE_ID)
+        # more ties than the offset cutoff of DRF's cursor
+        Image.objects.bulk_create([
+            Image(uploader=user, image_file='legacy.jpg', width=100 if i % 5 else 50) for i in range(1500)
+        ])
+        expected = list(Image.objects.filter(uploader=user).order_by('width', 'pk').values_list('pk', flat=True))
+
+        self.client.force_login(user)
+        ids = []
+        response = self.client.get(reverse('image'), {'ordering': 'width', 'page_size': 400})
+        while True:
+            ids += [image['id'] for image in response.data['results']]
+            if not response.data['next']:
+                break
+            response = self.client.get(response.data['next'])
+        self.assertEqual(ids, expected)
+
+        response = self.client.get(response.data['previous'])
+        self.assertEqual([image['id'] for image in response.data['results']], expected[800:1200])
+
+        user.delete()
+
+    def test_plan_cap(self):
+        user = User.objects.create_user('test_user_name')
+        AccountPlanAssignement.objects.create(user=user, account_plan_id=AccountPlan.BASIC_ID)
+        account_plan = AccountPlan.objects.get(pk=AccountPlan.BASIC_ID)
+        account_plan.max_page_size = 3
+        account_plan.save()
+        self.addCleanup(plan_cache.invalidate)
+        for _ in range(5):
+            Image.objects.create(uploader=user, image_file=File(open('static/test_image.jpg', 'rb')))
+
+        self.client.force_login(user)
+        response = self.client.get(reverse('image'), {'page_size': 100})
+        self.assertEqual(len(response.data['results']), 3)
+        self.assertIsNotNone(response.data['next'])
+
+        user.delete()
+
+
+@override_settings(THUMBNAIL_JOBS=EAGER_THUMBNAIL_JOBS)
+class TestDeduplication(TestCase):
+    def upload(self):
+        with open('static/test_image.jpg', 'rb') as f:
+            response = self.client.post(reverse('image'), data={'image_file': f})
+        return Image.objects.get(pk=response.data['id'])
+
+    def test_shared_files(self):
+        user = User.objects.create_user('test_user_name')
+        AccountPlanAssignement.objects.create(user=user, account_plan_id=AccountPlan.PREMIUM_ID)
+        self.client.force_login(user)
+
+        first = self.upload()
+        with DecodeCounter() as counter:
+            second = self.upload()
+        self.assertEqual(counter.count, 0)
+
+        self.assertEqual(first.image_file.name, second.image_file.name)
+        self.assertEqual(first.sha256, second.sha256)
+        self.assertEqual(StoredFile.objects.get(name=first.image_file.name).reference_count, 2)
+        self.assertEqual(
+            set(first.thumbnails.values_list('thumbnail_image', flat=True)),
+            set(second.thumbnails.values_list('thumbnail_image', flat=True))
+        )
+
+        user.delete()
+
+    def test_release(self):
+        user = User.objects.create_user('test_user_name')
+        AccountPlanAssignement.objects.create(user=user, account_plan_id=AccountPlan.PREMIUM_ID)
+        self.client.force_login(user)
+
+        first = self.upload()
+        second = self.upload()
+        storage = first.image_file.storage
+        names = [first.image_file.name] + list(first.thumbnails.values_list('thumbnail_image', flat=True))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            first.delete()
+        self.assertTrue(all(storage.exists(name) for name in names))
+        self.assertEqual(StoredFile.objects.get(name=second.image_file.name).reference_count, 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            second.delete()
+        self.assertFalse(any(storage.exists(name) for name in names))
+        self.assertFalse(StoredFile.objects.filter(name__in=names).exists())
+
+        user.delete()
+
+    def test_reupload_during_release(self):
+        user = User.objects.create_user('test_user_name')
+        AccountPlanAssignement.objects.create(user=user, account_plan_id=AccountPlan.PREMIUM_ID)
+        self.client.force_login(user)
+
+        first = self.upload()
+        storage = first.image_file.storage
+        with self.captureOnCommitCallbacks() as callbacks:
+            first.delete()
+        # the same content comes in before the release's delete runs
+        second = self.upload()
+        for callback in callbacks:
+            callback()
+        self.assertTrue(storage.exists(second.image_file.name))
+        self.assertEqual(StoredFile.objects.get(name=second.image_file.name).reference_count, 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            second.delete()
+        self.assertFalse(storage.exists(second.image_file.name))
+
+        user.delete()
+
+
+@override_settings(THUMBNAIL_JOBS=EAGER_THUMBNAIL_JOBS)
+class TestMediaSharding(TestCase):
+    def upload(self):
+        with open('static/test_image.jpg', 'rb') as f:
+            response = self.client.post(reverse('image'), data={'image_file': f})
+        return Image.objects.get(pk=response.data['id'])
+
+    def get_names(self, image):
+        return [image.image_file.name] + list(image.thumbnails.values_list('thumbnail_image', flat=True))
+
+    def test_sharded_names(self):
+        self.assertEqual(shard_name('a/b.jpg', 2, 2), shard_name(shard_name('a/b.jpg', 2, 2), 2, 2))
+        self.assertRegex(shard_name('b.jpg', 2, 2), r'^[0-9a-f]{2}/[0-9a-f]{2}/b\.jpg$')
+
+        user = User.objects.create_user('test_user_name')
+        AccountPlanAssignement.objects.create(user=user, account_plan_id=AccountPlan.PREMIUM_ID)
+        self.client.force_login(user)
+        image = self.upload()
+        for name in self.get_names(image):
+            self.assertEqual(shard_name(name), name)
+            self.assertTrue(image.image_file.storage.exists(name))
+
+        user.delete()
+
+    def test_relocate(self):
+        user = User.objects.create_user('test_user_name')
+        AccountPlanAssignement.objects.create(user=user, account_plan_id=AccountPlan.PREMIUM_ID)
+        self.client.force_login(user)
+        with self.settings(MEDIA_SHARDING=dict(settings.MEDIA_SHARDING, DEPTH=0)):
+            image = self.upload()
+        storage = image.image_file.storage
+        flat_names = self.get_names(image)
+        self.assertTrue(all('/' not in name for name in flat_names))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('relocate_media', batch_size=1, stdout=StringIO())
+        image.refresh_from_db()
+        names = self.get_names(image)
+        self.assertEqual(names, [shard_name(name) for name in flat_names])
+        self.assertTrue(all(storage.exists(name) for name in names))
+        self.assertFalse(any(storage.exists(name) for name in flat_names))
+        self.assertEqual(set(StoredFile.objects.values_list('name', flat=True)), set(names))
+
+        thumbnail = image.thumbnails.first()
+        response = self.client.get(thumbnail.get_content_url())
+        self.assertEqual(b''.join(response.streaming_content), storage.open(thumbnail.thumbnail_image.name).read())
+
+        out = StringIO()
+        call_command('relocate_media', stdout=out)
+        self.assertIn('0 files relocated', out.getvalue())
+
+        with self.captureOnCommitCallbacks(execute=True):
+            user.delete()
+
+    @override_settings(TEMPORARY_LINKS=dict(settings.TEMPORARY_LINKS, FORMAT=ExpirableLink.FORMAT_SIGNED))
+    def test_relocate_legacy(self):
+        cache.clear()
+        user = User.objects.create_user('test_user_name')
+        storage = Image._meta.get_field('image_file').storage
+        with open('static/test_image.jpg', 'rb') as f:
+            legacy_name = storage.save('legacy.jpg', File(f))
+        # stored before StoredFile rows existed, so nothing tracks the file
+        Image.objects.bulk_create([Image(uploader=user, image_file=legacy_name)])
+        image = Image.objects.get(uploader=user)
+        temporary_link = ExpirableLink.objects.create(
+            image=image, experation_period=timedelta(seconds=4000)
+        ).generate_temporary_link()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('relocate_media', stdout=StringIO())
+        image.refresh_from_db()
+        self.assertEqual(image.image_file.name, shard_name(legacy_name))
+        self.assertTrue(storage.exists(image.image_file.name))
+        self.assertFalse(storage.exists(legacy_name))
+        self.assertEqual(StoredFile.objects.get(name=image.image_file.name).reference_count, 1)
+
+        # links signed before the move still resolve
+        response = self.client.get(temporary_link)
+        self.assertEqual(response.status_code, 200)
+        response.close()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            user.delete()
+        self.assertFalse(storage.exists(image.image_file.name))
+
+
+@override_settings(THUMBNAIL_JOBS=EAGER_THUMBNAIL_JOBS)
+class TestAdmission(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(plan_cache.invalidate)
+        self.user = User.objects.create_user('test_user_name')
+        AccountPlanAssignement.objects.create(user=self.user, account_plan_id=AccountPlan.ENTERPRISE_ID)
+        self.client.force_login(self.user)
+
+    def tearDown(self):
+        self.user.delete()
+
+    def upload(self):
+        with open('static/test_image.jpg', 'rb') as f:
+            return self.client.post(reverse('image'), data={'image_file': f})
+
+    def hold_render_slot(self):
+        held, release = threading.Event(), threading.Event()
+
+        def hold():
+            with render_admission.admit():
+                held.set()
+                release.wait()
+
+        thread = threading.Thread(target=hold)
+        thread.start()
+        held.wait()
+        self.addCleanup(thread.join)
+        self.addCleanup(release.set)
+        return release
+
+    def test_plan_rate(self):
+        AccountPlan.objects.filter(pk=AccountPlan.ENTERPRISE_ID).update(upload_rate='1/min')
+        plan_cache.invalidate()
+
+        self.assertEqual(self.upload().status_code, 201)
+        response = self.upload()
+        self.assertEqual(response.status_code, 429)
+        self.assertIn('Retry-After', response)
+        # reads aren't counted
+        self.assertEqual(self.client.get(reverse('image')).status_code, 200)
+        self.assertIn(
+            'throttled_requests_total{plan="Enterprise"}', self.client.get(reverse('metrics')).content.decode()
+        )
+
+    def test_bulk_weight(self):
+        AccountPlan.objects.filter(pk=AccountPlan.ENTERPRISE_ID).update(upload_rate='3/min')
+        plan_cache.invalidate()
+        with open('static/test_image.jpg', 'rb') as f:
+            content = f.read()
+
+        response = self.client.post(reverse('image-bulk'), data={
+            'image_files': [SimpleUploadedFile(f'{i}.jpg', content) for i in range(2)]
+        })
+        self.assertEqual(response.status_code, 201)
+        # one slot is left, two files don't fit
+        response = self.client.post(reverse('image-bulk'), data={
+            'image_files': [SimpleUploadedFile(f'{i}.jpg', content) for i in range(2)]
+        })
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(self.upload().status_code, 201)
+
+    @override_settings(ADMISSION=dict(settings.ADMISSION, MAX_CONCURRENT_RENDERS=1, MAX_WAIT=0.01, RETRY_AFTER=3))
+    def test_render_capacity(self):
+        release = self.hold_render_slot()
+        response = self.upload()
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['Retry-After'], '3')
+        self.assertFalse(Image.objects.filter(uploader=self.user).exists())
+
+        release.set()
+        self.assertEqual(self.upload().status_code, 201)
+        metrics = self.client.get(reverse('metrics')).content.decode()
+        self.assertIn('render_admissions_total{outcome="rejected"}', metrics)
+        self.assertIn('render_admission_in_flight 0', metrics)
+
+    @override_settings(ADMISSION=dict(settings.ADMISSION, MAX_CONCURRENT_RENDERS=1, MAX_WAIT=0.01))
+    def test_lazy_render_capacity(self):
+        cache_location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_location)
+        with override_settings(
+            THUMBNAIL_MATERIALIZATION='lazy', THUMBNAIL_CACHE={'LOCATION': cache_location, 'MAX_SIZE': 1024 ** 2}
+        ):
+            self.assertEqual(self.upload().status_code, 201)
+            url = self.client.get(reverse('thumbnails')).data['results'][0]['thumbnail_image']
+            release = self.hold_render_slot()
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 429)
+            self.assertEqual(response['Retry-After'], str(settings.ADMISSION['RETRY_AFTER']))
+
+            release.set()
+            self.assertEqual(self.client.get(url).status_code, 200)
+
+
+class TestBenchmarks(TestCase):
+    def setUp(self):
+        self.addCleanup(plan_cache.invalidate)
+
+    def test_hot_paths(self):
+        results = bench_lists([10], repeat=1)
+        self.assertEqual(results['list.image.10']['queries'], 5)
+        self.assertEqual(results['list.thumbnails.10']['queries'], 3)
+        self.assertEqual(Thumbnail.objects.filter(original_image__uploader__username='list_10_0').count(), 20)
+
+        results = bench_temporary_links(repeat=1)
+        self.assertEqual(results['temporary_link.signed']['queries'], 0)
+
+
+class TestMetrics(TestCase):
+    @override_settings(THUMBNAIL_JOBS=EAGER_THUMBNAIL_JOBS)
+    def test_request_breakdown(self):
+        user = User.objects.create_user('test_user_name')
+        AccountPlanAssignement.objects.create(user=user, account_plan_id=AccountPlan.PREMIUM_ID)
+        self.client.force_login(user)
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+
+        with self.assertLogs('api.middleware', 'WARNING') as logs, self.settings(
+            MEDIA_ROOT=media_root, REQUEST_METRICS=dict(settings.REQUEST_METRICS, SLOW_REQUEST_THRESHOLD=0)
+        ):
+            response = self.client.post(reverse('image'), data={
+                'image_file': SimpleUploadedFile('test_image.jpg', open('static/test_image.jpg', 'rb').read())
+            })
+        self.assertEqual(response.status_code, 201)
+        self.assertIn("'decode'", logs.output[0])
+        self.assertIn("'save'", logs.output[0])
+
+        metrics = self.client.get(reverse('metrics')).content.decode()
+        self.assertIn('http_request_duration_seconds_count{view="image",method="POST",status="201"}', metrics)
+        self.assertIn('http_request_db_queries_bucket{view="image",le="+Inf"}', metrics)
+        for stage in ('decode', 'resize', 'encode'):
+            self.assertIn(f'thumbnail_render_stage_seconds_count{{stage="{stage}"}}', metrics)
+        self.assertIn('storage_io_bytes_sum{operation="save"}', metrics)
+        for stage in ('decode', 'resize', 'encode'):
+            self.assertIn(f'http_request_render_seconds_count{{view="image",stage="{stage}"}}', metrics)
+        self.assertIn('http_request_storage_bytes_count{view="image",operation="save"}', metrics)
+        self.assertIn('http_request_storage_seconds_count{view="image",operation="save"}', metrics)
 
         user.delete()
+
+    def test_histogram(self):
+        histogram = Histogram('test_seconds', 'Test histogram.', ['view'], buckets=(1, 2))
+        self.addCleanup(_registry.remove, histogram)
+        for value in (0.5, 1.5, 3):
+            histogram.observe(value, view='a')
+        self.assertEqual(histogram.collect()[2:], [
+            'test_seconds_bucket{view="a",le="1.0"} 1',
+            'test_seconds_bucket{view="a",le="2.0"} 2',
+            'test_seconds_bucket{view="a",le="+Inf"} 3',
+            'test_seconds_sum{view="a"} 5.0',
+            'test_seconds_count{view="a"} 3',
+        ])
@@ -0,0 +1,42 @@
+from django.conf import settings
+from django.core.cache import caches
+from rest_framework.permissions import SAFE_METHODS
+from rest_framework.throttling import SimpleRateThrottle
+
+from api.metrics import throttled_requests
+from api.models import get_account_plan
+from api.uploads import count_uploaded_files
+
+
+class AccountPlanRateThrottle(SimpleRateThrottle):
+    scope = 'uploads'
+
+    def __init__(self):
+        # the rate is the one of the plan of each request, not a setting, the counts are only shared
+        # by the processes that share THROTTLE_CACHE
+        self.cache = caches[settings.ADMISSION['THROTTLE_CACHE']]
+
+    def allow_request(self, request, view):
+        if request.method in SAFE_METHODS or not request.user.is_authenticated:
+            return True
+        account_plan = get_account_plan(request.user)
+        self.rate = account_plan.upload_rate
+        if not self.rate:
+            return True
+        self.num_requests, self.duration = self.parse_rate(self.rate)
+        self.weight = min(count_uploaded_files(request.FILES) or 1, self.num_requests)
+        allowed = super(AccountPlanRateThrottle, self).allow_request(request, view)
+        if not allowed:
+            throttled_requests.inc(plan=account_plan.name)
+        return allowed
+
+    def throttle_success(self):
+        # a bulk upload counts once per file, one with more files than the rate allows takes all of it
+        if len(self.history) + self.weight > self.num_requests:
+            return self.throttle_failure()
+        self.history[:0] = [self.now] * self.weight
+        self.cache.set(self.key, self.history, self.duration)
+        return True
+
+    def get_cache_key(self, request, view):
+        return self.cache_format % {'scope': self.scope, 'ident': request.user.pk}
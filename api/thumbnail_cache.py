@@ -0,0 +1,83 @@
+import os
+import tempfile
+import threading
+
+from django.conf import settings
+
+
+# eviction frees space down to this share of MAX_SIZE, so it does not run on every write
+LOW_WATERMARK = 0.9
+
+
+class ThumbnailDiskCache:
+    def __init__(self, location, max_size):
+        self.location = location
+        self.max_size = max_size
+        self._written = 0
+        self._lock = threading.Lock()
+
+    def path(self, name):
+        return os.path.join(self.location, name)
+
+    def get(self, name):
+        path = self.path(name)
+        try:
+            # the modification time is the recency used by eviction
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def set(self, name, content):
+        path = self.path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+
+        # every process sharing the location writes to it, so the size is stat'ed from the directory each time
+        # this one has written the space eviction frees, not counted in memory
+        with self._lock:
+            self._written += len(content)
+            if self._written < self.max_size * (1 - LOW_WATERMARK):
+                return path
+            self._written = 0
+        self.evict(int(self.max_size * LOW_WATERMARK))
+        return path
+
+    def entries(self):
+        for directory, _, filenames in os.walk(self.location):
+            for filename in filenames:
+                path = os.path.join(directory, filename)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                yield path, stat.st_size, stat.st_mtime
+
+    def evict(self, target_size):
+        entries = sorted(self.entries(), key=lambda entry: entry[2])
+        size = sum(entry[1] for entry in entries)
+        if size <= self.max_size:
+            return size
+        for path, entry_size, _ in entries:
+            if size <= target_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            size -= entry_size
+        return size
+
+
+_caches = {}
+
+
+def get_thumbnail_cache():
+    options = settings.THUMBNAIL_CACHE
+    key = (options['LOCATION'], options['MAX_SIZE'])
+    if key not in _caches:
+        _caches[key] = ThumbnailDiskCache(*key)
+    return _caches[key]
@@ -0,0 +1,62 @@
+import hashlib
+
+from django.conf import settings
+from django.core.exceptions import RequestDataTooBig
+from django.core.files.uploadhandler import MemoryFileUploadHandler, StopUpload, TemporaryFileUploadHandler
+
+
+CHUNK_SIZE = 64 * 2 ** 10
+
+
+def get_sha256(content):
+    sha256 = getattr(content, 'sha256', None)
+    if sha256:
+        return sha256
+
+    digest = hashlib.sha256()
+    content.seek(0)
+    for chunk in iter(lambda: content.read(CHUNK_SIZE), b''):
+        digest.update(chunk)
+    content.seek(0)
+    return digest.hexdigest()
+
+
+class HashingUploadHandlerMixin:
+    def new_file(self, *args, **kwargs):
+        self.sha256 = hashlib.sha256()
+        return super(HashingUploadHandlerMixin, self).new_file(*args, **kwargs)
+
+    def receive_data_chunk(self, raw_data, start):
+        data = super(HashingUploadHandlerMixin, self).receive_data_chunk(raw_data, start)
+        if data is None:
+            self.sha256.update(raw_data)
+        return data
+
+    def file_complete(self, file_size):
+        file = super(HashingUploadHandlerMixin, self).file_complete(file_size)
+        if file is not None:
+            file.sha256 = self.sha256.hexdigest()
+        return file
+
+
+class HashingMemoryFileUploadHandler(HashingUploadHandlerMixin, MemoryFileUploadHandler):
+    pass
+
+
+class HashingTemporaryFileUploadHandler(HashingUploadHandlerMixin, TemporaryFileUploadHandler):
+    def __init__(self, *args, **kwargs):
+        super(HashingTemporaryFileUploadHandler, self).__init__(*args, **kwargs)
+        self.too_large = False
+
+    def receive_data_chunk(self, raw_data, start):
+        # past the hard limit the upload stops without reading the rest of the body, the parser closes
+        # the files and upload_complete() turns the request down
+        if start + len(raw_data) > settings.IMAGE_UPLOADS['MAX_SIZE']:
+            self.too_large = True
+            raise StopUpload(connection_reset=True)
+        return super(HashingTemporaryFileUploadHandler, self).receive_data_chunk(raw_data, start)
+
+    def upload_complete(self):
+        if self.too_large:
+            raise RequestDataTooBig(f'upload is larger than {settings.IMAGE_UPLOADS["MAX_SIZE"]} bytes')
+        return super(HashingTemporaryFileUploadHandler, self).upload_complete()
@@ -0,0 +1,196 @@
+import zipfile
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import connection, transaction
+from PIL import Image as ImageObject
+
+from api.caching import invalidate_list_cache
+from api.metadata import get_image_extension, read_image_metadata
+from api.models import Image, StoredFile, Thumbnail, ThumbnailJob, get_account_plan
+from api.rendering import get_render_engine, to_signed
+from api.uploadhandlers import get_sha256
+
+
+def iter_uploaded_files(files):
+    for uploaded_file in files.getlist('image_files'):
+        yield uploaded_file.name, uploaded_file, uploaded_file.size
+    for archive in files.getlist('archive'):
+        try:
+            with zipfile.ZipFile(archive) as zip_file:
+                for info in zip_file.infolist():
+                    if info.is_dir():
+                        continue
+                    with zip_file.open(info) as member:
+                        yield info.filename, member, info.file_size
+        except zipfile.BadZipFile:
+            yield archive.name, None, 0
+
+
+def count_uploaded_files(files):
+    # only the central directory of an archive is read
+    count = len(files.getlist('image_files'))
+    for archive in files.getlist('archive'):
+        try:
+            with zipfile.ZipFile(archive) as zip_file:
+                count += sum(1 for info in zip_file.infolist() if not info.is_dir())
+        except zipfile.BadZipFile:
+            count += 1
+        archive.seek(0)
+    return count
+
+
+def validate_image(content, size, account_plan):
+    # only the header is parsed, so a decompression bomb is turned down before a single row is decoded
+    max_size = min(account_plan.max_upload_size, settings.IMAGE_UPLOADS['MAX_SIZE'])
+    if size > max_size:
+        raise ValidationError(f'image is larger than {max_size} bytes')
+    try:
+        metadata = read_image_metadata(content, size)
+    except ImageObject.DecompressionBombError:
+        raise ValidationError(f'image has more than {account_plan.max_image_pixels} pixels')
+    except Exception:
+        raise ValidationError('not a valid image')
+
+    image_format, width, height = metadata['image_format'], metadata['width'], metadata['height']
+    if image_format not in settings.IMAGE_UPLOADS['FORMATS']:
+        raise ValidationError(f'{image_format} images are not accepted')
+    if max(width, height) > account_plan.max_image_side:
+        raise ValidationError(f'image is larger than {account_plan.max_image_side} pixels on a side')
+    if width * height > account_plan.max_image_pixels:
+        raise ValidationError(f'image has more than {account_plan.max_image_pixels} pixels')
+    return metadata
+
+
+def batches(iterable, batch_size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class BulkUpload:
+    def __init__(self, user):
+        self.user = user
+        self.account_plan = get_account_plan(user)
+        self.sizes = list(self.account_plan.thumbnail_sizes.all())
+        self.storage = Image._meta.get_field('image_file').storage
+        self.eager = settings.THUMBNAIL_JOBS['EAGER']
+        self.lazy = settings.THUMBNAIL_MATERIALIZATION == Thumbnail.MATERIALIZATION_LAZY
+        self.results = []
+
+    def upload(self, files):
+        for batch in batches(self.store(files), settings.BULK_UPLOAD['BATCH_SIZE']):
+            self.create_batch(batch)
+        return self.results
+
+    def store(self, files):
+        for name, content, size in iter_uploaded_files(files):
+            try:
+                if content is None:
+                    raise ValidationError('not a valid zip archive')
+                metadata = validate_image(content, size, self.account_plan)
+                sha256 = get_sha256(content)
+                stored_name = StoredFile.store(
+                    self.storage, sha256, get_image_extension(metadata['image_format']), content
+                )
+            except ValidationError as e:
+                self.results.append({'name': name, 'error': e.messages[0]})
+                continue
+
+            yield name, stored_name, sha256, metadata
+
+    def create_batch(self, batch):
+        if self.lazy or not self.sizes:
+            processing_status = Image.PROCESSING_DONE
+        else:
+            processing_status = Image.PROCESSING_PENDING
+        failed = set()
+        try:
+            with transaction.atomic():
+                images = self.create_images([
+                    Image(
+                        uploader=self.user, image_file=stored_name, sha256=sha256,
+                        processing_status=processing_status, **metadata
+                    )
+                    for _, stored_name, sha256, metadata in batch
+                ])
+                if processing_status == Image.PROCESSING_PENDING and self.eager:
+                    failed = self.render(images)
+                    # deleting the rows releases the references store() took for them
+                    Image.objects.filter(pk__in=failed).delete()
+                elif processing_status == Image.PROCESSING_PENDING:
+                    ThumbnailJob.objects.bulk_create([ThumbnailJob(image=image) for image in images])
+                elif self.lazy:
+                    Thumbnail.create_cached(images, self.sizes)
+        except Exception:
+            # the references were taken outside the rolled back transaction
+            for _, stored_name, _, _ in batch:
+                StoredFile.release(self.storage, stored_name)
+            raise
+
+        invalidate_list_cache(self.user.pk)
+        for (name, _, _, _), image in zip(batch, images):
+            if image.pk in failed:
+                self.results.append({'name': name, 'error': 'image could not be decoded'})
+            else:
+                self.results.append({'name': name, 'id': image.pk, 'processing_status': image.processing_status})
+
+    def create_images(self, images):
+        Image.objects.bulk_create(images)
+        if not connection.features.can_return_rows_from_bulk_insert:
+            # without INSERT ... RETURNING read the keys back, such databases (SQLite) serialize writers,
+            # so the newest rows of the uploader in this transaction are the ones just inserted
+            pks = Image.objects.filter(uploader=self.user).order_by('-pk').values_list('pk', flat=True)
+            for image, pk in zip(images, reversed(pks[:len(images)])):
+                image.pk = pk
+        return images
+
+    def render(self, images):
+        shared = defaultdict(dict)
+        for sha256, size_id, *thumbnail in Thumbnail.objects.filter(
+            original_image__sha256__in={image.sha256 for image in images}, cached=False
+        ).values_list('original_image__sha256', 'thumbnail_size_id', 'thumbnail_image', 'encodings', 'width', 'height'):
+            shared[sha256][size_id] = tuple(thumbnail)
+
+        engine = get_render_engine()
+        futures = []
+        for image in images:
+            # read back from storage one at a time, the engine holds at most max_pending originals in memory
+            with self.storage.open(image.image_file.name, 'rb') as content:
+                source = content.read()
+            futures.append(engine.submit_ingest(source, {
+                (size.width, size.height): size.get_encodings()
+                for size in self.sizes if size.pk not in shared[image.sha256]
+            }))
+
+        thumbnails = []
+        shared_names = []
+        rendered_images = []
+        failed = set()
+        for image, future in zip(images, futures):
+            try:
+                rendered, dhash = future.result()
+            except Exception:
+                # passed the header check but the pixel data is broken
+                failed.add(image.pk)
+                continue
+            rendered_images.append(image)
+            for thumbnail in image.build_thumbnails(self.sizes, rendered, shared[image.sha256]):
+                if thumbnail.thumbnail_size_id in shared[image.sha256]:
+                    shared_names += thumbnail.get_stored_names()
+                thumbnails.append(thumbnail)
+            image.dhash = to_signed(dhash)
+            image.processing_status = Image.PROCESSING_DONE
+        thumbnails = Thumbnail.objects.bulk_create(thumbnails)
+        Image.objects.bulk_update(rendered_images, ['dhash'])
+        StoredFile.track(shared_names)
+        Image.objects.filter(pk__in=[image.pk for image in rendered_images]).update(
+            processing_status=Image.PROCESSING_DONE
+        )
+        return failed
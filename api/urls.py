@@ -1,6 +1,9 @@
+from django.conf import settings
 from django.urls import path
 
-from api.views import ExpirableLinkModelView, ImageModelView, ThumbnailModelView, expirable_link_content_view
+from api.views import ExpirableLinkModelView, ImageModelView, ThumbnailModelView, async_expirable_link_content_view, \
+    async_signed_link_content_view, expirable_link_content_view, metrics_view, signed_link_content_view, \
+    thumbnail_content_view, thumbnail_sprite_content_view
 
 
 urlpatterns = [
@@ -8,6 +11,23 @@ urlpatterns = [
         {'get': 'list', 'post': 'create'}
     ), name='expirable-link'),
     path('images/', ImageModelView.as_view({'get': 'list', 'post': 'create'}), name='image'),
+    path('images/bulk/', ImageModelView.as_view({'post': 'bulk'}), name='image-bulk'),
+    path('images/<int:pk>/similar/', ImageModelView.as_view({'get': 'similar'}), name='image-similar'),
     path('thumbnails/', ThumbnailModelView.as_view({'get': 'list'}), name='thumbnails'),
-    path('temporary_link/<slug:expirable_link>', expirable_link_content_view, name='temporary-link')
+    path('thumbnails/sprite/', ThumbnailModelView.as_view({'get': 'sprite'}), name='thumbnail-sprite'),
+    path(
+        'temporary_link/<slug:expirable_link>',
+        async_expirable_link_content_view if settings.ASYNC_VIEWS else expirable_link_content_view,
+        name='temporary-link'
+    ),
+    path(
+        'temporary_link/signed/<str:token>',
+        async_signed_link_content_view if settings.ASYNC_VIEWS else signed_link_content_view,
+        name='signed-temporary-link'
+    ),
+    path(
+        'thumbnail_content/<int:image>/<int:thumbnail_size>', thumbnail_content_view, name='thumbnail-content'
+    ),
+    path('thumbnail_sprites/<slug:key>', thumbnail_sprite_content_view, name='thumbnail-sprite-content'),
+    path('metrics', metrics_view, name='metrics'),
 ]
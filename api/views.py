@@ -1,36 +1,207 @@
-from django.db.models import F, ExpressionWrapper, DateTimeField
-from django.db.models.functions import Now
+import hashlib
+import json
+from contextlib import nullcontext
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.exceptions import PermissionDenied
+from django.urls import reverse
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.dateparse import parse_datetime
+from django.utils.timezone import is_naive, make_aware, now
 from django.views.decorators.http import require_GET
-from django.http import Http404, FileResponse
+from django.http import Http404, FileResponse, HttpResponse, HttpResponseNotAllowed
 
-from rest_framework import viewsets
+from rest_framework import status, viewsets
+from rest_framework.exceptions import ValidationError
 from rest_framework.permissions import IsAuthenticated
+from rest_framework.response import Response
+from rest_framework.utils.encoders import JSONEncoder
 
-from api.models import Image, ExpirableLink, Thumbnail
+from api.admission import RenderCapacityExceeded, render_admission
+from api.caching import get_list_cache, get_list_cache_key
+from api.metrics import render_metrics
+from api.models import Image, ExpirableLink, Thumbnail, get_account_plan
 from api.serializers import ExpirableLinkSerializer, ImageSerializer, ThumbnailSerializer
 from api.permissions import IsCreationOfExpirableLinkAllowedOrReadOnly
+from api.rendering import CONTENT_TYPES, FORMAT_JPEG
+from api.serving import negotiate_content_type, serve_file, serve_file_async
+from api.signing import unsign_temporary_link
+from api.similarity import find_near_duplicates
+from api.sprites import get_sprite, get_sprite_name, get_sprite_owner_id
+from api.thumbnail_cache import get_thumbnail_cache
+from api.throttling import AccountPlanRateThrottle
+from api.uploads import BulkUpload
+
+
+def parse_aware_datetime(value):
+    parsed = parse_datetime(value)
+    if parsed is not None and is_naive(parsed):
+        parsed = make_aware(parsed)
+    return parsed
+
+
+def too_many_requests(exc):
+    response = HttpResponse(exc.detail, status=status.HTTP_429_TOO_MANY_REQUESTS, content_type='text/plain')
+    response['Retry-After'] = str(exc.wait)
+    return response
+
+
+def get_list_etag(data):
+    return 'W/"{}"'.format(hashlib.md5(json.dumps(data, cls=JSONEncoder).encode()).hexdigest())
+
 
+class CachedListMixin:
+    def list(self, request, *args, **kwargs):
+        cache = get_list_cache()
+        if cache is None or not request.user.is_authenticated:
+            return self.list_uncached(request, *args, **kwargs)
 
-class ImageModelView(viewsets.ModelViewSet):
+        # urls in the payload are absolute and the renderer picks the body, so both are part of the key
+        variant = f'{self.basename}|{request.build_absolute_uri()}|{request.accepted_media_type}'
+        key = get_list_cache_key(cache, request.user.pk, variant)
+        entry = cache.get(key)
+        response = None
+        if entry is None:
+            response = self.list_uncached(request, *args, **kwargs)
+            if response.status_code != status.HTTP_200_OK:
+                return response
+            entry = (get_list_etag(response.data), response.data)
+            cache.set(key, entry, self.get_list_cache_timeout())
+        etag, data = entry
+        not_modified = get_conditional_response(request, etag=etag)
+        if not_modified is not None:
+            response = not_modified
+        elif response is None:
+            response = Response(data)
+        response['ETag'] = etag
+        patch_cache_control(response, private=True, no_cache=True)
+        return response
+
+    def list_uncached(self, request, *args, **kwargs):
+        return super(CachedListMixin, self).list(request, *args, **kwargs)
+
+    def get_list_cache_timeout(self):
+        return settings.LIST_CACHE['TIMEOUT']
+
+
+class ImageModelView(CachedListMixin, viewsets.ModelViewSet):
     queryset = Image.objects
     serializer_class = ImageSerializer
     permission_classes = [IsAuthenticated]
+    throttle_classes = [AccountPlanRateThrottle]
+    # query parameter -> (lookup, parser), served from the (uploader, column) indexes
+    metadata_filters = {
+        'image_format': ('image_format', str.upper),
+        'min_width': ('width__gte', int),
+        'max_width': ('width__lte', int),
+        'min_height': ('height__gte', int),
+        'max_height': ('height__lte', int),
+        'min_file_size': ('file_size__gte', int),
+        'max_file_size': ('file_size__lte', int),
+        'taken_after': ('taken_at__gte', parse_aware_datetime),
+        'taken_before': ('taken_at__lt', parse_aware_datetime),
+    }
+    # paged by a (value, primary key) cursor, so equal values don't repeat or get skipped, missing values come last
+    cursor_orderings = {
+        'width': ('width', 'pk'),
+        '-width': ('-width', '-pk'),
+        'height': ('height', 'pk'),
+        '-height': ('-height', '-pk'),
+        'file_size': ('file_size', 'pk'),
+        '-file_size': ('-file_size', '-pk'),
+        'taken': ('taken_at', 'pk'),
+        '-taken': ('-taken_at', '-pk'),
+    }
 
     def get_queryset(self):
         queryset = super(ImageModelView, self).get_queryset()
-        return queryset.filter(uploader=self.request.user)
+        queryset = queryset.filter(uploader=self.request.user).prefetch_related('thumbnails__thumbnail_size')
+        if self.request.method == 'GET':
+            queryset = queryset.filter(**self.get_metadata_filters())
+        return queryset
+
+    def admit_upload(self):
+        # only uploads that render their thumbnails before answering take a render slot
+        if settings.THUMBNAIL_JOBS['EAGER'] and settings.THUMBNAIL_MATERIALIZATION == Thumbnail.MATERIALIZATION_EAGER:
+            return render_admission.admit()
+        return nullcontext()
+
+    def perform_create(self, serializer):
+        with self.admit_upload():
+            serializer.save()
+
+    def similar(self, request, *args, **kwargs):
+        image = self.get_object()
+        max_distance = settings.NEAR_DUPLICATES['MAX_DISTANCE']
+        try:
+            distance = int(request.query_params.get('distance', settings.NEAR_DUPLICATES['DISTANCE']))
+        except ValueError:
+            distance = -1
+        if not 0 <= distance <= max_distance:
+            raise ValidationError({'distance': f'expected a Hamming distance from 0 to {max_distance}'})
 
+        matches = find_near_duplicates(image, distance)[:get_account_plan(request.user).max_page_size]
+        images = self.get_queryset().in_bulk([pk for _, pk in matches])
+        results = []
+        for distance, pk in matches:
+            # the index can still hold images deleted since it was built
+            if pk in images:
+                results.append(dict(self.get_serializer(images[pk]).data, distance=distance))
+        return Response(results)
 
-class ExpirableLinkModelView(viewsets.ModelViewSet):
+    def get_metadata_filters(self):
+        filters = {}
+        for param, (lookup, parse) in self.metadata_filters.items():
+            value = self.request.query_params.get(param)
+            if value is None:
+                continue
+            try:
+                parsed = parse(value)
+            except ValueError:
+                parsed = None
+            if parsed is None:
+                raise ValidationError({param: f'invalid value {value!r}'})
+            filters[lookup] = parsed
+        return filters
+
+    def get_serializer_context(self):
+        context = super(ImageModelView, self).get_serializer_context()
+        if self.request.user.is_authenticated:
+            account_plan = get_account_plan(self.request.user)
+            context.update(account_plan=account_plan, thumbnail_sizes=list(account_plan.thumbnail_sizes.all()))
+        return context
+
+    def bulk(self, request, *args, **kwargs):
+        with self.admit_upload():
+            results = BulkUpload(request.user).upload(request.FILES)
+        if not results:
+            return Response({'detail': 'no image_files or archive uploaded'}, status=status.HTTP_400_BAD_REQUEST)
+        if all('error' in result for result in results):
+            return Response(results, status=status.HTTP_400_BAD_REQUEST)
+        return Response(results, status=status.HTTP_201_CREATED)
+
+
+class ExpirableLinkModelView(CachedListMixin, viewsets.ModelViewSet):
     serializer_class = ExpirableLinkSerializer
-    queryset = ExpirableLink.objects.annotate(
-        expiration_time=ExpressionWrapper(
-            F('time_created') + F('experation_period'), output_field=DateTimeField())
-    ).filter(expiration_time__gt=Now())
+    queryset = ExpirableLink.filter_not_expired().select_related('image')
     permission_classes = [IsCreationOfExpirableLinkAllowedOrReadOnly]
 
+    def get_queryset(self):
+        queryset = super(ExpirableLinkModelView, self).get_queryset()
+        if not self.request.user.is_authenticated:
+            return queryset.none()
+        return queryset.filter(image__uploader=self.request.user)
+
+    def get_list_cache_timeout(self):
+        # a cached page must not outlive the first link on it
+        timeout = super(ExpirableLinkModelView, self).get_list_cache_timeout()
+        for link in getattr(self.paginator, 'page', None) or []:
+            timeout = min(timeout, int((link.expires_at - now()).total_seconds()))
+        return max(timeout, 0)
 
-class ThumbnailModelView(viewsets.ModelViewSet):
+
+class ThumbnailModelView(CachedListMixin, viewsets.ModelViewSet):
     serializer_class = ThumbnailSerializer
     queryset = Thumbnail.objects
     permission_classes = [IsAuthenticated]
@@ -39,17 +210,141 @@ class ThumbnailModelView(viewsets.ModelViewSet):
         queryset = super(ThumbnailModelView, self).get_queryset()
         if self.request.query_params.get('image'):
             queryset = queryset.filter(original_image__pk=int(self.request.query_params.get('image')))
-        return queryset.filter(original_image__uploader=self.request.user)
+        return queryset.filter(original_image__uploader=self.request.user).select_related('thumbnail_size')
+
+    def sprite(self, request, *args, **kwargs):
+        account_plan = get_account_plan(request.user)
+        size_id = request.query_params.get('thumbnail_size', '')
+        size = next((size for size in account_plan.thumbnail_sizes.all() if str(size.pk) == size_id), None)
+        if not size:
+            raise Http404
+
+        images = Image.objects.filter(uploader=request.user)
+        next_link = previous_link = None
+        if request.query_params.get('images'):
+            try:
+                image_ids = [int(image_id) for image_id in request.query_params['images'].split(',')]
+            except ValueError:
+                raise ValidationError({'images': 'expected comma separated image ids'})
+            if len(image_ids) > account_plan.max_page_size:
+                raise ValidationError({'images': f'at most {account_plan.max_page_size} images per sprite'})
+            images = list(images.filter(pk__in=image_ids).order_by('-pk'))
+        else:
+            images = self.paginate_queryset(images)
+            next_link, previous_link = self.paginator.get_next_link(), self.paginator.get_previous_link()
+
+        data = get_sprite(images, size) if images else None
+        if data:
+            data['url'] = request.build_absolute_uri(reverse('thumbnail-sprite-content', kwargs={'key': data['key']}))
+        else:
+            data = {'url': None, 'width': 0, 'height': 0, 'offsets': {}}
+        data.update(next=next_link, previous=previous_link)
+        return Response(data)
 
 
 @require_GET
 def expirable_link_content_view(request, expirable_link):
-    link = ExpirableLink.filter_by_temporary_link(expirable_link).annotate(
-        expiration_time=ExpressionWrapper(
-            F('time_created') + F('experation_period'), output_field=DateTimeField())
-    ).filter(expiration_time__gt=Now()).first()
+    link = ExpirableLink.get_active(expirable_link)
+    if not link:
+        raise Http404
+
+    return serve_file(request, link.image.image_file.storage, link.image.image_file.name, link.image.image_format)
+
+
+def get_signed_link_file(storage, payload):
+    if storage.exists(payload['file']):
+        return payload['file']
+    # moved by relocate_media after the link was signed, the link row points at the new name
+    link = ExpirableLink.get_active(payload['link'])
+    return link.image.image_file.name if link else payload['file']
 
+
+@require_GET
+def signed_link_content_view(request, token):
+    payload = unsign_temporary_link(token)
+    if not payload:
+        raise Http404
+
+    storage = Image._meta.get_field('image_file').storage
+    return serve_file(request, storage, get_signed_link_file(storage, payload), payload.get('format'))
+
+
+async def async_expirable_link_content_view(request, expirable_link):
+    if request.method != 'GET':
+        return HttpResponseNotAllowed(['GET'])
+    link = await sync_to_async(ExpirableLink.get_active)(expirable_link)
     if not link:
         raise Http404
 
-    return FileResponse(link.image.image_file, content_type='image/jpeg')
+    return await serve_file_async(
+        request, link.image.image_file.storage, link.image.image_file.name, link.image.image_format
+    )
+
+
+async def async_signed_link_content_view(request, token):
+    if request.method != 'GET':
+        return HttpResponseNotAllowed(['GET'])
+    # the revocation check is a cache lookup, which is synchronous in this Django
+    payload = await sync_to_async(unsign_temporary_link)(token)
+    if not payload:
+        raise Http404
+
+    storage = Image._meta.get_field('image_file').storage
+    name = await sync_to_async(get_signed_link_file)(storage, payload)
+    return await serve_file_async(request, storage, name, payload.get('format'))
+
+
+@require_GET
+def thumbnail_content_view(request, image, thumbnail_size):
+    if not request.user.is_authenticated:
+        raise PermissionDenied
+
+    image = Image.objects.filter(pk=image, uploader=request.user).first()
+    if not image:
+        raise Http404
+    size = next((size for size in image.get_account_plan().thumbnail_sizes.all() if size.pk == thumbnail_size), None)
+    if not size:
+        raise Http404
+
+    thumbnail = image.get_thumbnail(size)
+    formats = thumbnail.get_formats()
+    image_format = request.GET.get('encoding', '').upper()
+    if image_format and image_format not in formats:
+        raise Http404
+    if not image_format:
+        content_types = {CONTENT_TYPES[image_format]: image_format for image_format in formats}
+        image_format = content_types[negotiate_content_type(request, [
+            (CONTENT_TYPES[image_format], thumbnail.get_encoded_size(image_format)) for image_format in formats
+        ])]
+
+    try:
+        content = thumbnail.open_content(image_format)
+    except RenderCapacityExceeded as e:
+        return too_many_requests(e)
+    response = FileResponse(content, content_type=CONTENT_TYPES[image_format])
+    patch_vary_headers(response, ['Accept'])
+    return response
+
+
+@require_GET
+def thumbnail_sprite_content_view(request, key):
+    if not request.user.is_authenticated:
+        raise PermissionDenied
+    if get_sprite_owner_id(key) != request.user.pk:
+        raise Http404
+
+    path = get_thumbnail_cache().get(get_sprite_name(key))
+    if not path:
+        raise Http404
+    try:
+        response = FileResponse(open(path, 'rb'), content_type=CONTENT_TYPES[FORMAT_JPEG])
+    except FileNotFoundError:
+        raise Http404
+    # the key changes with any of the thumbnails, a sprite under it never does
+    patch_cache_control(response, private=True, max_age=365 * 24 * 60 * 60, immutable=True)
+    return response
+
+
+@require_GET
+def metrics_view(request):
+    return HttpResponse(render_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,91 @@
+"""
+Synthetic users, images of assorted resolutions, thumbnails and expirable links for the benchmarks.
+Rows are bulk inserted and share a few stored files, so 100k images take seconds rather than hours.
+"""
+from datetime import timedelta
+from io import BytesIO
+
+from django.contrib.auth import get_user_model
+from django.core.files.base import ContentFile
+from django.utils.timezone import now
+from PIL import Image as ImageObject
+
+from api.models import AccountPlanAssignement, ExpirableLink, Image, StoredFile, Thumbnail
+from api.rendering import render_thumbnails_from_bytes
+from api.uploadhandlers import get_sha256
+from api.uploads import batches
+
+
+User = get_user_model()
+
+RESOLUTIONS = [(640, 480), (1920, 1080), (4000, 3000)]
+BATCH_SIZE = 1000
+
+_gradients = {}
+
+
+def make_image(width, height, seed=0):
+    # a gradient with one pixel set from the seed, so every seed is a distinct file for deduplication
+    if (width, height) not in _gradients:
+        _gradients[(width, height)] = ImageObject.radial_gradient('L').resize((width, height)).convert('RGB')
+    img = _gradients[(width, height)].copy()
+    img.putpixel((seed % width, seed // width % height), (seed % 256, 0, 255))
+    content = BytesIO()
+    img.save(content, format='JPEG', quality=90)
+    return content.getvalue()
+
+
+def create_users(count, account_plan_id, prefix='benchmark'):
+    users = [User(username=f'{prefix}_{i}') for i in range(count)]
+    for user in users:
+        user.set_unusable_password()
+    User.objects.bulk_create(users)
+    users = list(User.objects.filter(username__startswith=f'{prefix}_').order_by('pk'))
+    AccountPlanAssignement.objects.bulk_create([
+        AccountPlanAssignement(user=user, account_plan_id=account_plan_id) for user in users
+    ])
+    return users
+
+
+def store(storage, content, ext):
+    content = ContentFile(content)
+    return StoredFile.store(storage, get_sha256(content), ext, content)
+
+
+def create_images(user, count, sizes, resolutions=RESOLUTIONS):
+    storage = Image._meta.get_field('image_file').storage
+    originals = []
+    for width, height in resolutions:
+        source = make_image(width, height)
+        rendered = render_thumbnails_from_bytes(source, [(size.width, size.height) for size in sizes])
+        originals.append((
+            store(storage, source, '.jpg'), get_sha256(ContentFile(source)),
+            {size: store(storage, rendered[(size.width, size.height)], '.jpg') for size in sizes},
+        ))
+
+    images = (
+        Image(uploader=user, image_file=name, sha256=sha256, processing_status=Image.PROCESSING_DONE)
+        for name, sha256, _ in (originals[i % len(originals)] for i in range(count))
+    )
+    for batch in batches(images, BATCH_SIZE):
+        Image.objects.bulk_create(batch)
+
+    image_ids = Image.objects.filter(uploader=user).order_by('pk').values_list('pk', flat=True)
+    thumbnails = (
+        Thumbnail(original_image_id=image_id, thumbnail_size=size, thumbnail_image=name)
+        for i, image_id in enumerate(list(image_ids)) for size, name in originals[i % len(originals)][2].items()
+    )
+    for batch in batches(thumbnails, BATCH_SIZE):
+        Thumbnail.objects.bulk_create(batch)
+
+
+def create_links(user, count, period=timedelta(seconds=30000)):
+    time_created = now()
+    image_ids = Image.objects.filter(uploader=user).order_by('pk').values_list('pk', flat=True)[:count]
+    ExpirableLink.objects.bulk_create([
+        ExpirableLink(
+            image_id=image_id, time_created=time_created, experation_period=period, expires_at=time_created + period
+        )
+        for image_id in image_ids
+    ])
+    return list(ExpirableLink.objects.filter(image__uploader=user).select_related('image'))
@@ -0,0 +1,163 @@
+"""
+Measure the hot paths against a throwaway database: Image.save thumbnail throughput per plan,
+image and thumbnail list latency and query counts at growing row counts and temporary link
+resolution. Results are written as JSON, pass an earlier result to --compare to see the change.
+
+    python -m benchmarks.hot_paths --rows 10 1000 100000 --output baseline.json
+    python -m benchmarks.hot_paths --compare baseline.json
+
+Runs on SQLite unless BENCHMARK_DATABASE=postgres is set, see benchmarks/settings.py.
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import time
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'benchmarks.settings')
+
+import django  # noqa: E402
+
+django.setup()
+
+from django.conf import settings  # noqa: E402
+from django.core.files.base import ContentFile  # noqa: E402
+from django.db import connection  # noqa: E402
+from django.test import Client  # noqa: E402
+from django.test.utils import CaptureQueriesContext, override_settings, setup_test_environment  # noqa: E402
+from django.urls import reverse  # noqa: E402
+
+from api.caching import plan_cache  # noqa: E402
+from api.models import AccountPlan, ExpirableLink, Image, get_account_plan  # noqa: E402
+from benchmarks.data import RESOLUTIONS, create_images, create_links, create_users, make_image  # noqa: E402
+
+
+PLANS = {'basic': AccountPlan.BASIC_ID, 'premium': AccountPlan.PREMIUM_ID, 'enterprise': AccountPlan.ENTERPRISE_ID}
+
+
+def time_calls(call, repeat):
+    call()
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        call()
+        timings.append((time.perf_counter() - started) * 1000)
+    with CaptureQueriesContext(connection) as queries:
+        call()
+    timings.sort()
+    return {
+        'median_ms': round(statistics.median(timings), 3),
+        'p90_ms': round(timings[min(len(timings) - 1, int(len(timings) * 0.9))], 3),
+        'queries': len(queries),
+    }
+
+
+def bench_image_save(images_per_plan):
+    results = {}
+    eager = dict(settings.THUMBNAIL_JOBS, EAGER=True)
+    with override_settings(THUMBNAIL_JOBS=eager, THUMBNAIL_MATERIALIZATION='eager'):
+        for name, account_plan_id in PLANS.items():
+            user = create_users(1, account_plan_id, prefix=f'save_{name}')[0]
+            # distinct seeds per plan, or deduplication would reuse the thumbnails of the previous plan
+            sources = [
+                make_image(*RESOLUTIONS[i % len(RESOLUTIONS)], seed=account_plan_id * images_per_plan + i)
+                for i in range(images_per_plan)
+            ]
+            started = time.perf_counter()
+            for i, source in enumerate(sources):
+                Image.objects.create(uploader=user, image_file=ContentFile(source, name=f'{i}.jpg'))
+            elapsed = time.perf_counter() - started
+            sizes = len(get_account_plan(user).thumbnail_sizes.all())
+            results[f'image_save.{name}'] = {
+                'images_per_second': round(images_per_plan / elapsed, 3),
+                'thumbnails_per_second': round(images_per_plan * sizes / elapsed, 3),
+            }
+    return results
+
+
+def bench_lists(rows, repeat):
+    results = {}
+    for count in rows:
+        user = create_users(1, AccountPlan.PREMIUM_ID, prefix=f'list_{count}')[0]
+        create_images(user, count, list(get_account_plan(user).thumbnail_sizes.all()))
+        client = Client()
+        client.force_login(user)
+        for name in ('image', 'thumbnails'):
+            url = reverse(name)
+            results[f'list.{name}.{count}'] = time_calls(lambda: client.get(url), repeat)
+            # the second page in upload order, its cursor has to seek past the first page
+            response = client.get(url, {'ordering': 'uploaded'})
+            deep_url = response.data['next'] or url
+            results[f'list.{name}.{count}.next_page'] = time_calls(lambda: client.get(deep_url), repeat)
+    return results
+
+
+def bench_temporary_links(repeat):
+    results = {}
+    user = create_users(1, AccountPlan.ENTERPRISE_ID, prefix='links')[0]
+    create_images(user, 10, [])
+    link = create_links(user, 1)[0]
+    client = Client()
+    for link_format in (ExpirableLink.FORMAT_ID, ExpirableLink.FORMAT_SIGNED):
+        url = link.generate_temporary_link(link_format=link_format)
+        results[f'temporary_link.{link_format}'] = time_calls(lambda: b''.join(client.get(url)), repeat)
+    return results
+
+
+def compare(results, baseline):
+    for name, metrics in results.items():
+        for metric, value in metrics.items():
+            previous = baseline.get('results', {}).get(name, {}).get(metric)
+            if previous:
+                change = (value - previous) / previous * 100
+                print(f'{name:>40} {metric:>22}: {previous:>12} -> {value:>12} ({change:+.1f}%)')
+            elif previous is not None:
+                print(f'{name:>40} {metric:>22}: {previous:>12} -> {value:>12}')
+            else:
+                print(f'{name:>40} {metric:>22}: {value:>12}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, nargs='+', default=[10, 1000, 100000])
+    parser.add_argument('--images', type=int, default=10, help='Images saved per plan')
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--output', help='Write the results to this JSON file')
+    parser.add_argument('--compare', help='Compare with the results in this JSON file')
+    args = parser.parse_args()
+
+    setup_test_environment()
+    database = connection.creation.create_test_db(verbosity=0)
+    try:
+        plan_cache.invalidate()
+        results = {}
+        results.update(bench_image_save(args.images))
+        results.update(bench_lists(args.rows, args.repeat))
+        results.update(bench_temporary_links(args.repeat))
+    finally:
+        connection.creation.destroy_test_db(database, verbosity=0)
+        shutil.rmtree(settings.MEDIA_ROOT, ignore_errors=True)
+
+    report = {
+        'environment': {
+            'database': connection.vendor,
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        },
+        'results': results,
+    }
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    compare(results, baseline)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,28 @@
+"""
+Settings for running the benchmarks locally, on SQLite by default or on a local Postgres with
+
+    BENCHMARK_DATABASE=postgres POSTGRES_DB=... POSTGRES_USER=... POSTGRES_PASSWORD=... python -m benchmarks.hot_paths
+"""
+import os
+import tempfile
+
+os.environ.setdefault('POSTGRES_DB', 'image_hosting')
+os.environ.setdefault('POSTGRES_USER', 'postgres')
+os.environ.setdefault('POSTGRES_PASSWORD', '')
+
+from image_hosting_api.settings import *  # noqa: E402,F401,F403
+
+
+if os.environ.get('BENCHMARK_DATABASE', 'sqlite') == 'postgres':
+    DATABASES['default']['HOST'] = os.environ.get('POSTGRES_HOST', 'localhost')
+    DATABASES['default']['PORT'] = int(os.environ.get('POSTGRES_PORT', 5432))
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.path.join(tempfile.gettempdir(), 'image_hosting_benchmarks.sqlite3'),
+        }
+    }
+
+MEDIA_ROOT = tempfile.mkdtemp(prefix='image_hosting_benchmarks_media_')
+THUMBNAIL_CACHE = dict(THUMBNAIL_CACHE, LOCATION=os.path.join(MEDIA_ROOT, 'thumbnail_cache'))
@@ -0,0 +1,100 @@
+"""
+Compare the single-decode thumbnail renderer with the old per-size loop, and the render
+engine backends on a batch of images.
+
+    python -m benchmarks.thumbnail_rendering --width 4000 --height 3000 --repeat 5 --images 16
+"""
+import argparse
+import time
+from io import BytesIO
+
+from PIL import Image as ImageObject, ImageFile
+
+from api.rendering import RenderEngine, render_thumbnails
+
+
+ENTERPRISE_LIKE_BOXES = [(1600, 1600), (800, 800), (400, 400), (200, 200), (100, 100)]
+
+
+class DecodeCounter:
+    def __init__(self):
+        self.count = 0
+        self._load = ImageFile.ImageFile.load
+
+    def __enter__(self):
+        counter = self
+
+        def load(img):
+            if img.tile:
+                counter.count += 1
+            return counter._load(img)
+
+        ImageFile.ImageFile.load = load
+        return self
+
+    def __exit__(self, *exc_info):
+        ImageFile.ImageFile.load = self._load
+
+
+def make_source(width, height):
+    img = ImageObject.radial_gradient('L').resize((width, height)).convert('RGB')
+    source = BytesIO()
+    img.save(source, format='JPEG', quality=90)
+    return source.getvalue()
+
+
+def render_per_size(source, boxes):
+    thumbnails = {}
+    for box in boxes:
+        img = ImageObject.open(BytesIO(source))
+        img.thumbnail(box)
+        thumbnail_io = BytesIO()
+        img.save(thumbnail_io, format='JPEG')
+        thumbnails[box] = thumbnail_io
+    return thumbnails
+
+
+def render_once(source, boxes):
+    return render_thumbnails(BytesIO(source), boxes)
+
+
+def measure(render, source, boxes, repeat):
+    with DecodeCounter() as counter:
+        started = time.perf_counter()
+        for _ in range(repeat):
+            render(source, boxes)
+        elapsed = time.perf_counter() - started
+    return counter.count / repeat, elapsed / repeat
+
+
+def measure_engine(backend, workers, source, boxes, images):
+    engine = RenderEngine(backend, workers=workers)
+    engine.map([(source, boxes)])
+    started = time.perf_counter()
+    engine.map([(source, boxes)] * images)
+    elapsed = time.perf_counter() - started
+    engine.shutdown()
+    return images / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--width', type=int, default=4000)
+    parser.add_argument('--height', type=int, default=3000)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--images', type=int, default=16)
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args()
+
+    source = make_source(args.width, args.height)
+    print(f'source {args.width}x{args.height}, {len(source)} bytes, boxes {ENTERPRISE_LIKE_BOXES}')
+    for name, render in (('per-size loop', render_per_size), ('single decode', render_once)):
+        decodes, elapsed = measure(render, source, ENTERPRISE_LIKE_BOXES, args.repeat)
+        print(f'{name:>14}: {decodes:.0f} decodes, {elapsed * 1000:.1f} ms per image')
+    for backend in (RenderEngine.BACKEND_INLINE, RenderEngine.BACKEND_THREAD, RenderEngine.BACKEND_PROCESS):
+        throughput = measure_engine(backend, args.workers, source, ENTERPRISE_LIKE_BOXES, args.images)
+        print(f'{backend:>14}: {throughput:.1f} images per second')
+
+
+if __name__ == '__main__':
+    main()
@@ -45,6 +45,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'api.middleware.RequestMetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -131,13 +132,136 @@ STATIC_URL = '/static/'
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
+REST_FRAMEWORK = {
+    'DEFAULT_PAGINATION_CLASS': 'api.pagination.PrimaryKeyCursorPagination',
+    'PAGE_SIZE': 50,
+}
+
 THUMBNAILS = {
     'METADATA': {
         'BACKEND': 'thumbnails.backends.metadata.DatabaseBackend',
     },
     'STORAGE': {
-        'BACKEND': 'django.core.files.storage.FileSystemStorage',
+        'BACKEND': 'api.storage.ShardedFileSystemStorage',
     }
 }
 
-MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
\ No newline at end of file
+DEFAULT_FILE_STORAGE = 'api.storage.ShardedFileSystemStorage'
+
+# new files go to DEPTH nested directories of WIDTH hex characters of the file name hash, e.g. 3f/a2/<name>
+MEDIA_SHARDING = {
+    'DEPTH': 2,
+    'WIDTH': 2,
+}
+
+MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
+
+# uploads are hashed while they stream in, originals are stored and deduplicated by that hash
+FILE_UPLOAD_HANDLERS = [
+    'api.uploadhandlers.HashingMemoryFileUploadHandler',
+    'api.uploadhandlers.HashingTemporaryFileUploadHandler',
+]
+
+# uploads above this size are streamed to a temporary file in chunks instead of being kept in memory
+FILE_UPLOAD_MAX_MEMORY_SIZE = 2 ** 20
+
+# hard limits of every upload, account plans have their own limits below these,
+# only the image header is read to check the format and dimensions
+IMAGE_UPLOADS = {
+    'MAX_SIZE': 50 * 2 ** 20,
+    'FORMATS': ['JPEG', 'PNG', 'GIF', 'WEBP', 'BMP', 'TIFF'],
+}
+
+
+# Background thumbnail rendering, see `python manage.py process_thumbnail_jobs`
+THUMBNAIL_JOBS = {
+    'EAGER': False,
+    'BATCH_SIZE': 10,
+    'POLL_INTERVAL': 1,
+    'MAX_ATTEMPTS': 3,
+    'STALE_AFTER': 600,
+}
+
+# 'inline' renders in the calling thread, 'thread' and 'process' fan images out over a pool of
+# WORKERS (cpu count by default) and block producers once MAX_PENDING renders are in flight
+THUMBNAIL_RENDERING = {
+    'BACKEND': 'thread',
+    'WORKERS': None,
+    'MAX_PENDING': None,
+}
+
+# 'eager' renders every size of the plan after upload, 'lazy' renders a size the first time it
+# is requested and keeps it in a disk cache of at most MAX_SIZE bytes, evicting the least recently used
+THUMBNAIL_MATERIALIZATION = 'eager'
+
+THUMBNAIL_CACHE = {
+    'LOCATION': os.path.join(BASE_DIR, 'thumbnail_cache'),
+    'MAX_SIZE': 1024 ** 3,
+}
+
+# files uploaded to `images/bulk/` are written to the database BATCH_SIZE at a time
+BULK_UPLOAD = {
+    'BATCH_SIZE': 100,
+}
+
+# 'id' links resolve through the database, 'signed' links carry an HMAC signed token with the file
+# and the expiry and resolve without it. Deleted links are revoked in REVOCATION_CACHE, which has
+# to be shared between processes for revocation to reach all of them
+TEMPORARY_LINKS = {
+    'FORMAT': 'id',
+    'REVOCATION_CACHE': 'default',
+}
+
+# None streams temporary link content from Django. 'x-accel-redirect' hands the file to nginx
+# through an internal location at PREFIX, 'x-sendfile' hands its absolute path to Apache/lighttpd
+FILE_OFFLOAD = {
+    'MODE': None,
+    'PREFIX': '/protected/media/',
+}
+
+# near-duplicate search keeps a BK-tree of image hashes per user in every process, new images are added to it
+# on the next search and it is rebuilt from the database in the background every REBUILD_INTERVAL seconds
+NEAR_DUPLICATES = {
+    'DISTANCE': 6,
+    'MAX_DISTANCE': 10,
+    'REBUILD_INTERVAL': 600,
+    'MAX_INDEXES': 100,
+}
+
+# account plans, their sizes and plan assignments are cached in every process and invalidated by
+# signals, with SHARED_CACHE set to a cache alias the invalidation reaches the other processes too,
+# without it the other processes (web workers, the job worker) see a change after LOCAL_TIMEOUT seconds
+PLAN_CACHE = {
+    'SHARED_CACHE': None,
+    'MAX_ENTRIES': 10000,
+    'LOCAL_TIMEOUT': 10,
+}
+
+# list responses are cached per user under a version that signals bump, CACHE is the alias they are kept in,
+# it has to be shared by every web and worker process (None turns the caching off), TIMEOUT is in seconds
+LIST_CACHE = {
+    'CACHE': None,
+    'TIMEOUT': 300,
+}
+
+# renders started by requests (eager uploads, lazy thumbnails and sprites) share MAX_CONCURRENT_RENDERS slots
+# per process (None for one per CPU), a request waits at most MAX_WAIT seconds for one before it is answered
+# with 429 and Retry-After: RETRY_AFTER, the upload rates of the plans are counted in THROTTLE_CACHE, one per
+# uploaded file, it has to be shared by every web process (the default local memory cache counts per process,
+# so N processes allow N times the rate)
+ADMISSION = {
+    'MAX_CONCURRENT_RENDERS': None,
+    'MAX_WAIT': 2,
+    'RETRY_AFTER': 5,
+    'THROTTLE_CACHE': 'default',
+}
+
+# request, database, thumbnail rendering and storage timings are served as Prometheus histograms on /metrics,
+# every process keeps its own, requests slower than SLOW_REQUEST_THRESHOLD seconds are logged with a breakdown
+REQUEST_METRICS = {
+    'SLOW_REQUEST_THRESHOLD': None,
+}
+
+# route temporary link downloads to async views, for ASGI deployments (image_hosting_api.asgi)
+# where a slow download then holds a coroutine instead of a thread
+ASYNC_VIEWS = False